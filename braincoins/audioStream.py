@@ -0,0 +1,130 @@
+"""
+===============================================================================
+ Live audio streaming from TextToSpeech.tts_stream to HTTP / WebSocket clients
+-------------------------------------------------------------------------------
+ tts_stream (tortoise/api_fast.py) is a blocking generator, so it runs on a
+ producer thread that holds one streaming engine, encodes every waveform chunk
+ as it is yielded and hands the bytes to the event loop through an
+ asyncio.Queue. The HTTP/WebSocket handler just forwards them.
+
+ Cancellation: when the client goes away the handler calls cancel(). The
+ producer notices before encoding its next chunk, closes the tts_stream
+ generator (which stops autoregressive decoding) and returns the engine to
+ the pool.
+===============================================================================
+"""
+
+import asyncio
+import logging
+import threading
+import traceback
+
+from tortoise.utils.audio_encoders import AudioEncoder
+
+logger = logging.getLogger("tortoise-api")
+
+_END = object()
+
+
+class AudioStream:
+    """
+    Streams encoded audio for `texts` (spoken back to back) from an engine of `pool`.
+
+    :param pool: EnginePool of engines exposing tts_stream(text, **kwargs).
+    :param texts: Text segments; each must fit in a single tts_stream call.
+    :param audio_format: Output format, see tortoise.utils.audio_encoders.FORMATS.
+    :param acquire_timeout: Seconds to wait for a free streaming engine.
+    :param tts_kwargs: Forwarded to tts_stream.
+    """
+
+    def __init__(self, pool, texts, audio_format="pcm16", acquire_timeout=None, **tts_kwargs):
+        self.pool = pool
+        self.texts = texts
+        self.audio_format = audio_format
+        self.acquire_timeout = acquire_timeout
+        self.tts_kwargs = tts_kwargs
+        # The bytes reach the client as they are encoded: WAV headers say "unknown length" instead of being patched.
+        self.encoder = AudioEncoder(audio_format, streaming=True)
+        self.content_type = self.encoder.content_type
+        self.chunks_sent = 0
+        self.finished = False
+        self._cancelled = threading.Event()
+        self._queue = None
+        self._loop = None
+        self._thread = None
+
+    def start(self):
+        """Start producing; must be called from the event loop that will consume the stream."""
+        self._loop = asyncio.get_running_loop()
+        self._queue = asyncio.Queue()
+        self._thread = threading.Thread(target=self._produce, name="tts-stream", daemon=True)
+        self._thread.start()
+
+    def cancel(self):
+        if not self._cancelled.is_set():
+            logger.info(f"Audio stream cancelled after {self.chunks_sent} chunk(s)")
+        self._cancelled.set()
+
+    @property
+    def cancelled(self):
+        return self._cancelled.is_set()
+
+    def _emit(self, item):
+        try:
+            self._loop.call_soon_threadsafe(self._queue.put_nowait, item)
+        except RuntimeError:
+            # Event loop already closed (server shutting down).
+            self._cancelled.set()
+
+    def _produce(self):
+        try:
+            with self.pool.acquire(timeout=self.acquire_timeout) as tts:
+                for text in self.texts:
+                    generator = tts.tts_stream(text, **self.tts_kwargs)
+                    try:
+                        for wav in generator:
+                            if self._cancelled.is_set():
+                                break
+                            data = self.encoder.encode(wav)
+                            if data:
+                                self._emit(data)
+                    finally:
+                        # Stops autoregressive decoding right away when the client has gone.
+                        generator.close()
+                    if self._cancelled.is_set():
+                        return
+            data = self.encoder.finish()
+            if data:
+                self._emit(data)
+            self._emit(_END)
+        except Exception as e:
+            self.finished = True
+            logger.error(f"Audio stream failed: {e}")
+            logger.error(traceback.format_exc())
+            self._emit(e)
+
+    async def next_chunk(self):
+        """Returns the next encoded chunk, None at the end of the stream; re-raises producer errors."""
+        item = await self._queue.get()
+        if item is _END:
+            self.finished = True
+            return None
+        if isinstance(item, Exception):
+            raise item
+        self.chunks_sent += 1
+        return item
+
+    async def iter_chunks(self, first=None):
+        """Async iterator over the remaining chunks (optionally starting with an already fetched one)."""
+        try:
+            if first is not None:
+                yield first
+            while True:
+                chunk = await self.next_chunk()
+                if chunk is None:
+                    return
+                yield chunk
+        finally:
+            # Reached without `finished` when the response is torn down by a client disconnect.
+            if not self.finished:
+                self.cancel()
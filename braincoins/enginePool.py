@@ -0,0 +1,193 @@
+"""
+===============================================================================
+ Resident TextToSpeech engine pool
+-------------------------------------------------------------------------------
+ Loading a TextToSpeech instance pulls the autoregressive, diffusion, CLVP and
+ vocoder checkpoints (plus the wav2vec2 aligner) from disk, which takes tens of
+ seconds. This module loads a configurable number of engines once per process,
+ keeps them warm and hands them out to requests one at a time (or, for
+ engines that batch concurrent requests themselves, up to slots_per_engine
+ at a time).
+
+ Lifecycle (see EnginePool.state):
+ - "cold":    nothing loaded yet.
+ - "warming": engines are being loaded / warmed up in the background.
+ - "ready":   every engine is loaded and available for checkout.
+ - "failed":  loading raised; see EnginePool.error.
+===============================================================================
+"""
+
+import logging
+import queue
+import threading
+import time
+import traceback
+from contextlib import contextmanager
+
+logger = logging.getLogger("tortoise-api")
+
+
+class EngineUnavailable(Exception):
+    """Raised when no engine could be checked out of the pool in time."""
+
+
+class EnginePool:
+    """
+    A fixed-size pool of long-lived TTS engines.
+
+    :param factory: Zero-argument callable returning a new engine (normally tortoise.api.TextToSpeech). Anything
+                    with the same interface works, which lets the API be exercised with a stub engine.
+    :param size: Number of engines to keep resident.
+    :param warmup: Optional callable(engine) run once on every engine after it is constructed.
+    :param slots_per_engine: How many requests may use one engine at the same time. Only engines that are safe to
+                             call from several threads (e.g. tortoise.utils.stream_engine.StreamingEngine) take more
+                             than one.
+    """
+
+    def __init__(self, factory, size=1, warmup=None, slots_per_engine=1):
+        if size < 1:
+            raise ValueError("EnginePool needs at least one engine.")
+        if slots_per_engine < 1:
+            raise ValueError("EnginePool needs at least one slot per engine.")
+        self.factory = factory
+        self.size = size
+        self.warmup = warmup
+        self.slots_per_engine = slots_per_engine
+        self.state = "cold"
+        self.error = None
+        self.load_seconds = None
+        self._idle = queue.Queue()
+        self._engines = []
+        self._in_use = 0
+        self._lock = threading.Lock()
+        self._loader = None
+
+    # --------------------------------------------------------------------------
+    # Loading
+    # --------------------------------------------------------------------------
+    def start(self, background=True):
+        """
+        Begin loading the engines. With background=True this returns immediately and the pool becomes ready
+        once the loader thread finishes; requests arriving earlier wait in acquire().
+        """
+        with self._lock:
+            if self.state != "cold":
+                return
+            self.state = "warming"
+        if background:
+            self._loader = threading.Thread(target=self._load_all, name="tts-engine-loader", daemon=True)
+            self._loader.start()
+        else:
+            self._load_all()
+
+    def _load_all(self):
+        start = time.time()
+        try:
+            for i in range(self.size):
+                logger.info(f"Loading TTS engine {i + 1}/{self.size}")
+                engine = self.factory()
+                if self.warmup is not None:
+                    logger.info(f"Warming up TTS engine {i + 1}/{self.size}")
+                    self.warmup(engine)
+                with self._lock:
+                    self._engines.append(engine)
+                # Engines are handed out as soon as they are loaded, before the whole pool is ready.
+                for _ in range(self.slots_per_engine):
+                    self._idle.put(engine)
+        except Exception as e:
+            logger.error(f"TTS engine loading failed: {e}")
+            logger.error(traceback.format_exc())
+            with self._lock:
+                self.state = "failed"
+                self.error = str(e)
+            return
+        with self._lock:
+            self.load_seconds = time.time() - start
+            self.state = "ready"
+        logger.info(f"TTS engine pool ready ({self.size} engine(s) in {self.load_seconds:.1f}s)")
+
+    def wait_ready(self, timeout=None):
+        """Block until the background loader finishes. Returns True if the pool is ready."""
+        if self._loader is not None:
+            self._loader.join(timeout)
+        return self.ready
+
+    # --------------------------------------------------------------------------
+    # Checkout
+    # --------------------------------------------------------------------------
+    @property
+    def ready(self):
+        return self.state == "ready"
+
+    @contextmanager
+    def acquire(self, timeout=None):
+        """
+        Check an engine out of the pool for the duration of the with-block.
+        Raises EngineUnavailable if the pool failed to load or no engine frees up within `timeout` seconds.
+        """
+        if self.state == "failed":
+            raise EngineUnavailable(f"TTS engines failed to load: {self.error}")
+        if self.state == "cold":
+            raise EngineUnavailable("TTS engine pool has not been started.")
+        try:
+            engine = self._idle.get(timeout=timeout)
+        except queue.Empty:
+            raise EngineUnavailable(f"No TTS engine became available within {timeout}s.")
+        with self._lock:
+            self._in_use += 1
+        try:
+            yield engine
+        finally:
+            with self._lock:
+                self._in_use -= 1
+            self._idle.put(engine)
+
+    def status(self):
+        with self._lock:
+            return {
+                "state": self.state,
+                "engines_total": self.size,
+                "engines_loaded": len(self._engines),
+                "slots_per_engine": self.slots_per_engine,
+                "engines_in_use": self._in_use,
+                "engines_idle": len(self._engines) * self.slots_per_engine - self._in_use,
+                "load_seconds": self.load_seconds,
+                "error": self.error,
+            }
+
+
+class StubEngine:
+    """
+    Stand-in for tortoise.api.TextToSpeech (and tortoise.api_fast.TextToSpeech.tts_stream) that renders a quiet tone
+    instead of speech, so the API, queueing, streaming and storage paths can be exercised without model checkpoints
+    or a GPU. Select it with TTS_ENGINE=stub; test_enginePool.py uses it.
+
+    :param seconds_per_char: Length of the rendered clip per input character.
+    :param delay: Seconds to sleep per call, to imitate synthesis latency.
+    """
+    sample_rate = 24000
+
+    def __init__(self, seconds_per_char=0.05, delay=0.0):
+        self.seconds_per_char = seconds_per_char
+        self.delay = delay
+
+    def tts_with_preset(self, text, preset='fast', **kwargs):
+        return self.tts(text, **kwargs)
+
+    def tts(self, text, k=1, **kwargs):
+        import math
+        import torch
+        if self.delay:
+            time.sleep(self.delay)
+        n = max(1, int(len(text) * self.seconds_per_char * self.sample_rate))
+        t = torch.arange(n, dtype=torch.float32) / self.sample_rate
+        wav = (0.1 * torch.sin(2 * math.pi * 220 * t)).view(1, 1, n)
+        return wav if k == 1 else [wav.clone() for _ in range(k)]
+
+    def tts_stream(self, text, chunk_seconds=0.5, **kwargs):
+        wav = self.tts(text).reshape(-1)
+        step = int(chunk_seconds * self.sample_rate)
+        for i in range(0, wav.shape[0], step):
+            if self.delay:
+                time.sleep(self.delay)
+            yield wav[i:i + step]
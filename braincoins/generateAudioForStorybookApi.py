@@ -9,33 +9,72 @@
  Key Features:
  - Accepts text input along with metadata (chapter/page, number, and voice).
  - Uses Tortoise TTS to synthesize speech audio.
- - Uploads the generated audio directly to an S3 bucket.
+ - Streams the generated audio directly to an S3 bucket (multipart upload for
+   long clips, through one shared, connection-pooled client).
  - Automatically creates the "audios" folder in S3 if it does not exist.
  - Returns the public S3 URL for the uploaded audio file.
+ - Splits long texts into segments, synthesizes them in parallel on all
+   engines and stitches them (silence or crossfade) in order; per-segment
+   progress is reported on the job (see segmentScheduler.py).
+ - Keeps a pool of warm TextToSpeech engines resident for the lifetime of the
+   process (see enginePool.py); /health and /ready expose their state.
+ - Asynchronous jobs: POST /jobs returns a job id immediately, GET /jobs/{id}
+   and GET /jobs/{id}/result poll for the outcome. Jobs run on a bounded
+   worker pool (see jobQueue.py); a full queue answers 429 with Retry-After.
+ - Scheduling: segments run on the engines in priority order (interactive
+   before batch, preempting chapters at segment boundaries) with weighted
+   fair share between tenants, i.e. API keys or S3 buckets (see scheduler.py).
+ - Live streaming: POST /stream (chunked HTTP) and /stream/ws (WebSocket) send
+   encoded audio while tortoise.api_fast's tts_stream is still generating it,
+   on a separate pool of streaming engines (see audioStream.py). With
+   TTS_STREAM_BATCH_SIZE > 1 each engine decodes that many streams together.
+ - TTS_PREFIX_CACHE_MB keeps the autoregressive prompt states of recent
+   voice + text pairs on each engine, so repeated pages and retries skip
+   the prompt pass (see tortoise/utils/prefix_cache.py).
+ - Prometheus metrics on /metrics: per-stage synthesis timings (tokenization
+   ... vocoder, redaction, upload), cache hits, generated tokens, discarded
+   samples, engine/queue gauges (see tortoise/utils/instrumentation.py).
+ - TTS_ENGINE=stub and TTS_OBJECT_STORE=memory run the whole API without model
+   checkpoints or cloud credentials.
 
  Dependencies:
  - FastAPI (API framework)
  - boto3 (AWS S3 interaction)
- - torchaudio (for saving audio tensors as .wav)
+ - soundfile (audio is encoded to WAV/FLAC/Opus/MP3 while uploading)
  - Tortoise TTS (text-to-speech model)
  - pydantic (request validation)
 ===============================================================================
 """
 
-from fastapi import FastAPI, HTTPException
+from fastapi import FastAPI, Header, HTTPException, WebSocket, WebSocketDisconnect
+from fastapi.responses import JSONResponse, Response, StreamingResponse
+from starlette.concurrency import run_in_threadpool
 from pydantic import BaseModel
 import sys
 import os
 sys.path.append(os.path.dirname(__file__))
-import boto3
-import io
-import torchaudio
+import json
+import hashlib
+import time
+import torch
 import logging
 from tortoise.api import TextToSpeech
+from tortoise.api_fast import TextToSpeech as StreamingTextToSpeech
+from tortoise.utils.stream_engine import StreamingEngine
 from tortoise.utils.audio import load_voice
-from botocore.exceptions import ClientError
+from tortoise.utils.result_cache import SynthesisCache
+from tortoise.utils.prefix_cache import PrefixCache
+from tortoise.utils.audio_encoders import AudioEncoder, iter_encoded, get_format, output_filename
+from tortoise.utils.instrumentation import MetricsRegistry, MetricsHooks
 import s3Config  # your S3 config module
-import traceback
+import ttsConfig
+from enginePool import EnginePool, EngineUnavailable, StubEngine
+from jobQueue import JobManager, QueueFull
+from objectStore import S3ObjectStore, InMemoryObjectStore, ObjectStoreCacheTier
+from audioStream import AudioStream
+from segmentScheduler import split_text, SegmentStitcher, synthesize_segments
+from scheduler import FairScheduler, PRIORITY_CLASSES, parse_weights
+from typing import Optional
 
 # ------------------------------------------------------------------------------
 # Centralized logger configuration (works with systemd/journald)
@@ -54,6 +93,99 @@ if not logger.handlers:
 
 app = FastAPI()
 
+# ------------------------------------------------------------------------------
+# Metrics (served on /metrics): the engines report their pipeline stages here.
+# ------------------------------------------------------------------------------
+metrics = MetricsRegistry()
+pipeline_hooks = MetricsHooks(metrics)
+
+# ------------------------------------------------------------------------------
+# Object storage for the generated audio
+# ------------------------------------------------------------------------------
+if ttsConfig.TTS_OBJECT_STORE == "memory":
+    object_store = InMemoryObjectStore()
+else:
+    object_store = S3ObjectStore(s3Config)
+
+# ------------------------------------------------------------------------------
+# Synthesis result cache shared by all engines (seeded requests only)
+# ------------------------------------------------------------------------------
+result_cache = None
+if ttsConfig.TTS_RESULT_CACHE_DIR:
+    remote_tier = None
+    if ttsConfig.TTS_RESULT_CACHE_BUCKET:
+        remote_tier = ObjectStoreCacheTier(object_store, ttsConfig.TTS_RESULT_CACHE_BUCKET, ttsConfig.TTS_RESULT_CACHE_PREFIX)
+    result_cache = SynthesisCache(ttsConfig.TTS_RESULT_CACHE_DIR, max_bytes=ttsConfig.TTS_RESULT_CACHE_MAX_BYTES, remote=remote_tier)
+
+# ------------------------------------------------------------------------------
+# Resident TTS engines: loaded once at startup, shared by every request.
+# ------------------------------------------------------------------------------
+prefix_caches = []
+
+def create_prefix_cache():
+    # One per engine: the cached states live on that engine's device.
+    if ttsConfig.TTS_PREFIX_CACHE_MB > 0 and ttsConfig.TTS_KV_CACHE:
+        prefix_caches.append(PrefixCache(ttsConfig.TTS_PREFIX_CACHE_MB * 1024 ** 2))
+        return prefix_caches[-1]
+    return None
+
+def prefix_cache_stats():
+    if not prefix_caches:
+        return None
+    stats = [cache.stats() for cache in prefix_caches]
+    return {key: sum(s[key] for s in stats) for key in stats[0]}
+
+def create_engine():
+    if ttsConfig.TTS_ENGINE == "stub":
+        return StubEngine(delay=ttsConfig.TTS_STUB_DELAY)
+    kwargs = {"kv_cache": ttsConfig.TTS_KV_CACHE, "half": ttsConfig.TTS_HALF, "result_cache": result_cache,
+              "hooks": pipeline_hooks}
+    kwargs["placement"] = ttsConfig.TTS_PLACEMENT
+    kwargs["reuse_ar_latents"] = ttsConfig.TTS_REUSE_AR_LATENTS
+    kwargs["prefix_cache"] = create_prefix_cache()
+    if ttsConfig.TTS_PLACEMENT_BUDGET_MB is not None:
+        kwargs["placement_budget"] = ttsConfig.TTS_PLACEMENT_BUDGET_MB * 1024 ** 2
+    if ttsConfig.TTS_MODELS_DIR:
+        kwargs["models_dir"] = ttsConfig.TTS_MODELS_DIR
+    tts = TextToSpeech(**kwargs)
+    # Load CLVP, the vocoder and the aligner now rather than in the first request that needs them.
+    tts.preload()
+    return tts
+
+def warmup_engine(tts):
+    tts.tts_with_preset(ttsConfig.TTS_WARMUP_TEXT, preset='ultra_fast', verbose=False)
+
+engine_pool = EnginePool(
+    create_engine,
+    size=ttsConfig.TTS_ENGINE_COUNT,
+    warmup=warmup_engine if ttsConfig.TTS_WARMUP else None,
+)
+
+# ------------------------------------------------------------------------------
+# Streaming engines (tortoise.api_fast: HiFi-GAN decoder, chunked output),
+# reserved for the live /stream endpoints.
+# ------------------------------------------------------------------------------
+def create_stream_engine():
+    if ttsConfig.TTS_ENGINE == "stub":
+        return StubEngine(delay=ttsConfig.TTS_STUB_DELAY)
+    kwargs = {"kv_cache": ttsConfig.TTS_KV_CACHE, "half": ttsConfig.TTS_HALF, "prefix_cache": create_prefix_cache()}
+    if ttsConfig.TTS_MODELS_DIR:
+        kwargs["models_dir"] = ttsConfig.TTS_MODELS_DIR
+    if ttsConfig.TTS_STREAM_BATCH_SIZE > 1:
+        return StreamingEngine(StreamingTextToSpeech(**kwargs), max_batch_size=ttsConfig.TTS_STREAM_BATCH_SIZE)
+    return StreamingTextToSpeech(**kwargs)
+
+stream_pool = EnginePool(create_stream_engine, size=max(1, ttsConfig.TTS_STREAM_ENGINE_COUNT),
+                         slots_per_engine=max(1, ttsConfig.TTS_STREAM_BATCH_SIZE))
+
+@app.on_event("startup")
+def load_engines():
+    engine_pool.start(background=True)
+    segment_scheduler.start()
+    if ttsConfig.TTS_STREAM_ENGINE_COUNT > 0:
+        stream_pool.start(background=True)
+    job_manager.start()
+
 # ------------------------------------------------------------------------------
 # Request body model
 # ------------------------------------------------------------------------------
@@ -63,69 +195,116 @@ class AudioRequest(BaseModel):
     type: str  # "chapter" or "page"
     number: int
     voice: str = 'random'
+    seed: Optional[int] = None  # Fixed seed: reproducible output, served from the result cache when possible
+    silence_ms: Optional[int] = None  # Silence between text segments (default TTS_SEGMENT_SILENCE_MS)
+    crossfade_ms: Optional[int] = None  # Crossfade between text segments instead of silence (default TTS_SEGMENT_CROSSFADE_MS)
+    format: Optional[str] = None  # wav | pcm16 | flac | opus | mp3 (default TTS_OUTPUT_FORMAT)
+    priority: Optional[str] = None  # "interactive" | "batch" (default TTS_DEFAULT_PRIORITY)
+
+class StreamRequest(BaseModel):
+    text: str
+    voice: str = 'random'
+    seed: Optional[int] = None
+    format: Optional[str] = None  # wav | pcm16 | flac | opus | mp3 (default TTS_STREAM_FORMAT)
 
 # ------------------------------------------------------------------------------
 # Function: Generate audio from text using Tortoise TTS
+# The text is split into segments which are synthesized in parallel on all
+# engines; the stitched audio is returned as an iterator of tensors, in order,
+# that starts producing as soon as the first segment is done.
 # ------------------------------------------------------------------------------
-def generate_audio(text, voice='random'):
+# One slot per engine: a segment task holds an engine for its whole duration.
+# The scheduler decides which queued segment (by priority class, then tenant) gets the next free engine.
+segment_scheduler = FairScheduler(
+    workers=ttsConfig.TTS_ENGINE_COUNT,
+    weights=parse_weights(ttsConfig.TTS_TENANT_WEIGHTS),
+)
+
+def synthesize_segment(text, voice_samples, conditioning_latents, seed):
     try:
-        tts = TextToSpeech()
-        voice_samples, conditioning_latents = load_voice(voice)
-        audio = tts.tts_with_preset(
-            text,
-            voice_samples=voice_samples,
-            conditioning_latents=conditioning_latents,
-            preset='fast'
-        )
-        return audio
+        with engine_pool.acquire(timeout=ttsConfig.TTS_ENGINE_ACQUIRE_TIMEOUT) as tts:
+            return tts.tts_with_preset(
+                text,
+                voice_samples=voice_samples,
+                conditioning_latents=conditioning_latents,
+                preset=ttsConfig.TTS_PRESET,
+                use_deterministic_seed=seed,
+                score_threshold=ttsConfig.TTS_SEARCH_SCORE_THRESHOLD,
+                search_patience=ttsConfig.TTS_SEARCH_PATIENCE,
+                search_time_budget=ttsConfig.TTS_SEARCH_TIME_BUDGET,
+            )
     except Exception as e:
         logger.error(f"Audio generation failed: {e}")
         raise
 
+def generate_audio(text, voice='random', seed=None, progress=None, silence_ms=None, crossfade_ms=None,
+                   priority="batch", tenant="default"):
+    voice_samples, conditioning_latents = load_voice(voice)
+    if seed is None:
+        seed = ttsConfig.TTS_DEFAULT_SEED
+    texts = split_text(text, ttsConfig.TTS_SEGMENT_DESIRED_LENGTH, ttsConfig.TTS_SEGMENT_MAX_LENGTH)
+    if not texts:
+        raise ValueError("No text to synthesize.")
+    logger.info(f"Synthesizing {len(texts)} segment(s)")
+    stitcher = SegmentStitcher(
+        sample_rate=24000,
+        silence_ms=ttsConfig.TTS_SEGMENT_SILENCE_MS if silence_ms is None else silence_ms,
+        crossfade_ms=ttsConfig.TTS_SEGMENT_CROSSFADE_MS if crossfade_ms is None else crossfade_ms,
+    )
+    return synthesize_segments(
+        texts,
+        lambda segment: synthesize_segment(segment, voice_samples, conditioning_latents, seed),
+        segment_scheduler.bind(priority, tenant),
+        stitcher,
+        progress=progress,
+    )
+
 # ------------------------------------------------------------------------------
 # Function: Upload audio file to S3
-# Save audio tensor to WAV in memory and upload directly to S3 at the given path.
+# Encodes audio in the requested format (see tortoise/utils/audio_encoders.py)
+# while streaming it to the object store (multipart once it exceeds one part).
+# `audio` is a tensor or an iterable of tensors produced over time. Containers
+# that rewrite their header on close (WAV, FLAC) are patched by the uploader.
 # Returns the public URL of the uploaded file.
+# The "upload" stage metric excludes the time spent waiting for the audio.
 # ------------------------------------------------------------------------------
-def upload_audio_to_s3(audio, bucket_name, s3_key):
-    print(f"Bucket Name: {bucket_name}, Key: {s3_key}")
+def timed_iter(iterable, elapsed):
+    """Yields from `iterable`, adding the time spent producing each item to elapsed[0]."""
+    iterator = iter(iterable)
+    while True:
+        start = time.perf_counter()
+        try:
+            item = next(iterator)
+        except StopIteration:
+            return
+        finally:
+            elapsed[0] += time.perf_counter() - start
+        yield item
+
+def upload_audio_to_s3(audio, bucket_name, s3_key, audio_format="wav", sample_rate=24000):
+    logger.info(f"Bucket Name: {bucket_name}, Key: {s3_key}")
     # Ensure no leading slash in key
     s3_key = s3_key.lstrip("/")
-    
-    s3 = boto3.client(
-        "s3",
-        region_name=s3Config.S3_REGION,
-        aws_access_key_id=s3Config.AWS_ACCESS_KEY_ID,
-        aws_secret_access_key=s3Config.AWS_SECRET_ACCESS_KEY
-    )
 
     try:
-        buffer = io.BytesIO()
-        torchaudio.save(
-            buffer,
-            audio.squeeze(0).cpu(),
-            sample_rate=24000,
-            format="wav"
-        )
-        buffer.seek(0)
-
-        logger.info(f"Uploading to S3 -> Bucket: {bucket_name}, Key: {s3_key}")
+        if torch.is_tensor(audio):
+            # Hand the encoder one second at a time so encoding and upload overlap.
+            audio = audio.reshape(-1).split(sample_rate)
+        else:
+            audio = (piece for chunk in audio for piece in chunk.reshape(-1).split(sample_rate))
 
-        s3.put_object(
-            Bucket=bucket_name,
-            Key=s3_key,
-            Body=buffer,
-            ACL="public-read",
-            ContentType="audio/wav",
+        encoder = AudioEncoder(audio_format, sample_rate)
+        producing = [0.0]
+        start = time.perf_counter()
+        url = object_store.upload_stream(
+            bucket_name,
+            s3_key,
+            timed_iter(iter_encoded(audio, encoder), producing),
+            encoder.content_type,
+            finalize_head=lambda head, total: encoder.patch_head(head),
         )
-
-        if getattr(s3Config, "S3_ENDPOINT_URL", None):
-            base_url = s3Config.S3_ENDPOINT_URL.rstrip("/")
-            url = f"{base_url}/{s3_key}"
-        else:
-            url = f"https://{bucket_name}.s3.{s3Config.S3_REGION}.amazonaws.com/{s3_key}"
-        
-        logger.info(f"Upload successful: {url}")
+        pipeline_hooks.on_stage("upload", time.perf_counter() - start - producing[0])
+        logger.info(f"Upload successful: {url} ({encoder.total_bytes} bytes {audio_format})")
         return url
 
     except Exception as e:
@@ -151,52 +330,195 @@ def ensure_audio_folder_exists(bucket, prefix):
     Ensure that the given folder path exists in S3.
     If it doesn’t exist, create it by uploading a placeholder file (.keep).
     """
-    s3 = boto3.client(
-        "s3",
-        region_name=s3Config.S3_REGION,
-        aws_access_key_id=s3Config.AWS_ACCESS_KEY_ID,
-        aws_secret_access_key=s3Config.AWS_SECRET_ACCESS_KEY
-    )
-    
-    # Folder we want
-    audios_prefix = f"{prefix.rstrip('/')}"
-    
+    object_store.ensure_folder(bucket, prefix)
+
+# ------------------------------------------------------------------------------
+# Helper Function: Validate a request and work out where its audio goes
+# ------------------------------------------------------------------------------
+def request_format(request):
+    return request.format or ttsConfig.TTS_OUTPUT_FORMAT
+
+def request_priority(request):
+    return request.priority or ttsConfig.TTS_DEFAULT_PRIORITY
+
+def request_tenant(request, api_key=None):
+    """Fair-share key of a request: the caller's API key if it sent one, otherwise the target bucket."""
+    if api_key:
+        return api_key
+    return parse_s3_path(request.s3_path)[0]
+
+def resolve_audio_target(request):
+    """Returns (bucket, audio_dir, s3_key). Raises ValueError for malformed requests."""
+    # Parse bucket and folder path
+    bucket, folder = parse_s3_path(request.s3_path)
+    audio_dir = folder + "/audios"
+
+    # Determine filename based on type
+    audio_format = request_format(request)
+    get_format(audio_format)  # raises ValueError for unknown formats
+    if request_priority(request) not in PRIORITY_CLASSES:
+        raise ValueError(f"Invalid priority. Must be one of: {', '.join(PRIORITY_CLASSES)}.")
+    if request.type == "chapter":
+        audio_filename = output_filename(f"chapter_{request.number}", audio_format)
+    elif request.type == "page":
+        audio_filename = output_filename(f"page_{request.number}", audio_format)
+    else:
+        raise ValueError("Invalid type. Must be 'chapter' or 'page'.")
+
+    # Construct S3 key
+    s3_key = f"{audio_dir}/{audio_filename}".lstrip("/")
+    return bucket, audio_dir, s3_key
+
+# ------------------------------------------------------------------------------
+# Job handler: executed on a job worker thread for every accepted request
+# ------------------------------------------------------------------------------
+def process_audio_request(payload, progress=None):
+    request, tenant = payload
+    bucket, audio_dir, s3_key = resolve_audio_target(request)
+
+    # Ensure the audios folder exists
+    ensure_audio_folder_exists(bucket, audio_dir)
+
+    logger.info(f"Generating audio for {request.type} {request.number} using voice: {request.voice}")
+    audio = generate_audio(request.text, request.voice, request.seed, progress=progress,
+                           silence_ms=request.silence_ms, crossfade_ms=request.crossfade_ms,
+                           priority=request_priority(request), tenant=tenant)
+
+    # Segments are uploaded as they are stitched, while later ones are still being generated.
+    logger.info(f"Uploading to S3: {s3_key}")
+    s3_url = upload_audio_to_s3(audio, bucket, s3_key, request_format(request))
+    return {"s3_url": s3_url}
+
+job_manager = JobManager(
+    process_audio_request,
+    workers=ttsConfig.TTS_JOB_WORKERS,
+    max_queued=ttsConfig.TTS_MAX_QUEUED_JOBS,
+    retention=ttsConfig.TTS_JOB_RETENTION,
+)
+
+def request_key(request, tenant):
+    """Identical requests (same tenant, target, text, voice, seed...) share one in-flight job."""
+    # The job runs (and is accounted) under one tenant, so requests of different tenants never share it.
+    payload = {"tenant": tenant, "request": request.dict()}
+    return hashlib.sha256(json.dumps(payload, sort_keys=True).encode("utf-8")).hexdigest()
+
+def submit_job(request, api_key=None):
+    """Validate and enqueue a request, coalescing it with an identical in-flight one. Raises HTTPException 400 / 429."""
     try:
-        # Check if the folder exists
-        try:
-            response = s3.list_objects_v2(
-                Bucket=bucket,
-                Prefix=audios_prefix,
-                MaxKeys=1
-            )
-            exists = 'Contents' in response
-        except ClientError as e:
-            if e.response['Error']['Code'] == 'NoSuchKey':
-                exists = False
-                print(prefix, " Doesn't exist");
-                response = {} # ensure response exists
-            else:
-                raise
-        
-        # Create folder if it does not exist
-        if not exists:  
-            # Folder doesn't exist — create it by putting an empty key
-            dummy_key = audios_prefix + "/.keep"
-            s3.put_object(Bucket=bucket, Key=dummy_key, Body=b'', ACL='public-read')
-            print(f"Created folder: {audios_prefix}")
-        else:
-            print(f"Folder already exists: {audios_prefix}")
+        resolve_audio_target(request)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    priority = request_priority(request)
+    tenant = request_tenant(request, api_key)
+    try:
+        job, attached = job_manager.submit(
+            (request, tenant),
+            key=request_key(request, tenant),
+            priority=PRIORITY_CLASSES.index(priority),
+        )
+    except QueueFull as e:
+        logger.warning(f"Rejecting request: {e}")
+        raise HTTPException(status_code=429, detail=str(e), headers={"Retry-After": "5"})
+    if attached:
+        logger.info(f"Request for {request.type} {request.number} attached to in-flight job {job.id}")
+    return job
 
-    except Exception:
-        logger.error("Exception while checking/creating folder:")
-        logger.error(traceback.format_exc())
-        raise
+# ------------------------------------------------------------------------------
+# API Endpoints: Liveness / readiness of the engine pool
+# ------------------------------------------------------------------------------
+@app.get("/health")
+def health():
+    return {
+        "status": "ok",
+        "engines": engine_pool.status(),
+        "jobs": job_manager.status(),
+        "scheduler": segment_scheduler.status(),
+        "stream_engines": stream_pool.status() if ttsConfig.TTS_STREAM_ENGINE_COUNT > 0 else None,
+        "result_cache": result_cache.stats() if result_cache is not None else None,
+        "prefix_cache": prefix_cache_stats(),
+    }
+
+engines_gauge = metrics.gauge("tortoise_engines", "Resident TTS engines by state.", ("pool", "state"))
+jobs_gauge = metrics.gauge("tortoise_jobs", "Jobs currently known to the job manager, by status.", ("status",))
+queued_segments_gauge = metrics.gauge("tortoise_queued_segments", "Segments waiting for an engine.", ("priority",))
+deduplicated_gauge = metrics.gauge("tortoise_jobs_deduplicated", "Requests attached to an identical in-flight job.")
+
+@app.get("/metrics")
+def metrics_api():
+    """Prometheus scrape endpoint."""
+    pools = {"synthesis": engine_pool}
+    if ttsConfig.TTS_STREAM_ENGINE_COUNT > 0:
+        pools["stream"] = stream_pool
+    for pool_name, pool in pools.items():
+        status = pool.status()
+        engines_gauge.set(status["engines_in_use"], pool=pool_name, state="in_use")
+        engines_gauge.set(status["engines_idle"], pool=pool_name, state="idle")
+    jobs = job_manager.status()
+    for job_status in ("queued", "running", "succeeded", "failed"):
+        jobs_gauge.set(jobs["jobs"].get(job_status, 0), status=job_status)
+    deduplicated_gauge.set(jobs["deduplicated"])
+    for priority, queued in segment_scheduler.status()["queued"].items():
+        queued_segments_gauge.set(queued, priority=priority)
+    return Response(content=metrics.render(), media_type=MetricsRegistry.CONTENT_TYPE)
+
+@app.get("/ready")
+def ready():
+    status = engine_pool.status()
+    if not engine_pool.ready:
+        raise HTTPException(status_code=503, detail=status)
+    return status
+
+# ------------------------------------------------------------------------------
+# API Endpoints: Asynchronous jobs
+# ------------------------------------------------------------------------------
+@app.post("/jobs", status_code=202)
+def submit_job_api(request: AudioRequest, x_api_key: Optional[str] = Header(None)):
+    """
+    Queue an audio generation job and return immediately.
+    Accepts the same body (and X-API-Key header) as /generate-audio.
+
+    Returns:
+    - job_id: Identifier to poll
+    - status: "queued"
+    - status_url / result_url: Where to poll for progress and the result
+    Responds 429 (with Retry-After) when the job queue is full.
+    """
+    job = submit_job(request, x_api_key)
+    return {
+        "job_id": job.id,
+        "status": job.status,
+        "status_url": f"/jobs/{job.id}",
+        "result_url": f"/jobs/{job.id}/result",
+    }
+
+def get_job_or_404(job_id):
+    job = job_manager.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail=f"Unknown job: {job_id}")
+    return job
+
+@app.get("/jobs/{job_id}")
+def job_status_api(job_id: str):
+    return get_job_or_404(job_id).to_dict()
+
+@app.get("/jobs/{job_id}/result")
+def job_result_api(job_id: str):
+    """
+    Returns 200 with the S3 URL once the job succeeded, 202 while it is still queued/running
+    and 500 with the error if it failed.
+    """
+    job = get_job_or_404(job_id)
+    if job.status == "succeeded":
+        return {"status": "success", "job_id": job.id, "s3_url": job.result["s3_url"]}
+    if job.status == "failed":
+        raise HTTPException(status_code=500, detail=job.error)
+    return JSONResponse(status_code=202, content=job.to_dict(), headers={"Retry-After": "2"})
 
 # ------------------------------------------------------------------------------
 # API Endpoint: Generate Audio
 # ------------------------------------------------------------------------------
 @app.post("/generate-audio")
-def generate_audio_api(request: AudioRequest):
+def generate_audio_api(request: AudioRequest, x_api_key: Optional[str] = Header(None)):
     """
     API endpoint to generate audio for a given text and upload it to S3.
     Request must include:
@@ -205,39 +527,106 @@ def generate_audio_api(request: AudioRequest):
     - type: "chapter" or "page"
     - number: Chapter/page number
     - voice: Voice name (optional, default = random)
+    - seed: Fixed seed (optional); identical seeded requests are served from the result cache
+    - format: Output format (optional): wav, pcm16, flac, opus or mp3
+    - priority: "interactive" or "batch" (optional); interactive segments take the next free engine
+
+    An X-API-Key header, if present, identifies the tenant for fair sharing of the engines (otherwise the bucket).
+
+    The request goes through the same job queue as /jobs and this call blocks until it finishes.
 
     Returns:
     - status: "success"
     - s3_url: Public URL of uploaded audio file
     """
-    
     try:
-        # Parse bucket and folder path
-        bucket, folder = parse_s3_path(request.s3_path)
-        audio_dir = folder + "/audios"
-
-        # Ensure the audios folder exists
-        ensure_audio_folder_exists(bucket, audio_dir)
-    
-        # Determine filename based on type
-        if request.type == "chapter":
-            audio_filename = f"chapter_{request.number}.wav"
-        elif request.type == "page":
-            audio_filename = f"page_{request.number}.wav"
-        else:
-            raise ValueError("Invalid type. Must be 'chapter' or 'page'.")
+        resolve_audio_target(request)
+    except ValueError as e:
+        logger.error(f"Process failed: {e}")
+        raise HTTPException(status_code=500, detail=str(e))
 
-        # Construct S3 key
-        s3_key = f"{audio_dir}/{audio_filename}".lstrip("/")
-        
-        logger.info(f"Generating audio for {request.type} {request.number} using voice: {request.voice}")
-        audio = generate_audio(request.text, request.voice)
+    job = submit_job(request, x_api_key)
+    job.wait()
+    if job.status == "failed":
+        if isinstance(job.exception, EngineUnavailable):
+            logger.error(f"No TTS engine available: {job.error}")
+            raise HTTPException(status_code=503, detail=job.error)
+        raise HTTPException(status_code=500, detail=job.error)
+    return {"status": "success", "s3_url": job.result["s3_url"]}
 
-        logger.info(f"Uploading to S3: {s3_key}")
-        s3_url = upload_audio_to_s3(audio, bucket, s3_key)
+# ------------------------------------------------------------------------------
+# API Endpoints: Live streaming
+# Audio is sent as it is generated. When the client disconnects the stream is
+# cancelled, which stops generation and frees the streaming engine.
+# ------------------------------------------------------------------------------
+async def open_audio_stream(request):
+    """Validate a StreamRequest and start producing its audio. Raises HTTPException 400 / 503."""
+    if ttsConfig.TTS_STREAM_ENGINE_COUNT <= 0:
+        raise HTTPException(status_code=503, detail="Streaming is disabled (TTS_STREAM_ENGINE_COUNT=0).")
+    audio_format = request.format or ttsConfig.TTS_STREAM_FORMAT
+    try:
+        get_format(audio_format)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    texts = split_text(request.text, ttsConfig.TTS_SEGMENT_DESIRED_LENGTH, ttsConfig.TTS_SEGMENT_MAX_LENGTH)
+    if not texts:
+        raise HTTPException(status_code=400, detail="No text to synthesize.")
+    voice_samples, _ = await run_in_threadpool(load_voice, request.voice)
+    seed = request.seed if request.seed is not None else ttsConfig.TTS_DEFAULT_SEED
+    audio_stream = AudioStream(
+        stream_pool,
+        texts,
+        audio_format=audio_format,
+        acquire_timeout=ttsConfig.TTS_STREAM_ACQUIRE_TIMEOUT,
+        voice_samples=voice_samples,
+        use_deterministic_seed=seed,
+        verbose=False,
+    )
+    audio_stream.start()
+    return audio_stream
 
-        return {"status": "success", "s3_url": s3_url}
-        
+@app.post("/stream")
+async def stream_audio_api(request: StreamRequest):
+    """
+    Stream speech for `text` as a chunked HTTP response in the requested format.
+    The response starts with the first generated chunk; 503 if no streaming engine is free.
+    """
+    audio_stream = await open_audio_stream(request)
+    try:
+        first = await audio_stream.next_chunk()
+    except EngineUnavailable as e:
+        raise HTTPException(status_code=503, detail=str(e))
     except Exception as e:
-        logger.error(f"Process failed: {e}")
         raise HTTPException(status_code=500, detail=str(e))
+    if first is None:
+        return Response(content=b"", media_type=audio_stream.content_type)
+    return StreamingResponse(audio_stream.iter_chunks(first), media_type=audio_stream.content_type)
+
+@app.websocket("/stream/ws")
+async def stream_audio_ws(websocket: WebSocket):
+    """
+    WebSocket variant of /stream. The client sends one JSON StreamRequest; the server answers with binary audio
+    frames followed by a JSON {"status": "done"} message, or {"status": "error", "detail": ...} on failure.
+    """
+    await websocket.accept()
+    audio_stream = None
+    try:
+        request = StreamRequest(**(await websocket.receive_json()))
+        audio_stream = await open_audio_stream(request)
+        async for chunk in audio_stream.iter_chunks():
+            await websocket.send_bytes(chunk)
+        await websocket.send_json({"status": "done", "chunks": audio_stream.chunks_sent})
+        await websocket.close()
+    except WebSocketDisconnect:
+        logger.info("Stream client disconnected")
+    except Exception as e:
+        detail = e.detail if isinstance(e, HTTPException) else str(e)
+        logger.error(f"Stream failed: {detail}")
+        try:
+            await websocket.send_json({"status": "error", "detail": detail})
+            await websocket.close(code=1013 if isinstance(e, EngineUnavailable) else 1011)
+        except Exception:
+            pass
+    finally:
+        if audio_stream is not None and not audio_stream.finished:
+            audio_stream.cancel()
@@ -0,0 +1,191 @@
+"""
+===============================================================================
+ Bounded asynchronous job queue for audio generation
+-------------------------------------------------------------------------------
+ Jobs are accepted into a bounded queue and executed by a fixed number of
+ worker threads. Submitting to a full queue raises QueueFull, which the API
+ turns into HTTP 429 so callers back off instead of piling up requests on the
+ TTS device.
+
+ Job lifecycle: "queued" -> "running" -> "succeeded" | "failed".
+
+ Jobs carry a priority (lower runs first, FIFO within a priority), so an
+ interactive request does not wait behind queued bulk renders.
+
+ Submissions may carry a dedupe key. While a job with that key is queued or
+ running, identical submissions attach to it (single-flight) instead of
+ queueing another synthesis, and every caller receives the same result.
+===============================================================================
+"""
+
+import itertools
+import logging
+import queue
+import threading
+import time
+import traceback
+import uuid
+
+logger = logging.getLogger("tortoise-api")
+
+
+class QueueFull(Exception):
+    """Raised when a job is submitted while the queue is at capacity."""
+
+
+class Job:
+    def __init__(self, payload, key=None, priority=0):
+        self.id = uuid.uuid4().hex
+        self.payload = payload
+        self.key = key
+        self.priority = priority
+        self.attached = 0  # Submissions coalesced into this job
+        self.progress = {}
+        self.status = "queued"
+        self.result = None
+        self.error = None
+        self.exception = None
+        self.created_at = time.time()
+        self.started_at = None
+        self.finished_at = None
+        self._done = threading.Event()
+
+    def update_progress(self, **fields):
+        self.progress = dict(self.progress, **fields)
+
+    @property
+    def done(self):
+        return self._done.is_set()
+
+    def wait(self, timeout=None):
+        """Block until the job finishes. Returns True if it finished within `timeout` seconds."""
+        return self._done.wait(timeout)
+
+    def to_dict(self):
+        return {
+            "job_id": self.id,
+            "status": self.status,
+            "priority": self.priority,
+            "created_at": self.created_at,
+            "started_at": self.started_at,
+            "finished_at": self.finished_at,
+            "error": self.error,
+            "attached": self.attached,
+            "progress": self.progress,
+        }
+
+
+class JobManager:
+    """
+    Runs `handler(payload, progress)` for every submitted job on a bounded pool of worker threads.
+
+    :param handler: Callable executed by the workers; its return value becomes Job.result. `progress` is
+                    Job.update_progress, through which the handler can publish fields shown by Job.to_dict().
+    :param workers: Number of worker threads. Normally equal to the number of resident TTS engines.
+    :param max_queued: Maximum number of jobs waiting to start. Further submissions raise QueueFull.
+    :param retention: Seconds a finished job stays queryable before it is forgotten.
+    """
+
+    def __init__(self, handler, workers=1, max_queued=32, retention=3600):
+        self.handler = handler
+        self.workers = workers
+        self.max_queued = max_queued
+        self.retention = retention
+        self._queue = queue.PriorityQueue(maxsize=max_queued)  # (priority, seq, job)
+        self._seq = itertools.count()
+        self._jobs = {}
+        self._inflight = {}  # dedupe key -> queued/running Job
+        self.deduplicated = 0
+        self._lock = threading.Lock()
+        self._threads = []
+
+    def start(self):
+        with self._lock:
+            if self._threads:
+                return
+            for i in range(self.workers):
+                t = threading.Thread(target=self._work, name=f"tts-job-worker-{i}", daemon=True)
+                t.start()
+                self._threads.append(t)
+
+    def stop(self):
+        """Ask the workers to exit once they have drained the queue."""
+        for _ in self._threads:
+            self._queue.put((float("inf"), next(self._seq), None))
+        for t in self._threads:
+            t.join()
+        self._threads = []
+
+    # --------------------------------------------------------------------------
+    # Submission / lookup
+    # --------------------------------------------------------------------------
+    def submit(self, payload, key=None, priority=0):
+        """
+        Queue `payload`, or attach to the in-flight job with the same `key`. Lower `priority` values start first.
+        Returns (job, attached) where attached is True if no new work was queued.
+        """
+        with self._lock:
+            if key is not None:
+                existing = self._inflight.get(key)
+                if existing is not None:
+                    existing.attached += 1
+                    self.deduplicated += 1
+                    return existing, True
+            job = Job(payload, key, priority)
+            try:
+                self._queue.put_nowait((priority, next(self._seq), job))
+            except queue.Full:
+                raise QueueFull(f"Job queue is full ({self.max_queued} jobs waiting).")
+            self._prune()
+            self._jobs[job.id] = job
+            if key is not None:
+                self._inflight[key] = job
+        return job, False
+
+    def get(self, job_id):
+        with self._lock:
+            return self._jobs.get(job_id)
+
+    def queue_depth(self):
+        return self._queue.qsize()
+
+    def status(self):
+        with self._lock:
+            counts = {}
+            for job in self._jobs.values():
+                counts[job.status] = counts.get(job.status, 0) + 1
+            deduplicated = self.deduplicated
+        return {"workers": self.workers, "max_queued": self.max_queued, "queue_depth": self.queue_depth(),
+                "jobs": counts, "deduplicated": deduplicated}
+
+    def _prune(self):
+        cutoff = time.time() - self.retention
+        expired = [jid for jid, j in self._jobs.items() if j.finished_at is not None and j.finished_at < cutoff]
+        for jid in expired:
+            del self._jobs[jid]
+
+    # --------------------------------------------------------------------------
+    # Workers
+    # --------------------------------------------------------------------------
+    def _work(self):
+        while True:
+            _, _, job = self._queue.get()
+            if job is None:
+                return
+            job.status = "running"
+            job.started_at = time.time()
+            try:
+                job.result = self.handler(job.payload, job.update_progress)
+                job.status = "succeeded"
+            except Exception as e:
+                logger.error(f"Job {job.id} failed: {e}")
+                logger.error(traceback.format_exc())
+                job.error = str(e)
+                job.exception = e
+                job.status = "failed"
+            finally:
+                with self._lock:
+                    if job.key is not None and self._inflight.get(job.key) is job:
+                        del self._inflight[job.key]
+                job.finished_at = time.time()
+                job._done.set()
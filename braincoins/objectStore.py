@@ -0,0 +1,265 @@
+"""
+===============================================================================
+ Object storage backends for generated audio
+-------------------------------------------------------------------------------
+ S3ObjectStore talks to S3 / Lightsail Object Storage through boto3.
+ InMemoryObjectStore keeps objects in a dict; it is meant for local runs and
+ for exercising the API without any cloud credentials.
+
+ Both expose the same small interface:
+ - ensure_folder(bucket, prefix)
+ - put_object(bucket, key, body, content_type, acl) -> public URL
+ - upload_stream(bucket, key, chunks, content_type, finalize_head, acl)
+   -> public URL; uploads while `chunks` is still being produced
+ - get_object(bucket, key) -> bytes or None
+ - public_url(bucket, key) -> URL string
+
+ ObjectStoreCacheTier adapts either store into the shared tier of
+ tortoise.utils.result_cache.SynthesisCache.
+===============================================================================
+"""
+
+import logging
+import threading
+import traceback
+
+logger = logging.getLogger("tortoise-api")
+
+
+# ------------------------------------------------------------------------------
+# Streaming upload helpers
+# ------------------------------------------------------------------------------
+# S3 requires every multipart part except the last to be at least 5 MiB.
+MIN_PART_SIZE = 5 * 1024 * 1024
+
+
+def iter_parts(chunks, part_size):
+    """Regroup an iterable of byte strings into parts of `part_size` bytes (the last one may be shorter)."""
+    buffer = bytearray()
+    for chunk in chunks:
+        buffer += chunk
+        while len(buffer) >= part_size:
+            yield bytes(buffer[:part_size])
+            del buffer[:part_size]
+    if buffer:
+        yield bytes(buffer)
+
+
+# ------------------------------------------------------------------------------
+# S3 / Lightsail Object Storage
+# ------------------------------------------------------------------------------
+class S3ObjectStore:
+    """
+    One boto3 client is created lazily and shared by every thread (boto3 clients are thread-safe; its urllib3 pool
+    is sized by S3_MAX_POOL_CONNECTIONS). Folder checks are memoized per process, since folders are never deleted
+    by this service.
+    """
+
+    def __init__(self, config):
+        self.config = config
+        self.part_size = max(MIN_PART_SIZE, int(getattr(config, "S3_MULTIPART_PART_SIZE", MIN_PART_SIZE)))
+        self._s3 = None
+        self._lock = threading.Lock()
+        self._known_folders = set()
+
+    def _client(self):
+        if self._s3 is None:
+            with self._lock:
+                if self._s3 is None:
+                    import boto3
+                    from botocore.config import Config
+                    self._s3 = boto3.client(
+                        "s3",
+                        region_name=self.config.S3_REGION,
+                        aws_access_key_id=self.config.AWS_ACCESS_KEY_ID,
+                        aws_secret_access_key=self.config.AWS_SECRET_ACCESS_KEY,
+                        config=Config(max_pool_connections=int(getattr(self.config, "S3_MAX_POOL_CONNECTIONS", 10)))
+                    )
+        return self._s3
+
+    def public_url(self, bucket, key):
+        if getattr(self.config, "S3_ENDPOINT_URL", None):
+            base_url = self.config.S3_ENDPOINT_URL.rstrip("/")
+            return f"{base_url}/{key}"
+        return f"https://{bucket}.s3.{self.config.S3_REGION}.amazonaws.com/{key}"
+
+    def ensure_folder(self, bucket, prefix):
+        """
+        Ensure that the given folder path exists in S3.
+        If it doesn’t exist, create it by uploading a placeholder file (.keep).
+        """
+        from botocore.exceptions import ClientError
+
+        # Folder we want
+        audios_prefix = f"{prefix.rstrip('/')}"
+        if (bucket, audios_prefix) in self._known_folders:
+            return
+        s3 = self._client()
+
+        try:
+            # Check if the folder exists
+            try:
+                response = s3.list_objects_v2(
+                    Bucket=bucket,
+                    Prefix=audios_prefix,
+                    MaxKeys=1
+                )
+                exists = 'Contents' in response
+            except ClientError as e:
+                if e.response['Error']['Code'] == 'NoSuchKey':
+                    exists = False
+                    logger.info(f"{prefix} doesn't exist")
+                else:
+                    raise
+
+            # Create folder if it does not exist
+            if not exists:
+                # Folder doesn't exist — create it by putting an empty key
+                dummy_key = audios_prefix + "/.keep"
+                s3.put_object(Bucket=bucket, Key=dummy_key, Body=b'', ACL='public-read')
+                logger.info(f"Created folder: {audios_prefix}")
+            else:
+                logger.info(f"Folder already exists: {audios_prefix}")
+            self._known_folders.add((bucket, audios_prefix))
+
+        except Exception:
+            logger.error("Exception while checking/creating folder:")
+            logger.error(traceback.format_exc())
+            raise
+
+    def put_object(self, bucket, key, body, content_type, acl="public-read"):
+        key = key.lstrip("/")
+        logger.info(f"Uploading to S3 -> Bucket: {bucket}, Key: {key}")
+        extra = {"ACL": acl} if acl else {}
+        self._client().put_object(
+            Bucket=bucket,
+            Key=key,
+            Body=body,
+            ContentType=content_type,
+            **extra
+        )
+        return self.public_url(bucket, key)
+
+    def upload_stream(self, bucket, key, chunks, content_type, finalize_head=None, acl="public-read"):
+        """
+        Upload an object whose bytes are produced incrementally, sending each part as soon as it fills.
+
+        :param chunks: Iterable of byte strings; consumed lazily, so upload overlaps with producing them.
+        :param finalize_head: Optional callable(first_part, total_bytes) -> first_part, applied once the stream is
+                              exhausted. Lets formats with size fields in their header (WAV) patch them: part 1 is
+                              held back and uploaded last, which S3 allows since parts are ordered by number.
+        Objects smaller than one part are sent with a single put_object. A failed upload is aborted.
+        """
+        key = key.lstrip("/")
+        parts = iter_parts(chunks, self.part_size)
+        head = next(parts, b"")
+        second = next(parts, None)
+        if second is None:
+            if finalize_head is not None:
+                head = finalize_head(head, len(head))
+            return self.put_object(bucket, key, head, content_type, acl=acl)
+
+        s3 = self._client()
+        logger.info(f"Multipart upload to S3 -> Bucket: {bucket}, Key: {key}")
+        extra = {"ACL": acl} if acl else {}
+        upload_id = s3.create_multipart_upload(Bucket=bucket, Key=key, ContentType=content_type, **extra)["UploadId"]
+        try:
+            completed = []
+            total = len(head)
+            part_number = 2
+            pending = second
+            for part in parts:
+                # Send the previous part only once a later one exists, so the final (short) part is known.
+                etag = s3.upload_part(Bucket=bucket, Key=key, UploadId=upload_id, PartNumber=part_number, Body=pending)["ETag"]
+                completed.append({"PartNumber": part_number, "ETag": etag})
+                total += len(pending)
+                part_number += 1
+                pending = part
+            etag = s3.upload_part(Bucket=bucket, Key=key, UploadId=upload_id, PartNumber=part_number, Body=pending)["ETag"]
+            completed.append({"PartNumber": part_number, "ETag": etag})
+            total += len(pending)
+
+            if finalize_head is not None:
+                head = finalize_head(head, total)
+            etag = s3.upload_part(Bucket=bucket, Key=key, UploadId=upload_id, PartNumber=1, Body=head)["ETag"]
+            completed.insert(0, {"PartNumber": 1, "ETag": etag})
+            s3.complete_multipart_upload(Bucket=bucket, Key=key, UploadId=upload_id, MultipartUpload={"Parts": completed})
+        except Exception:
+            logger.error(f"Multipart upload of {key} failed, aborting")
+            s3.abort_multipart_upload(Bucket=bucket, Key=key, UploadId=upload_id)
+            raise
+        logger.info(f"Multipart upload complete: {key} ({part_number} parts, {total} bytes)")
+        return self.public_url(bucket, key)
+
+    def get_object(self, bucket, key):
+        from botocore.exceptions import ClientError
+        try:
+            response = self._client().get_object(Bucket=bucket, Key=key.lstrip("/"))
+        except ClientError as e:
+            if e.response['Error']['Code'] in ('NoSuchKey', '404'):
+                return None
+            raise
+        return response['Body'].read()
+
+
+# ------------------------------------------------------------------------------
+# In-process store (local development / tests)
+# ------------------------------------------------------------------------------
+class InMemoryObjectStore:
+    def __init__(self):
+        self.objects = {}  # (bucket, key) -> (bytes, content_type)
+        self._lock = threading.Lock()
+
+    def public_url(self, bucket, key):
+        return f"memory://{bucket}/{key}"
+
+    def ensure_folder(self, bucket, prefix):
+        # Folders are implicit in a key/value store.
+        pass
+
+    def put_object(self, bucket, key, body, content_type, acl="public-read"):
+        key = key.lstrip("/")
+        data = body.read() if hasattr(body, "read") else bytes(body)
+        with self._lock:
+            self.objects[(bucket, key)] = (data, content_type)
+        return self.public_url(bucket, key)
+
+    def upload_stream(self, bucket, key, chunks, content_type, finalize_head=None, acl="public-read"):
+        data = b"".join(chunks)
+        if finalize_head is not None:
+            head = finalize_head(data[:MIN_PART_SIZE], len(data))
+            data = head + data[MIN_PART_SIZE:]
+        return self.put_object(bucket, key, data, content_type, acl=acl)
+
+    def get_object(self, bucket, key):
+        with self._lock:
+            entry = self.objects.get((bucket, key.lstrip("/")))
+        return None if entry is None else entry[0]
+
+
+# ------------------------------------------------------------------------------
+# Shared tier for the synthesis result cache
+# ------------------------------------------------------------------------------
+class ObjectStoreCacheTier:
+    """Stores cache entries as private objects under `bucket/prefix`. Failures are logged and treated as misses."""
+
+    def __init__(self, store, bucket, prefix="tts-cache"):
+        self.store = store
+        self.bucket = bucket
+        self.prefix = prefix.strip("/")
+
+    def _key(self, key):
+        return f"{self.prefix}/{key[:2]}/{key}.pt"
+
+    def get(self, key):
+        try:
+            return self.store.get_object(self.bucket, self._key(key))
+        except Exception as e:
+            logger.warning(f"Result cache lookup failed for {key}: {e}")
+            return None
+
+    def put(self, key, data):
+        try:
+            self.store.put_object(self.bucket, self._key(key), data, "application/octet-stream", acl=None)
+        except Exception as e:
+            logger.warning(f"Result cache upload failed for {key}: {e}")
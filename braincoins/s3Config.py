@@ -11,3 +11,7 @@ S3_REGION = os.getenv("S3_REGION")
 S3_ENDPOINT_URL = os.getenv("S3_ENDPOINT_URL")
 S3_ACL = os.getenv("S3_ACL")
 
+# Size of the shared boto3 connection pool (should cover concurrent job workers + uploads)
+S3_MAX_POOL_CONNECTIONS = int(os.getenv("S3_MAX_POOL_CONNECTIONS", "10"))
+# Part size for streaming multipart uploads (S3 minimum is 5 MiB)
+S3_MULTIPART_PART_SIZE = int(os.getenv("S3_MULTIPART_PART_SIZE", str(5 * 1024 * 1024)))
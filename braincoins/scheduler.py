@@ -0,0 +1,171 @@
+"""
+===============================================================================
+ Segment scheduler: priority classes + weighted fair share across tenants
+-------------------------------------------------------------------------------
+ Every synthesized text segment is a task on this scheduler. It runs one
+ worker per engine and, each time a worker frees up, picks the next task by:
+
+ 1. Priority class: any queued "interactive" task runs before any "batch"
+    task. Since a chapter is split into many segments, an interactive request
+    arriving mid-chapter takes the next free engine, i.e. batch work is
+    preempted at segment boundaries.
+ 2. Tenant (S3 bucket or API key): within a class, tenants with queued tasks
+    are served by smooth weighted round robin (the nginx upstream algorithm),
+    so a tenant with weight 3 gets three segments for every one of a tenant
+    with weight 1, interleaved rather than in bursts.
+ 3. Submission order within a tenant.
+===============================================================================
+"""
+
+import logging
+import threading
+import traceback
+from collections import OrderedDict, deque
+from concurrent.futures import Future
+
+logger = logging.getLogger("tortoise-api")
+
+# Highest priority first.
+PRIORITY_CLASSES = ("interactive", "batch")
+
+
+def parse_weights(spec):
+    """Parses "tenantA=3,tenantB=1" into a dict."""
+    weights = {}
+    for item in (spec or "").split(","):
+        if not item.strip():
+            continue
+        tenant, _, weight = item.rpartition("=")
+        weights[tenant.strip()] = int(weight)
+    return weights
+
+
+class FairScheduler:
+    """
+    :param workers: Number of tasks that may run at once (normally the number of engines).
+    :param weights: Dict of tenant -> integer weight. Unlisted tenants get `default_weight`.
+    """
+
+    def __init__(self, workers=1, weights=None, default_weight=1):
+        self.workers = workers
+        self.weights = dict(weights or {})
+        self.default_weight = default_weight
+        # priority -> tenant -> deque of (future, fn, args, kwargs)
+        self._pending = {p: OrderedDict() for p in PRIORITY_CLASSES}
+        # priority -> tenant -> current weight (smooth WRR state); tenants are dropped once their queue empties.
+        self._current = {p: {} for p in PRIORITY_CLASSES}
+        self._running = {p: 0 for p in PRIORITY_CLASSES}
+        self._served = {}
+        self._cond = threading.Condition()
+        self._threads = []
+        self._stopping = False
+
+    def start(self):
+        with self._cond:
+            if self._threads:
+                return
+            for i in range(self.workers):
+                t = threading.Thread(target=self._work, name=f"tts-segment-{i}", daemon=True)
+                t.start()
+                self._threads.append(t)
+
+    def shutdown(self):
+        with self._cond:
+            self._stopping = True
+            self._cond.notify_all()
+        for t in self._threads:
+            t.join()
+        self._threads = []
+
+    def weight(self, tenant):
+        return self.weights.get(tenant, self.default_weight)
+
+    # --------------------------------------------------------------------------
+    # Submission
+    # --------------------------------------------------------------------------
+    def submit(self, fn, *args, priority="batch", tenant="default", **kwargs):
+        """Queue fn(*args, **kwargs); returns a concurrent.futures.Future. Cancelled futures are skipped."""
+        if priority not in self._pending:
+            raise ValueError(f"Unknown priority class: {priority}. Options: {', '.join(PRIORITY_CLASSES)}")
+        future = Future()
+        with self._cond:
+            queue = self._pending[priority].get(tenant)
+            if queue is None:
+                queue = self._pending[priority][tenant] = deque()
+                self._current[priority][tenant] = 0
+            queue.append((future, fn, args, kwargs))
+            self._cond.notify()
+        return future
+
+    def bind(self, priority="batch", tenant="default"):
+        """An executor-like view whose submit(fn, *args) queues under the given priority class and tenant."""
+        return _BoundScheduler(self, priority, tenant)
+
+    def _next_task(self):
+        """Pick the next task; caller holds the lock. Returns (priority, tenant, task) or None."""
+        for priority in PRIORITY_CLASSES:
+            tenants = self._pending[priority]
+            if not tenants:
+                continue
+            current = self._current[priority]
+            total = 0
+            best = None
+            for tenant in tenants:
+                w = self.weight(tenant)
+                current[tenant] += w
+                total += w
+                if best is None or current[tenant] > current[best]:
+                    best = tenant
+            current[best] -= total
+            queue = tenants[best]
+            task = queue.popleft()
+            if not queue:
+                del tenants[best]
+                del current[best]
+            return priority, best, task
+        return None
+
+    # --------------------------------------------------------------------------
+    # Workers
+    # --------------------------------------------------------------------------
+    def _work(self):
+        while True:
+            with self._cond:
+                picked = self._next_task()
+                while picked is None:
+                    if self._stopping:
+                        return
+                    self._cond.wait()
+                    picked = self._next_task()
+                priority, tenant, (future, fn, args, kwargs) = picked
+                if not future.set_running_or_notify_cancel():
+                    continue
+                self._running[priority] += 1
+                self._served[tenant] = self._served.get(tenant, 0) + 1
+            try:
+                future.set_result(fn(*args, **kwargs))
+            except BaseException as e:
+                logger.debug(traceback.format_exc())
+                future.set_exception(e)
+            finally:
+                with self._cond:
+                    self._running[priority] -= 1
+
+    def status(self):
+        with self._cond:
+            return {
+                "workers": self.workers,
+                "queued": {p: sum(len(q) for q in self._pending[p].values()) for p in PRIORITY_CLASSES},
+                "running": dict(self._running),
+                "segments_served": dict(self._served),
+            }
+
+
+class _BoundScheduler:
+    def __init__(self, scheduler, priority, tenant):
+        self.scheduler = scheduler
+        self.priority = priority
+        self.tenant = tenant
+
+    def submit(self, fn, *args, **kwargs):
+        return self.scheduler.submit(fn, *args, priority=self.priority, tenant=self.tenant, **kwargs)
@@ -0,0 +1,118 @@
+"""
+===============================================================================
+ Long-text synthesis: split, schedule segments in parallel, stitch in order
+-------------------------------------------------------------------------------
+ TextToSpeech.tts only accepts ~400 tokens, so chapter text is split with
+ tortoise.utils.text.split_and_recombine_text (or on '|' if the caller marked
+ split points, like tortoise/read.py). Every segment becomes a task on a
+ shared scheduler (scheduler.py) with one slot per engine, so segments of one
+ chapter run concurrently on all free engines.
+
+ synthesize_segments() yields the stitched audio in text order as soon as
+ each segment and all segments before it are finished, which lets the upload
+ start while later segments are still being generated.
+===============================================================================
+"""
+
+import logging
+import threading
+
+import torch
+from tortoise.utils.text import split_and_recombine_text
+
+logger = logging.getLogger("tortoise-api")
+
+
+def split_text(text, desired_length=200, max_length=300):
+    if '|' in text:
+        texts = text.split('|')
+    else:
+        texts = split_and_recombine_text(text, desired_length, max_length)
+    return [t.strip() for t in texts if t.strip()]
+
+
+# ------------------------------------------------------------------------------
+# Stitching
+# ------------------------------------------------------------------------------
+class SegmentStitcher:
+    """
+    Joins mono segments incrementally. With crossfade_ms > 0 the end of each segment is blended linearly into the
+    start of the next (the tail is held back until the next segment arrives); otherwise silence_ms of silence is
+    inserted between segments.
+    """
+
+    def __init__(self, sample_rate=24000, silence_ms=0, crossfade_ms=0):
+        self.silence = int(sample_rate * silence_ms / 1000)
+        self.crossfade = int(sample_rate * crossfade_ms / 1000)
+        self._tail = None
+
+    def add(self, wav):
+        """Add the next segment; returns the list of tensors that are now final."""
+        wav = wav.reshape(-1).float().cpu()
+        out = []
+        if self._tail is None:
+            rest = wav
+        elif self.crossfade > 0:
+            c = min(self._tail.shape[0], wav.shape[0])
+            fade = torch.linspace(0, 1, c)
+            out.append(self._tail[:self._tail.shape[0] - c])
+            out.append(self._tail[-c:] * (1 - fade) + wav[:c] * fade)
+            rest = wav[c:]
+        else:
+            out.append(self._tail)
+            if self.silence > 0:
+                out.append(torch.zeros(self.silence))
+            rest = wav
+        hold = min(self.crossfade, rest.shape[0]) if self.crossfade > 0 else 0
+        out.append(rest[:rest.shape[0] - hold])
+        self._tail = rest[rest.shape[0] - hold:] if self.crossfade > 0 else torch.zeros(0)
+        return [o for o in out if o.numel() > 0]
+
+    def finish(self):
+        tail, self._tail = self._tail, None
+        return [tail] if tail is not None and tail.numel() > 0 else []
+
+
+# ------------------------------------------------------------------------------
+# Scheduling
+# ------------------------------------------------------------------------------
+def synthesize_segments(texts, synthesize, executor, stitcher, progress=None):
+    """
+    Run synthesize(text) for every segment on `executor` and yield stitched audio tensors in text order.
+
+    :param synthesize: Callable(text) -> audio tensor; expected to check out its own engine.
+    :param progress: Optional callable(**fields) receiving segments_total, segments_done and per-segment states.
+    """
+    states = ["queued"] * len(texts)
+    lock = threading.Lock()
+
+    def report():
+        if progress is not None:
+            with lock:
+                progress(segments_total=len(texts), segments_done=states.count("done"), segments=list(states))
+
+    def run(i):
+        with lock:
+            states[i] = "running"
+        report()
+        wav = synthesize(texts[i])
+        with lock:
+            states[i] = "done"
+        report()
+        return wav
+
+    report()
+    futures = [executor.submit(run, i) for i in range(len(texts))]
+    try:
+        for i, future in enumerate(futures):
+            wav = future.result()
+            logger.info(f"Segment {i + 1}/{len(texts)} ready ({wav.shape[-1]} samples)")
+            futures[i] = None  # release the audio once it has been handed on
+            for chunk in stitcher.add(wav):
+                yield chunk
+        for chunk in stitcher.finish():
+            yield chunk
+    finally:
+        for future in futures:
+            if future is not None:
+                future.cancel()
@@ -0,0 +1,106 @@
+"""
+===============================================================================
+ Engine pool and back-pressure tests (no checkpoints needed)
+-------------------------------------------------------------------------------
+ Runs against StubEngine and the API's stub mode:
+
+   python -m unittest braincoins/test_enginePool.py
+===============================================================================
+"""
+
+import os
+import sys
+import threading
+import unittest
+
+# The API reads its configuration at import time.
+os.environ.update(TTS_ENGINE="stub", TTS_OBJECT_STORE="memory", TTS_RESULT_CACHE_DIR="", TTS_WARMUP="0",
+                  TTS_STREAM_ENGINE_COUNT="0", TTS_MAX_QUEUED_JOBS="1")
+sys.path[:0] = [os.path.dirname(os.path.abspath(__file__)), os.path.dirname(os.path.dirname(os.path.abspath(__file__)))]
+
+from enginePool import EnginePool, EngineUnavailable, StubEngine
+
+
+class EnginePoolTest(unittest.TestCase):
+    def make_pool(self, **kwargs):
+        pool = EnginePool(StubEngine, **kwargs)
+        pool.start(background=False)
+        return pool
+
+    def test_acquire_release(self):
+        pool = self.make_pool(size=2)
+        self.assertTrue(pool.ready)
+        with pool.acquire(timeout=1) as first, pool.acquire(timeout=1) as second:
+            self.assertIsNot(first, second)
+            self.assertEqual(pool.status()["engines_in_use"], 2)
+            self.assertEqual(first.tts("Hello.").shape[:2], (1, 1))
+        status = pool.status()
+        self.assertEqual(status["engines_in_use"], 0)
+        self.assertEqual(status["engines_idle"], 2)
+
+    def test_exhaustion(self):
+        pool = self.make_pool(size=1)
+        with pool.acquire(timeout=1):
+            with self.assertRaises(EngineUnavailable):
+                with pool.acquire(timeout=0.05):
+                    pass
+        # The engine is back once the holder is done.
+        with pool.acquire(timeout=1) as engine:
+            self.assertIsInstance(engine, StubEngine)
+
+    def test_slots_per_engine(self):
+        pool = self.make_pool(size=1, slots_per_engine=2)
+        with pool.acquire(timeout=1) as first, pool.acquire(timeout=1) as second:
+            self.assertIs(first, second)
+            with self.assertRaises(EngineUnavailable):
+                with pool.acquire(timeout=0.05):
+                    pass
+
+    def test_unstarted_and_failed(self):
+        with self.assertRaises(EngineUnavailable):
+            with EnginePool(StubEngine).acquire(timeout=0.05):
+                pass
+
+        def broken():
+            raise RuntimeError("no checkpoints")
+
+        pool = EnginePool(broken)
+        pool.start(background=False)
+        self.assertEqual(pool.state, "failed")
+        with self.assertRaisesRegex(EngineUnavailable, "no checkpoints"):
+            with pool.acquire(timeout=0.05):
+                pass
+
+    def test_waiter_gets_released_engine(self):
+        pool = self.make_pool(size=1)
+        got = []
+
+        def wait_for_engine():
+            with pool.acquire(timeout=5) as engine:
+                got.append(engine)
+
+        with pool.acquire(timeout=1) as engine:
+            waiter = threading.Thread(target=wait_for_engine)
+            waiter.start()
+        waiter.join(5)
+        self.assertEqual(got, [engine])
+
+
+class QueueFullTest(unittest.TestCase):
+    def test_full_queue_answers_429(self):
+        from fastapi.testclient import TestClient
+        import generateAudioForStorybookApi as api
+
+        # Without the startup event no job worker runs, so the single queue slot stays taken.
+        client = TestClient(api.app)
+        body = {"s3_path": "s3://bucket/book", "text": "Hello.", "type": "page", "number": 1}
+        self.assertEqual(client.post("/jobs", json=body).status_code, 202)
+        # An identical request attaches to the queued job instead of taking a slot.
+        self.assertEqual(client.post("/jobs", json=body).status_code, 202)
+        response = client.post("/jobs", json=dict(body, number=2))
+        self.assertEqual(response.status_code, 429)
+        self.assertEqual(response.headers["Retry-After"], "5")
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,179 @@
+"""
+===============================================================================
+ S3ObjectStore upload tests against an in-process fake S3 client
+-------------------------------------------------------------------------------
+ The fake records every call and rebuilds completed multipart uploads the way
+ S3 does (parts ordered by number), so the streaming upload path can be
+ checked without credentials:
+
+   python -m unittest braincoins/test_objectStore.py
+===============================================================================
+"""
+
+import io
+import os
+import sys
+import unittest
+import uuid
+from types import SimpleNamespace
+
+sys.path[:0] = [os.path.dirname(os.path.abspath(__file__)), os.path.dirname(os.path.dirname(os.path.abspath(__file__)))]
+
+import numpy as np
+import soundfile as sf
+
+from objectStore import S3ObjectStore
+from tortoise.utils.audio_encoders import AudioEncoder, encode_audio, iter_encoded
+
+
+class FakeS3:
+    def __init__(self, existing_keys=()):
+        self.calls = []
+        self.objects = {key: b"" for key in existing_keys}  # (bucket, key) -> bytes
+        self.uploads = {}  # upload id -> {part number: bytes}
+        self.aborted = []
+
+    def list_objects_v2(self, Bucket, Prefix, MaxKeys):
+        self.calls.append(("list_objects_v2", Prefix))
+        keys = [key for (bucket, key) in self.objects if bucket == Bucket and key.startswith(Prefix)]
+        return {"Contents": [{"Key": k} for k in keys[:MaxKeys]]} if keys else {}
+
+    def put_object(self, Bucket, Key, Body, **kwargs):
+        self.calls.append(("put_object", Key))
+        self.objects[(Bucket, Key)] = bytes(Body)
+
+    def create_multipart_upload(self, Bucket, Key, **kwargs):
+        upload_id = uuid.uuid4().hex
+        self.calls.append(("create_multipart_upload", Key))
+        self.uploads[upload_id] = {}
+        return {"UploadId": upload_id}
+
+    def upload_part(self, Bucket, Key, UploadId, PartNumber, Body):
+        self.calls.append(("upload_part", PartNumber))
+        self.uploads[UploadId][PartNumber] = bytes(Body)
+        return {"ETag": f"etag-{PartNumber}"}
+
+    def complete_multipart_upload(self, Bucket, Key, UploadId, MultipartUpload):
+        self.calls.append(("complete_multipart_upload", Key))
+        parts = MultipartUpload["Parts"]
+        numbers = [p["PartNumber"] for p in parts]
+        assert numbers == sorted(numbers), "S3 rejects parts that are not in ascending order"
+        for p in parts:
+            assert p["ETag"] == f"etag-{p['PartNumber']}"
+        uploaded = self.uploads.pop(UploadId)
+        self.objects[(Bucket, Key)] = b"".join(uploaded[n] for n in numbers)
+
+    def abort_multipart_upload(self, Bucket, Key, UploadId):
+        self.calls.append(("abort_multipart_upload", Key))
+        self.aborted.append(UploadId)
+        self.uploads.pop(UploadId)
+
+    def called(self, name):
+        return [c for c in self.calls if c[0] == name]
+
+
+def make_store(client, part_size=4096):
+    config = SimpleNamespace(S3_REGION="us-east-1", AWS_ACCESS_KEY_ID="", AWS_SECRET_ACCESS_KEY="")
+    store = S3ObjectStore(config)
+    store.part_size = part_size  # Below S3's 5 MiB minimum, which the fake does not enforce.
+    store._s3 = client
+    return store
+
+
+def tone(seconds, sample_rate=24000):
+    t = np.arange(int(seconds * sample_rate), dtype=np.float32) / sample_rate
+    return (0.1 * np.sin(2 * np.pi * 220 * t)).astype(np.float32)
+
+
+class UploadStreamTest(unittest.TestCase):
+    def upload_wav(self, client, wav, part_size=4096):
+        store = make_store(client, part_size)
+        encoder = AudioEncoder("pcm16")
+        chunks = iter_encoded(np.array_split(wav, 7), encoder)
+        url = store.upload_stream("bucket", "/book/audios/page_1.wav", chunks, encoder.content_type,
+                                  finalize_head=lambda head, total: encoder.patch_head(head))
+        self.assertEqual(url, "https://bucket.s3.us-east-1.amazonaws.com/book/audios/page_1.wav")
+        return client.objects[("bucket", "book/audios/page_1.wav")]
+
+    def test_multipart_reassembles_and_patches_header(self):
+        client = FakeS3()
+        wav = tone(1.0)
+        data = self.upload_wav(client, wav)
+
+        self.assertEqual(data, encode_audio(wav, "pcm16"))
+        self.assertEqual(int.from_bytes(data[4:8], "little"), len(data) - 8)
+        decoded, sample_rate = sf.read(io.BytesIO(data), dtype="float32")
+        self.assertEqual(sample_rate, 24000)
+        self.assertEqual(len(decoded), len(wav))
+
+        parts = [c[1] for c in client.called("upload_part")]
+        self.assertGreater(len(parts), 2)
+        # Part 1 (the header) is held back and sent last.
+        self.assertEqual(parts, list(range(2, len(parts) + 1)) + [1])
+        self.assertEqual(len(client.called("complete_multipart_upload")), 1)
+        self.assertEqual(client.called("put_object"), [])
+        self.assertEqual(client.uploads, {})
+
+    def test_exactly_two_parts(self):
+        client = FakeS3()
+        store = make_store(client, part_size=4)
+        seen = []
+
+        def finalize(head, total):
+            seen.append((head, total))
+            return b"HEAD"
+
+        store.upload_stream("bucket", "k", [b"abcdef", b"gh"], "application/octet-stream", finalize_head=finalize)
+        self.assertEqual(seen, [(b"abcd", 8)])
+        self.assertEqual(client.objects[("bucket", "k")], b"HEADefgh")
+        self.assertEqual([c[1] for c in client.called("upload_part")], [2, 1])
+
+    def test_small_object_uses_put_object(self):
+        client = FakeS3()
+        wav = tone(0.05)
+        data = self.upload_wav(client, wav, part_size=1024 * 1024)
+
+        self.assertEqual(data, encode_audio(wav, "pcm16"))
+        self.assertEqual(len(client.called("put_object")), 1)
+        self.assertEqual(client.called("create_multipart_upload"), [])
+        self.assertEqual(client.called("upload_part"), [])
+
+    def test_failure_mid_stream_aborts(self):
+        client = FakeS3()
+        store = make_store(client, part_size=4)
+
+        def chunks():
+            yield b"0123456789abcdef"
+            raise RuntimeError("synthesis failed")
+
+        with self.assertRaisesRegex(RuntimeError, "synthesis failed"):
+            store.upload_stream("bucket", "k", chunks(), "application/octet-stream")
+        self.assertEqual(len(client.aborted), 1)
+        self.assertEqual(client.called("complete_multipart_upload"), [])
+        self.assertNotIn(("bucket", "k"), client.objects)
+        self.assertEqual(client.uploads, {})
+
+
+class EnsureFolderTest(unittest.TestCase):
+    def test_creates_missing_folder_once(self):
+        client = FakeS3()
+        store = make_store(client)
+        for _ in range(3):
+            store.ensure_folder("bucket", "book/audios/")
+        self.assertEqual(len(client.called("list_objects_v2")), 1)
+        self.assertEqual(client.called("put_object"), [("put_object", "book/audios/.keep")])
+
+    def test_existing_folder_is_not_recreated(self):
+        client = FakeS3(existing_keys=[("bucket", "book/audios/page_1.wav")])
+        store = make_store(client)
+        store.ensure_folder("bucket", "book/audios")
+        store.ensure_folder("bucket", "book/audios")
+        self.assertEqual(len(client.called("list_objects_v2")), 1)
+        self.assertEqual(client.called("put_object"), [])
+        # Other folders are still checked.
+        store.ensure_folder("bucket", "book/other")
+        self.assertEqual(len(client.called("list_objects_v2")), 2)
+
+
+if __name__ == "__main__":
+    unittest.main()
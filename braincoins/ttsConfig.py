@@ -0,0 +1,92 @@
+from dotenv import load_dotenv
+import os
+
+# Load variables from .env file
+load_dotenv(dotenv_path=os.path.join(os.path.dirname(__file__), ".env"))  # Explicit load
+
+
+def _get_bool(name, default):
+    value = os.getenv(name)
+    if value is None or value == "":
+        return default
+    return value.strip().lower() in ("1", "true", "yes", "on")
+
+
+# Number of resident TextToSpeech engines kept warm by the API process.
+TTS_ENGINE_COUNT = int(os.getenv("TTS_ENGINE_COUNT", "1"))
+# Where the engines look for model checkpoints (defaults to tortoise's own MODELS_DIR).
+TTS_MODELS_DIR = os.getenv("TORTOISE_MODELS_DIR")
+# Autoregressive key/value cache: true, false, or "static" (preallocated for the whole generation).
+TTS_KV_CACHE = "static" if os.getenv("TTS_KV_CACHE", "").strip().lower() == "static" else _get_bool("TTS_KV_CACHE", False)
+TTS_HALF = _get_bool("TTS_HALF", False)
+# Device memory (MiB per engine) for prefilled voice + text prompts reused across requests (needs TTS_KV_CACHE).
+# 0 disables it.
+TTS_PREFIX_CACHE_MB = int(os.getenv("TTS_PREFIX_CACHE_MB", "0"))
+# Where the engine keeps its models between calls: "offload-lru" (resident while they fit in the budget),
+# "all-resident" or "cpu-only". Budget in MiB per engine; empty uses half of the GPU's memory.
+TTS_PLACEMENT = os.getenv("TTS_PLACEMENT", "offload-lru")
+TTS_PLACEMENT_BUDGET_MB = int(os.getenv("TTS_PLACEMENT_BUDGET_MB")) if os.getenv("TTS_PLACEMENT_BUDGET_MB") else None
+# Use the autoregressive states from sampling as diffusion conditioning instead of recomputing them (slightly
+# different audio; see TextToSpeech's reuse_ar_latents).
+TTS_REUSE_AR_LATENTS = _get_bool("TTS_REUSE_AR_LATENTS", False)
+# Progressive candidate search: stop sampling once the best candidates reach a CLVP score, stop improving for N
+# batches, or the search has used its time budget (seconds). Empty keeps sampling the whole preset.
+TTS_SEARCH_SCORE_THRESHOLD = float(os.getenv("TTS_SEARCH_SCORE_THRESHOLD")) if os.getenv("TTS_SEARCH_SCORE_THRESHOLD") else None
+TTS_SEARCH_PATIENCE = int(os.getenv("TTS_SEARCH_PATIENCE")) if os.getenv("TTS_SEARCH_PATIENCE") else None
+TTS_SEARCH_TIME_BUDGET = float(os.getenv("TTS_SEARCH_TIME_BUDGET")) if os.getenv("TTS_SEARCH_TIME_BUDGET") else None
+# Generation preset for segments (see TextToSpeech.tts_with_preset), e.g. "fast_dpm" for DPM-Solver++ decoding.
+TTS_PRESET = os.getenv("TTS_PRESET", "fast")
+# Run a short synthesis on every engine after loading so the first real request does not pay for kernel warm-up.
+TTS_WARMUP = _get_bool("TTS_WARMUP", True)
+TTS_WARMUP_TEXT = os.getenv("TTS_WARMUP_TEXT", "Warming up.")
+# How long (seconds) a request waits for a free engine before giving up.
+TTS_ENGINE_ACQUIRE_TIMEOUT = float(os.getenv("TTS_ENGINE_ACQUIRE_TIMEOUT", "600"))
+
+# "tortoise" for real synthesis, "stub" for a tone generator (local development / API tests).
+TTS_ENGINE = os.getenv("TTS_ENGINE", "tortoise")
+# Seconds the stub engine sleeps per call (per chunk when streaming), to imitate synthesis latency.
+TTS_STUB_DELAY = float(os.getenv("TTS_STUB_DELAY", "0"))
+# "s3" for S3 / Lightsail Object Storage, "memory" for an in-process store (local development / API tests).
+TTS_OBJECT_STORE = os.getenv("TTS_OBJECT_STORE", "s3")
+# Worker threads executing generation jobs. Engine time is handed out per segment by the scheduler, so there are
+# more job workers than engines: an interactive job can start (and overtake) while long chapters are in progress.
+TTS_JOB_WORKERS = int(os.getenv("TTS_JOB_WORKERS", str(4 * TTS_ENGINE_COUNT)))
+# Jobs allowed to wait for a worker before new submissions are rejected with 429.
+TTS_MAX_QUEUED_JOBS = int(os.getenv("TTS_MAX_QUEUED_JOBS", "32"))
+# Seconds a finished job remains queryable through /jobs/{job_id}.
+TTS_JOB_RETENTION = float(os.getenv("TTS_JOB_RETENTION", "3600"))
+
+# Content-addressed cache of finished syntheses (only used for seeded requests). Empty disables it.
+TTS_RESULT_CACHE_DIR = os.getenv("TTS_RESULT_CACHE_DIR", "")
+TTS_RESULT_CACHE_MAX_BYTES = int(os.getenv("TTS_RESULT_CACHE_MAX_BYTES", str(2 * 1024 ** 3)))
+# Optional bucket/prefix through which several API hosts share cached results.
+TTS_RESULT_CACHE_BUCKET = os.getenv("TTS_RESULT_CACHE_BUCKET", "")
+TTS_RESULT_CACHE_PREFIX = os.getenv("TTS_RESULT_CACHE_PREFIX", "tts-cache")
+# Seed used for requests that do not carry one, making them reproducible (and cacheable). Empty keeps random seeds.
+TTS_DEFAULT_SEED = int(os.getenv("TTS_DEFAULT_SEED")) if os.getenv("TTS_DEFAULT_SEED") else None
+
+# Long texts are split into segments that are synthesized in parallel on all engines and stitched back together.
+TTS_SEGMENT_DESIRED_LENGTH = int(os.getenv("TTS_SEGMENT_DESIRED_LENGTH", "200"))
+TTS_SEGMENT_MAX_LENGTH = int(os.getenv("TTS_SEGMENT_MAX_LENGTH", "300"))
+# Silence inserted between segments, or (if > 0) a linear crossfade between them instead.
+TTS_SEGMENT_SILENCE_MS = int(os.getenv("TTS_SEGMENT_SILENCE_MS", "0"))
+TTS_SEGMENT_CROSSFADE_MS = int(os.getenv("TTS_SEGMENT_CROSSFADE_MS", "0"))
+
+# Default encoding of uploaded audio: wav (32-bit float), pcm16, flac, opus or mp3.
+TTS_OUTPUT_FORMAT = os.getenv("TTS_OUTPUT_FORMAT", "wav")
+
+# Engines (tortoise.api_fast) reserved for the live /stream endpoints. 0 disables streaming.
+TTS_STREAM_ENGINE_COUNT = int(os.getenv("TTS_STREAM_ENGINE_COUNT", "0"))
+# Streams decoded together on each streaming engine (continuous batching, see tortoise/utils/stream_engine.py).
+# 1 gives every stream an engine of its own.
+TTS_STREAM_BATCH_SIZE = int(os.getenv("TTS_STREAM_BATCH_SIZE", "1"))
+# Default encoding of streamed audio.
+TTS_STREAM_FORMAT = os.getenv("TTS_STREAM_FORMAT", "pcm16")
+# How long (seconds) a stream waits for a free streaming engine before answering 503.
+TTS_STREAM_ACQUIRE_TIMEOUT = float(os.getenv("TTS_STREAM_ACQUIRE_TIMEOUT", "30"))
+
+# Scheduling of segments on the engines: "interactive" requests always go before "batch" ones (at segment
+# boundaries); within a class, tenants (API key, else S3 bucket) share the engines by weighted round robin.
+TTS_DEFAULT_PRIORITY = os.getenv("TTS_DEFAULT_PRIORITY", "batch")
+# Tenant weights as "tenant=weight,..." e.g. "my-books-bucket=3,partner-api-key=1". Unlisted tenants weigh 1.
+TTS_TENANT_WEIGHTS = os.getenv("TTS_TENANT_WEIGHTS", "")
@@ -11,6 +11,7 @@ import torchaudio
 
 from tortoise.api import MODELS_DIR, TextToSpeech
 from tortoise.utils.audio import get_voices, load_voices, load_audio
+from tortoise.utils.audio_encoders import FORMATS, output_filename, save_audio
 from tortoise.utils.text import split_and_recombine_text
 
 parser = argparse.ArgumentParser(
@@ -34,6 +35,9 @@ parser.add_argument(
 parser.add_argument(
     '-q, --quiet', default=False, action='store_true', dest='quiet',
     help='Suppress all output.')
+parser.add_argument(
+    '-f, --format', type=str, default=None, choices=list(FORMATS), dest='format',
+    help='Output audio format. Defaults to the extension of --output, otherwise wav.')
 
 output_group = parser.add_mutually_exclusive_group(required=True)
 output_group.add_argument(
@@ -204,6 +208,7 @@ if args.play:
         parser.error('--play requires pydub to be installed, which can be done with "pip install pydub"')
 
 seed = int(time.time()) if args.seed is None else args.seed
+output_format = args.format or 'wav'
 if not args.quiet:
     print('Loading tts...')
 tts = TextToSpeech(models_dir=args.models_dir, enable_redaction=not args.disable_redaction,
@@ -228,7 +233,7 @@ for voice_idx, voice in enumerate(selected_voices):
     for text_idx, text in enumerate(texts):
         clip_name = f'{"-".join(voice)}_{text_idx:02d}'
         if args.output_dir:
-            first_clip = os.path.join(args.output_dir, f'{clip_name}_00.wav')
+            first_clip = os.path.join(args.output_dir, output_filename(f'{clip_name}_00', output_format))
             if (args.skip_existing or (regenerate_clips and text_idx not in regenerate_clips)) and os.path.exists(first_clip):
                 audio_parts.append(load_audio(first_clip, 24000))
                 if not args.quiet:
@@ -245,16 +250,16 @@ for voice_idx, voice in enumerate(selected_voices):
             if candidate_idx == 0:
                 audio_parts.append(audio)
             if args.output_dir:
-                filename = f'{clip_name}_{candidate_idx:02d}.wav'
-                torchaudio.save(os.path.join(args.output_dir, filename), audio, 24000)
+                filename = output_filename(f'{clip_name}_{candidate_idx:02d}', output_format)
+                save_audio(os.path.join(args.output_dir, filename), audio, 24000, output_format)
 
     audio = torch.cat(audio_parts, dim=-1)
     if args.output_dir:
-        filename = f'{"-".join(voice)}_combined.wav'
-        torchaudio.save(os.path.join(args.output_dir, filename), audio, 24000)
+        filename = output_filename(f'{"-".join(voice)}_combined', output_format)
+        save_audio(os.path.join(args.output_dir, filename), audio, 24000, output_format)
     elif args.output:
         filename = args.output if args.output else os.tmp
-        torchaudio.save(args.output, audio, 24000)
+        save_audio(args.output, audio, 24000, args.format)
     elif args.play:
         f = tempfile.NamedTemporaryFile(suffix='.wav', delete=True)
         torchaudio.save(f.name, audio, 24000)
@@ -1,11 +1,13 @@
 import os
 import random
+import threading
 import uuid
 from time import time
 from urllib import request
 
 import torch
 import torch.nn.functional as F
+from torch.nn.utils.rnn import pad_sequence
 import progressbar
 import torchaudio
 
@@ -19,10 +21,16 @@ from tortoise.models.cvvp import CVVP
 from tortoise.models.random_latent_generator import RandomLatentConverter
 from tortoise.models.vocoder import UnivNetGenerator
 from tortoise.utils.audio import wav_to_univnet_mel, denormalize_tacotron_mel
-from tortoise.utils.diffusion import SpacedDiffusion, space_timesteps, get_named_beta_schedule
+from tortoise.utils.diffusion import SpacedDiffusion, sampler_timesteps, get_named_beta_schedule
 from tortoise.utils.tokenizer import VoiceBpeTokenizer
+from tortoise.utils.result_cache import hash_voice, make_cache_key
+from tortoise.utils.instrumentation import timed_stage, count, StageTimer
+from tortoise.utils.placement import ModelPlacement
+from tortoise.utils.latent_store import LatentStore
+from tortoise.utils.candidate_search import CandidateSearch
+from tortoise.utils.codes import fix_autoregressive_codes, calm_trim_points
 from tortoise.utils.wav2vec_alignment import Wav2VecAlignment
-from contextlib import contextmanager
+from contextlib import contextmanager, nullcontext
 from huggingface_hub import hf_hub_download
 pbar = None
 
@@ -61,13 +69,16 @@ def pad_or_truncate(t, length):
         return t[..., :length]
 
 
-def load_discrete_vocoder_diffuser(trained_diffusion_steps=4000, desired_diffusion_steps=200, cond_free=True, cond_free_k=1):
+def load_discrete_vocoder_diffuser(trained_diffusion_steps=4000, desired_diffusion_steps=200, cond_free=True, cond_free_k=1,
+                                   sampler='p'):
     """
     Helper function to load a GaussianDiffusion instance configured for use as a vocoder.
+    :param sampler: One of tortoise.utils.diffusion.SAMPLERS; picks the timesteps and the loop run by sample_loop().
     """
-    return SpacedDiffusion(use_timesteps=space_timesteps(trained_diffusion_steps, [desired_diffusion_steps]), model_mean_type='epsilon',
-                           model_var_type='learned_range', loss_type='mse', betas=get_named_beta_schedule('linear', trained_diffusion_steps),
-                           conditioning_free=cond_free, conditioning_free_k=cond_free_k)
+    betas = get_named_beta_schedule('linear', trained_diffusion_steps)
+    return SpacedDiffusion(use_timesteps=sampler_timesteps(sampler, betas, desired_diffusion_steps), model_mean_type='epsilon',
+                           model_var_type='learned_range', loss_type='mse', betas=betas,
+                           conditioning_free=cond_free, conditioning_free_k=cond_free_k, sampler=sampler)
 
 
 def format_conditioning(clip, cond_length=132300, device="cuda" if not torch.backends.mps.is_available() else 'mps'):
@@ -93,25 +104,18 @@ def fix_autoregressive_output(codes, stop_token, complain=True):
     and copying out the last few codes.
 
     Failing to do this padding will produce speech with a harsh end that sounds like "BLAH" or similar.
+
+    Works on a single clip (1D); see tortoise.utils.codes.fix_autoregressive_codes for whole batches.
     """
-    # Strip off the autoregressive stop token and add padding.
-    stop_token_indices = (codes == stop_token).nonzero()
-    if len(stop_token_indices) == 0:
-        if complain:
-            print("No stop tokens found in one of the generated voice clips. This typically means the spoken audio is "
-                  "too long. In some cases, the output will still be good, though. Listen to it and if it is missing words, "
-                  "try breaking up your input text.")
-        return codes
-    else:
-        codes[stop_token_indices] = 83
-    stm = stop_token_indices.min().item()
-    codes[stm:] = 83
-    if stm - 3 < codes.shape[0]:
-        codes[-3] = 45
-        codes[-2] = 45
-        codes[-1] = 248
+    return fix_autoregressive_codes(codes.unsqueeze(0), stop_token, complain=complain).squeeze(0)
 
-    return codes
+
+def calm_trim_point(codes, calm_token, max_calm=8):
+    """
+    Index at which the latents of `codes` (1D) are cut before diffusion: the position of the first calm token that
+    follows `max_calm` consecutive calm tokens. None if there is no such run. See calm_trim_points for batches.
+    """
+    return calm_trim_points(codes.unsqueeze(0), calm_token, max_calm)[0]
 
 
 def do_spectrogram_diffusion(diffusion_model, diffuser, latents, conditioning_latents, temperature=1, verbose=True):
@@ -124,12 +128,69 @@ def do_spectrogram_diffusion(diffusion_model, diffuser, latents, conditioning_la
         precomputed_embeddings = diffusion_model.timestep_independent(latents, conditioning_latents, output_seq_len, False)
 
         noise = torch.randn(output_shape, device=latents.device) * temperature
-        mel = diffuser.p_sample_loop(diffusion_model, output_shape, noise=noise,
-                                      model_kwargs={'precomputed_aligned_embeddings': precomputed_embeddings},
+        mel = diffuser.sample_loop(diffusion_model, output_shape, noise=noise,
+                                    model_kwargs={'precomputed_aligned_embeddings': precomputed_embeddings},
                                      progress=verbose)
         return denormalize_tacotron_mel(mel)[:,:,:output_seq_len]
 
 
+def do_spectrogram_diffusion_batch(diffusion_model, diffuser, latents, conditioning_latents, temperature=1, verbose=True):
+    """
+    do_spectrogram_diffusion for a list of latents (S,D) of different lengths, diffused together in one sampling loop:
+    they are padded to the longest one and DiffusionTts.valid_lengths masks the padding out. Returns one spectrogram
+    per latent, cut to its own length.
+    """
+    if len(latents) == 1 or not hasattr(diffusion_model, 'valid_lengths'):  # Traced models cannot mask padding.
+        return [do_spectrogram_diffusion(diffusion_model, diffuser, lat.unsqueeze(0), conditioning_latents, temperature, verbose)
+                for lat in latents]
+    with torch.no_grad():
+        output_seq_lens = [lat.shape[0] * 4 * 24000 // 22050 for lat in latents]
+        output_seq_len = max(output_seq_lens)
+        output_shape = (len(latents), 100, output_seq_len)
+        # Aligned per sample, so every sample is stretched to its own output length.
+        precomputed_embeddings = torch.cat([
+            F.pad(diffusion_model.timestep_independent(lat.unsqueeze(0), conditioning_latents, seq_len, False),
+                  (0, output_seq_len - seq_len))
+            for lat, seq_len in zip(latents, output_seq_lens)])
+
+        noise = torch.randn(output_shape, device=latents[0].device) * temperature
+        with diffusion_model.valid_lengths(output_seq_lens if len(set(output_seq_lens)) > 1 else None):
+            mel = diffuser.sample_loop(diffusion_model, output_shape, noise=noise,
+                                       model_kwargs={'precomputed_aligned_embeddings': precomputed_embeddings},
+                                         progress=verbose)
+        mel = denormalize_tacotron_mel(mel)
+        return [mel[b:b + 1, :, :seq_len] for b, seq_len in enumerate(output_seq_lens)]
+
+
+def vocode_batch(vocoder, mels):
+    """
+    Runs the vocoder once over spectrograms of different lengths and returns one waveform per spectrogram. Shorter
+    spectrograms are padded with the same silence UnivNetGenerator.inference appends, and their audio cut back.
+    """
+    if len(mels) == 1:
+        return [vocoder.inference(mels[0])]
+    length = max(mel.shape[-1] for mel in mels)
+    silence = -11.5129
+    wav = vocoder.inference(torch.cat([F.pad(mel, (0, length - mel.shape[-1]), value=silence) for mel in mels]))
+    hop_length = wav.shape[-1] // length
+    return [wav[b:b + 1, :, :mel.shape[-1] * hop_length] for b, mel in enumerate(mels)]
+
+
+def length_buckets(lengths, batch_size, slack=None):
+    """
+    Groups the indices of `lengths` into buckets of at most `batch_size`, in order of length, starting a new bucket when
+    an item is more than `slack` longer than the shortest one of the current bucket.
+    """
+    buckets = []
+    for i in sorted(range(len(lengths)), key=lambda i: lengths[i]):
+        bucket = buckets[-1] if buckets else None
+        if bucket is None or len(bucket) >= batch_size or (slack is not None and lengths[i] - lengths[bucket[0]] > slack):
+            buckets.append([i])
+        else:
+            bucket.append(i)
+    return buckets
+
+
 def classify_audio_clip(clip):
     """
     Returns whether or not Tortoises' classifier thinks the given clip came from Tortoise.
@@ -171,14 +232,63 @@ def pick_best_batch_size_for_gpu():
             return 4
     return 1
 
+def preset_settings(preset, **kwargs):
+    """
+    Generation settings of one of the presets described in TextToSpeech.tts_with_preset, overridden by kwargs.
+    """
+    # Use generally found best tuning knobs for generation.
+    settings = {'temperature': .8, 'length_penalty': 1.0, 'repetition_penalty': 2.0,
+                'top_p': .8,
+                'cond_free_k': 2.0, 'diffusion_temperature': 1.0}
+    # Presets are defined here.
+    presets = {
+        'ultra_fast': {'num_autoregressive_samples': 16, 'diffusion_iterations': 30, 'cond_free': False},
+        'fast': {'num_autoregressive_samples': 96, 'diffusion_iterations': 80},
+        'standard': {'num_autoregressive_samples': 256, 'diffusion_iterations': 200},
+        'high_quality': {'num_autoregressive_samples': 256, 'diffusion_iterations': 400},
+        'fast_dpm': {'num_autoregressive_samples': 96, 'diffusion_iterations': 20, 'diffusion_sampler': 'dpm++2m-karras'},
+    }
+    settings.update(presets[preset])
+    settings.update(kwargs) # allow overriding of preset settings with kwargs
+    return settings
+
+
+class _LazyModel:
+    """
+    A TextToSpeech sub-model loaded by `loader` on first use. Concurrent first uses wait on the engine's load lock and
+    load it once; the result is stored in the instance __dict__, so later lookups do not come back here. Assigning the
+    attribute replaces the model.
+    """
+
+    def __init__(self, loader):
+        self.loader = loader
+
+    def __set_name__(self, owner, name):
+        self.name = name
+
+    def __get__(self, instance, owner=None):
+        if instance is None:
+            return self
+        with instance._load_lock:
+            if self.name not in instance.__dict__:
+                instance.__dict__[self.name] = self.loader(instance)
+        return instance.__dict__[self.name]
+
+
 class TextToSpeech:
     """
     Main entry point into Tortoise.
+
+    The autoregressive and diffusion models are loaded by the constructor. CLVP, the vocoder, the random latent
+    generators and the wav2vec2 aligner used for redaction are loaded on first use; call preload() to load them
+    up front.
     """
 
     def __init__(self, autoregressive_batch_size=None, models_dir=MODELS_DIR, 
                  enable_redaction=True, kv_cache=False, use_deepspeed=False, half=False, device=None,
-                 tokenizer_vocab_file=None, tokenizer_basic=False):
+                 tokenizer_vocab_file=None, tokenizer_basic=False, result_cache=None, hooks=None,
+                 placement='offload-lru', placement_budget=None, reuse_ar_latents=False,
+                 ar_latent_budget=512 * 1024 ** 2, prefix_cache=None):
 
         """
         Constructor
@@ -190,21 +300,53 @@ class TextToSpeech:
                                  (but are still rendered by the model). This can be used for prompt engineering.
                                  Default is true.
         :param device: Device to use when running the model. If omitted, the device will be automatically chosen.
+        :param kv_cache: Reuse the attention keys/values of earlier tokens while sampling. 'static' keeps them in a
+                         cache preallocated for the whole generation instead of growing it every token.
+        :param result_cache: Optional tortoise.utils.result_cache.SynthesisCache. When set, tts() calls made with
+                             use_deterministic_seed are looked up there first and stored there afterwards.
+        :param hooks: Optional tortoise.utils.instrumentation.PipelineHooks receiving per-stage timings and counters
+                      (e.g. MetricsHooks for Prometheus metrics).
+        :param placement: Where models live between uses: 'all-resident', 'offload-lru' (default) or 'cpu-only', see
+                          tortoise.utils.placement. A ModelPlacement instance may be passed instead.
+        :param placement_budget: Device memory (bytes) resident models may occupy under 'offload-lru'.
+        :param reuse_ar_latents: When true, the autoregressive hidden states computed while sampling are kept and used
+                                 as the diffusion conditioning of the best candidates, instead of running the
+                                 autoregressive model over them a second time. The latents of the spoken part are the
+                                 same as the recomputed ones when kv_cache is off; with kv_cache they carry the position
+                                 offset of cached sampling, and the few latents after the stop token were computed from
+                                 the stop token rather than the calm-token padding, so the audio is close to, but not
+                                 bit-identical with, the default path.
+        :param ar_latent_budget: Bytes of sampled latents kept per tts() call with reuse_ar_latents. Batches beyond the
+                                 budget are not kept; if a chosen candidate's latents are missing, they are recomputed.
+        :param prefix_cache: Optional tortoise.utils.prefix_cache.PrefixCache (requires kv_cache). Prompts of
+                             voice + text that were sampled from before are restored from it instead of being run
+                             through the autoregressive model again.
         """
         self.models_dir = models_dir
+        self.result_cache = result_cache
+        self.hooks = hooks
+        self.reuse_ar_latents = reuse_ar_latents
+        self.ar_latent_budget = ar_latent_budget
+        self.last_search_stats = None
         self.autoregressive_batch_size = pick_best_batch_size_for_gpu() if autoregressive_batch_size is None else autoregressive_batch_size
         self.enable_redaction = enable_redaction
         self.device = torch.device('cuda' if torch.cuda.is_available() else'cpu')
         if torch.backends.mps.is_available():
             self.device = torch.device('mps')
-        if self.enable_redaction:
-            self.aligner = Wav2VecAlignment()
+        if not isinstance(placement, ModelPlacement):
+            placement = ModelPlacement(self.device, placement, placement_budget)
+        self.placement = placement
+        self.device = placement.device
+        self._load_lock = threading.RLock()
+        self._diffusers = {}  # see vocoder_diffuser()
 
         self.tokenizer = VoiceBpeTokenizer(
             vocab_file=tokenizer_vocab_file,
             use_basic_cleaners=tokenizer_basic,
         )
         self.half = half
+        self.kv_cache = kv_cache
+        self.prefix_cache = prefix_cache
         if os.path.exists(f'{models_dir}/autoregressive.ptt'):
             # Assume this is a traced directory.
             self.autoregressive = torch.jit.load(f'{models_dir}/autoregressive.ptt')
@@ -216,38 +358,98 @@ class TextToSpeech:
                                           train_solo_embeddings=False).cpu().eval()
             self.autoregressive.load_state_dict(torch.load(get_model_path('autoregressive.pth', models_dir)), strict=False)
             self.autoregressive.post_init_gpt2_config(use_deepspeed=use_deepspeed, kv_cache=kv_cache, half=self.half)
+            self.autoregressive.inference_model.prefix_cache = prefix_cache
             
             self.diffusion = DiffusionTts(model_channels=1024, num_layers=10, in_channels=100, out_channels=200,
                                           in_latent_channels=1024, in_tokens=8193, dropout=0, use_fp16=False, num_heads=16,
                                           layer_drop=0, unconditioned_percentage=0).cpu().eval()
             self.diffusion.load_state_dict(torch.load(get_model_path('diffusion_decoder.pth', models_dir)))
 
-        self.clvp = CLVP(dim_text=768, dim_speech=768, dim_latent=768, num_text_tokens=256, text_enc_depth=20,
-                         text_seq_len=350, text_heads=12,
-                         num_speech_tokens=8192, speech_enc_depth=20, speech_heads=12, speech_seq_len=430,
-                         use_xformers=True).cpu().eval()
-        self.clvp.load_state_dict(torch.load(get_model_path('clvp2.pth', models_dir)))
         self.cvvp = None # CVVP model is only loaded if used.
 
-        self.vocoder = UnivNetGenerator().cpu()
-        self.vocoder.load_state_dict(torch.load(get_model_path('vocoder.pth', models_dir), map_location=torch.device('cpu'))['model_g'])
-        self.vocoder.eval(inference=True)
+    def _load_clvp(self):
+        clvp = CLVP(dim_text=768, dim_speech=768, dim_latent=768, num_text_tokens=256, text_enc_depth=20,
+                    text_seq_len=350, text_heads=12,
+                    num_speech_tokens=8192, speech_enc_depth=20, speech_heads=12, speech_seq_len=430,
+                    use_xformers=True).cpu().eval()
+        clvp.load_state_dict(torch.load(get_model_path('clvp2.pth', self.models_dir)))
+        return clvp
+
+    def _load_vocoder(self):
+        vocoder = UnivNetGenerator().cpu()
+        vocoder.load_state_dict(torch.load(get_model_path('vocoder.pth', self.models_dir), map_location=torch.device('cpu'))['model_g'])
+        vocoder.eval(inference=True)
+        return vocoder
+
+    def _load_rlg_auto(self):
+        rlg = RandomLatentConverter(1024).eval()
+        rlg.load_state_dict(torch.load(get_model_path('rlg_auto.pth', self.models_dir), map_location=torch.device('cpu')))
+        return rlg
+
+    def _load_rlg_diffusion(self):
+        rlg = RandomLatentConverter(2048).eval()
+        rlg.load_state_dict(torch.load(get_model_path('rlg_diffuser.pth', self.models_dir), map_location=torch.device('cpu')))
+        return rlg
+
+    def _load_aligner(self):
+        return Wav2VecAlignment()
+
+    clvp = _LazyModel(_load_clvp)
+    vocoder = _LazyModel(_load_vocoder)
+    # Random latent generators (RLGs), only needed for the "random" voice.
+    rlg_auto = _LazyModel(_load_rlg_auto)
+    rlg_diffusion = _LazyModel(_load_rlg_diffusion)
+    # Only needed to redact text in [brackets].
+    aligner = _LazyModel(_load_aligner)
+
+    def preload(self, cvvp=False, random_latents=False):
+        """
+        Loads the lazily loaded models now instead of on first use, e.g. before a server starts taking requests.
+        :param cvvp: Also load CVVP, used when cvvp_amount > 0.
+        :param random_latents: Also load the random latent generators, used by the "random" voice.
+        """
+        names = ['clvp', 'vocoder']
+        if self.enable_redaction:
+            names.append('aligner')
+        if random_latents:
+            names.extend(['rlg_auto', 'rlg_diffusion'])
+        for name in names:
+            getattr(self, name)  # Loads it.
+        if cvvp:
+            self.load_cvvp()
 
-        # Random latent generators (RLGs) are loaded lazily.
-        self.rlg_auto = None
-        self.rlg_diffusion = None
     @contextmanager
     def temporary_cuda(self, model):
-        m = model.to(self.device)
-        yield m
-        m = model.cpu()
+        """Kept for compatibility: models are now placed by self.placement instead of moved on every use."""
+        with self.placement.use(model) as m:
+            yield m
+
+    def vocoder_diffuser(self, diffusion_iterations, cond_free, cond_free_k, sampler):
+        """
+        load_discrete_vocoder_diffuser(), cached per instance. A diffuser holds no per-sample state and can be shared
+        between threads, but keeps its schedule tables on the device and a reference to the last model it ran, so it
+        must not outlive (or be shared with other instances of) this model.
+        """
+        key = (diffusion_iterations, cond_free, cond_free_k, sampler)
+        with self._load_lock:
+            diffuser = self._diffusers.get(key)
+            if diffuser is None:
+                if len(self._diffusers) >= 32:
+                    del self._diffusers[next(iter(self._diffusers))]
+                diffuser = load_discrete_vocoder_diffuser(desired_diffusion_steps=diffusion_iterations, cond_free=cond_free,
+                                                          cond_free_k=cond_free_k, sampler=sampler)
+                self._diffusers[key] = diffuser
+        return diffuser
 
-    
     def load_cvvp(self):
         """Load CVVP model."""
-        self.cvvp = CVVP(model_dim=512, transformer_heads=8, dropout=0, mel_codes=8192, conditioning_enc_depth=8, cond_mask_percentage=0,
-                         speech_enc_depth=8, speech_mask_percentage=0, latent_multiplier=1).cpu().eval()
-        self.cvvp.load_state_dict(torch.load(get_model_path('cvvp.pth', self.models_dir)))
+        with self._load_lock:
+            if self.cvvp is not None:
+                return
+            cvvp = CVVP(model_dim=512, transformer_heads=8, dropout=0, mel_codes=8192, conditioning_enc_depth=8, cond_mask_percentage=0,
+                        speech_enc_depth=8, speech_mask_percentage=0, latent_multiplier=1).cpu().eval()
+            cvvp.load_state_dict(torch.load(get_model_path('cvvp.pth', self.models_dir)))
+            self.cvvp = cvvp
 
     def get_conditioning_latents(self, voice_samples, return_mels=False):
         """
@@ -265,9 +467,8 @@ class TextToSpeech:
             for vs in voice_samples:
                 auto_conds.append(format_conditioning(vs, device=self.device))
             auto_conds = torch.stack(auto_conds, dim=1)
-            self.autoregressive = self.autoregressive.to(self.device)
-            auto_latent = self.autoregressive.get_conditioning(auto_conds)
-            self.autoregressive = self.autoregressive.cpu()
+            with self.placement.use(self.autoregressive) as autoregressive:
+                auto_latent = autoregressive.get_conditioning(auto_conds)
 
             diffusion_conds = []
             for sample in voice_samples:
@@ -278,9 +479,8 @@ class TextToSpeech:
                 diffusion_conds.append(cond_mel)
             diffusion_conds = torch.stack(diffusion_conds, dim=1)
 
-            self.diffusion = self.diffusion.to(self.device)
-            diffusion_latent = self.diffusion.get_conditioning(diffusion_conds)
-            self.diffusion = self.diffusion.cpu()
+            with self.placement.use(self.diffusion) as diffusion:
+                diffusion_latent = diffusion.get_conditioning(diffusion_conds)
 
         if return_mels:
             return auto_latent, diffusion_latent, auto_conds, diffusion_conds
@@ -288,12 +488,6 @@ class TextToSpeech:
             return auto_latent, diffusion_latent
 
     def get_random_conditioning_latents(self):
-        # Lazy-load the RLG models.
-        if self.rlg_auto is None:
-            self.rlg_auto = RandomLatentConverter(1024).eval()
-            self.rlg_auto.load_state_dict(torch.load(get_model_path('rlg_auto.pth', self.models_dir), map_location=torch.device('cpu')))
-            self.rlg_diffusion = RandomLatentConverter(2048).eval()
-            self.rlg_diffusion.load_state_dict(torch.load(get_model_path('rlg_diffuser.pth', self.models_dir), map_location=torch.device('cpu')))
         with torch.no_grad():
             return self.rlg_auto(torch.tensor([0.0])), self.rlg_diffusion(torch.tensor([0.0]))
 
@@ -304,21 +498,15 @@ class TextToSpeech:
             'fast': Decent quality speech at a decent inference rate. A good choice for mass inference.
             'standard': Very good quality. This is generally about as good as you are going to get.
             'high_quality': Use if you want the absolute best. This is not really worth the compute, though.
+            'fast_dpm': Like 'fast', but decodes with 20 steps of DPM-Solver++ instead of 80 ancestral diffusion steps.
+        """
+        return self.tts(text, **preset_settings(preset, **kwargs))
+
+    def tts_batch_with_preset(self, texts, preset='fast', **kwargs):
+        """
+        Calls tts_batch with one of the presets of tts_with_preset.
         """
-        # Use generally found best tuning knobs for generation.
-        settings = {'temperature': .8, 'length_penalty': 1.0, 'repetition_penalty': 2.0,
-                    'top_p': .8,
-                    'cond_free_k': 2.0, 'diffusion_temperature': 1.0}
-        # Presets are defined here.
-        presets = {
-            'ultra_fast': {'num_autoregressive_samples': 16, 'diffusion_iterations': 30, 'cond_free': False},
-            'fast': {'num_autoregressive_samples': 96, 'diffusion_iterations': 80},
-            'standard': {'num_autoregressive_samples': 256, 'diffusion_iterations': 200},
-            'high_quality': {'num_autoregressive_samples': 256, 'diffusion_iterations': 400},
-        }
-        settings.update(presets[preset])
-        settings.update(kwargs) # allow overriding of preset settings with kwargs
-        return self.tts(text, **settings)
+        return self.tts_batch(texts, **preset_settings(preset, **kwargs))
 
     def tts(self, text, voice_samples=None, conditioning_latents=None, k=1, verbose=True, use_deterministic_seed=None,
             return_deterministic_state=False,
@@ -326,8 +514,11 @@ class TextToSpeech:
             num_autoregressive_samples=512, temperature=.8, length_penalty=1, repetition_penalty=2.0, top_p=.8, max_mel_tokens=500,
             # CVVP parameters follow
             cvvp_amount=.0,
+            # progressive candidate search parameters follow
+            score_threshold=None, search_patience=None, search_time_budget=None,
             # diffusion generation parameters follow
-            diffusion_iterations=100, cond_free=True, cond_free_k=2, diffusion_temperature=1.0,
+            diffusion_iterations=100, cond_free=True, cond_free_k=2, diffusion_temperature=1.0, diffusion_sampler='p',
+            diffusion_batch_size=4, diffusion_bucket_slack=64,
             **hf_generate_kwargs):
         """
         Produces an audio clip of the given text being spoken with the given reference voice.
@@ -354,6 +545,13 @@ class TextToSpeech:
         ~~CLVP-CVVP KNOBS~~
         :param cvvp_amount: Controls the influence of the CVVP model in selecting the best output from the autoregressive model.
                             [0,1]. Values closer to 1 mean the CVVP model is more important, 0 disables the CVVP model.
+        ~~CANDIDATE SEARCH KNOBS~~
+        Setting any of these scores every batch of autoregressive samples as soon as it is drawn and stops sampling early,
+        making num_autoregressive_samples an upper bound (see tortoise.utils.candidate_search). How many samples were
+        drawn, the scores reached and why the search stopped are left in self.last_search_stats.
+        :param score_threshold: Stop once the k best candidates all have at least this CLVP score.
+        :param search_patience: Stop once this many batches in a row did not improve the k-th best score.
+        :param search_time_budget: Stop before sampling and scoring would take longer than this many seconds.
         ~~DIFFUSION KNOBS~~
         :param diffusion_iterations: Number of diffusion steps to perform. [0,4000]. More steps means the network has more chances to iteratively refine
                                      the output, which should theoretically mean a higher quality output. Generally a value above 250 is not noticeably better,
@@ -367,6 +565,13 @@ class TextToSpeech:
                             Formula is: output=cond_present_output*(cond_free_k+1)-cond_absenct_output*cond_free_k
         :param diffusion_temperature: Controls the variance of the noise fed into the diffusion model. [0,1]. Values at 0
                                       are the "mean" prediction of the diffusion network and will sound bland and smeared.
+        :param diffusion_sampler: How the diffusion model is sampled, one of tortoise.utils.diffusion.SAMPLERS: 'p'
+                                  (ancestral sampling, the default), 'ddim', 'dpm++2m' or 'dpm++2m-karras'. The DPM-Solver++
+                                  samplers need far fewer diffusion_iterations (10-25) for the same quality.
+        :param diffusion_batch_size: How many of the k selected candidates are diffused (and vocoded) together.
+        :param diffusion_bucket_slack: Candidates are batched in buckets of similar length. A bucket admits candidates up
+                                       to this many latents longer than its shortest one. Padding is masked out, so this
+                                       only trades computation spent on padding against the number of batches.
         ~~OTHER STUFF~~
         :param hf_generate_kwargs: The huggingface Transformers generate API is used for the autoregressive transformer.
                                    Extra keyword args fed to this function get forwarded directly to that API. Documentation
@@ -376,214 +581,455 @@ class TextToSpeech:
         """
         deterministic_seed = self.deterministic_state(seed=use_deterministic_seed)
 
-        text_tokens = torch.IntTensor(self.tokenizer.encode(text)).unsqueeze(0).to(self.device)
+        with timed_stage(self.hooks, 'tokenization'):
+            encoded_text = self.tokenizer.encode(text)
+        cache_key = None
+        if self.result_cache is not None and use_deterministic_seed is not None:
+            # Only seeded calls are reproducible, so only those can be served from the cache.
+            settings = {'k': k, 'num_autoregressive_samples': num_autoregressive_samples, 'temperature': temperature,
+                        'length_penalty': length_penalty, 'repetition_penalty': repetition_penalty, 'top_p': top_p,
+                        'max_mel_tokens': max_mel_tokens, 'cvvp_amount': cvvp_amount,
+                        'score_threshold': score_threshold, 'search_patience': search_patience,
+                        'search_time_budget': search_time_budget,
+                        'diffusion_iterations': diffusion_iterations, 'cond_free': cond_free, 'cond_free_k': cond_free_k,
+                        'diffusion_temperature': diffusion_temperature, 'diffusion_sampler': diffusion_sampler,
+                        'hf_generate_kwargs': hf_generate_kwargs,
+                        'diffusion_batch_size': diffusion_batch_size, 'diffusion_bucket_slack': diffusion_bucket_slack,
+                        # These change the random stream or numerics, and therefore the output for a given seed.
+                        'autoregressive_batch_size': self.autoregressive_batch_size, 'half': self.half,
+                        'kv_cache': self.kv_cache, 'prefix_cache': self.prefix_cache is not None,
+                        'models_dir': self.models_dir, 'device': self.device.type,
+                        'reuse_ar_latents': self.reuse_ar_latents,
+                        # Redaction works on the raw text rather than the tokens.
+                        'redacted_text': text if self.enable_redaction and '[' in text else None}
+            cache_key = make_cache_key(encoded_text, hash_voice(voice_samples, conditioning_latents), settings,
+                                       deterministic_seed)
+            res = self.result_cache.get(cache_key)
+            count(self.hooks, 'cache_hits' if res is not None else 'cache_misses')
+            if res is not None:
+                self.last_search_stats = None
+                if verbose:
+                    print("Found result in synthesis cache.")
+                if return_deterministic_state:
+                    return res, (deterministic_seed, text, voice_samples, conditioning_latents)
+                return res
+
+        text_tokens = torch.IntTensor(encoded_text).unsqueeze(0).to(self.device)
         text_tokens = F.pad(text_tokens, (0, 1))  # This may not be necessary.
         assert text_tokens.shape[-1] < 400, 'Too much text provided. Break the text up into separate segments and re-try inference.'
         auto_conds = None
-        if voice_samples is not None:
-            auto_conditioning, diffusion_conditioning, auto_conds, _ = self.get_conditioning_latents(voice_samples, return_mels=True)
-        elif conditioning_latents is not None:
-            auto_conditioning, diffusion_conditioning = conditioning_latents
-        else:
-            auto_conditioning, diffusion_conditioning = self.get_random_conditioning_latents()
-        auto_conditioning = auto_conditioning.to(self.device)
-        diffusion_conditioning = diffusion_conditioning.to(self.device)
+        with timed_stage(self.hooks, 'conditioning', self.device):
+            if voice_samples is not None:
+                auto_conditioning, diffusion_conditioning, auto_conds, _ = self.get_conditioning_latents(voice_samples, return_mels=True)
+            elif conditioning_latents is not None:
+                auto_conditioning, diffusion_conditioning = conditioning_latents
+            else:
+                auto_conditioning, diffusion_conditioning = self.get_random_conditioning_latents()
+            auto_conditioning = auto_conditioning.to(self.device)
+            diffusion_conditioning = diffusion_conditioning.to(self.device)
+
+        diffuser = self.vocoder_diffuser(diffusion_iterations, cond_free, cond_free_k, diffusion_sampler)
 
-        diffuser = load_discrete_vocoder_diffuser(desired_diffusion_steps=diffusion_iterations, cond_free=cond_free, cond_free_k=cond_free_k)
+        latent_store = LatentStore(self.ar_latent_budget) if self.reuse_ar_latents else None
+        search = CandidateSearch(k, score_threshold, search_patience, search_time_budget)
 
         with torch.no_grad():
-            samples = []
             num_batches = num_autoregressive_samples // self.autoregressive_batch_size
             stop_mel_token = self.autoregressive.stop_mel_token
             calm_token = 83  # This is the token for coding silence, which is fixed in place with "fix_autoregressive_output"
-            if verbose:
-                print("Generating autoregressive samples..")
-            if not torch.backends.mps.is_available():
-                with self.temporary_cuda(self.autoregressive
-                ) as autoregressive, torch.autocast(device_type="cuda", dtype=torch.float16, enabled=self.half):
-                    for b in tqdm(range(num_batches), disable=not verbose):
-                        codes = autoregressive.inference_speech(auto_conditioning, text_tokens,
-                                                                    do_sample=True,
-                                                                    top_p=top_p,
-                                                                    temperature=temperature,
-                                                                    num_return_sequences=self.autoregressive_batch_size,
-                                                                    length_penalty=length_penalty,
-                                                                    repetition_penalty=repetition_penalty,
-                                                                    max_generate_length=max_mel_tokens,
-                                                                    **hf_generate_kwargs)
-                        padding_needed = max_mel_tokens - codes.shape[1]
-                        codes = F.pad(codes, (0, padding_needed), value=stop_mel_token)
-                        samples.append(codes)
+            if search.enabled:
+                best_indices, best_results = self.progressive_search(
+                    search, auto_conditioning, text_tokens, auto_conds, num_batches, latent_store, cvvp_amount, verbose,
+                    top_p=top_p, temperature=temperature, length_penalty=length_penalty,
+                    repetition_penalty=repetition_penalty, max_generate_length=max_mel_tokens, **hf_generate_kwargs)
             else:
-                with self.temporary_cuda(self.autoregressive) as autoregressive:
-                    for b in tqdm(range(num_batches), disable=not verbose):
-                        codes = autoregressive.inference_speech(auto_conditioning, text_tokens,
-                                                                    do_sample=True,
-                                                                    top_p=top_p,
-                                                                    temperature=temperature,
-                                                                    num_return_sequences=self.autoregressive_batch_size,
-                                                                    length_penalty=length_penalty,
-                                                                    repetition_penalty=repetition_penalty,
-                                                                    max_generate_length=max_mel_tokens,
-                                                                    **hf_generate_kwargs)
-                        padding_needed = max_mel_tokens - codes.shape[1]
-                        codes = F.pad(codes, (0, padding_needed), value=stop_mel_token)
-                        samples.append(codes)
-
-            clip_results = []
+                samples = []
+                if verbose:
+                    print("Generating autoregressive samples..")
+                if not torch.backends.mps.is_available():
+                    with timed_stage(self.hooks, 'autoregressive', self.device), self.placement.use(self.autoregressive
+                    ) as autoregressive, torch.autocast(device_type="cuda", dtype=torch.float16, enabled=self.half):
+                        for b in tqdm(range(num_batches), disable=not verbose):
+                            codes = autoregressive.inference_speech(auto_conditioning, text_tokens,
+                                                                        do_sample=True,
+                                                                        top_p=top_p,
+                                                                        temperature=temperature,
+                                                                        num_return_sequences=self.autoregressive_batch_size,
+                                                                        length_penalty=length_penalty,
+                                                                        repetition_penalty=repetition_penalty,
+                                                                        max_generate_length=max_mel_tokens,
+                                                                        return_latents=latent_store is not None,
+                                                                        **hf_generate_kwargs)
+                            if latent_store is not None:
+                                codes, sampled_latents = codes
+                                latent_store.add_batch(sampled_latents, codes.shape[0])
+                            count(self.hooks, 'tokens_generated', codes.numel())
+                            padding_needed = max_mel_tokens - codes.shape[1]
+                            codes = F.pad(codes, (0, padding_needed), value=stop_mel_token)
+                            samples.append(codes)
+                else:
+                    with timed_stage(self.hooks, 'autoregressive', self.device), self.placement.use(self.autoregressive) as autoregressive:
+                        for b in tqdm(range(num_batches), disable=not verbose):
+                            codes = autoregressive.inference_speech(auto_conditioning, text_tokens,
+                                                                        do_sample=True,
+                                                                        top_p=top_p,
+                                                                        temperature=temperature,
+                                                                        num_return_sequences=self.autoregressive_batch_size,
+                                                                        length_penalty=length_penalty,
+                                                                        repetition_penalty=repetition_penalty,
+                                                                        max_generate_length=max_mel_tokens,
+                                                                        return_latents=latent_store is not None,
+                                                                        **hf_generate_kwargs)
+                            if latent_store is not None:
+                                codes, sampled_latents = codes
+                                latent_store.add_batch(sampled_latents, codes.shape[0])
+                            count(self.hooks, 'tokens_generated', codes.numel())
+                            padding_needed = max_mel_tokens - codes.shape[1]
+                            codes = F.pad(codes, (0, padding_needed), value=stop_mel_token)
+                            samples.append(codes)
+
+                clip_results = []
             
-            if not torch.backends.mps.is_available():
-                with self.temporary_cuda(self.clvp) as clvp, torch.autocast(
-                    device_type="cuda" if not torch.backends.mps.is_available() else 'mps', dtype=torch.float16, enabled=self.half
-                ):
-                    if cvvp_amount > 0:
-                        if self.cvvp is None:
-                            self.load_cvvp()
-                        self.cvvp = self.cvvp.to(self.device)
-                    if verbose:
-                        if self.cvvp is None:
-                            print("Computing best candidates using CLVP")
-                        else:
-                            print(f"Computing best candidates using CLVP {((1-cvvp_amount) * 100):2.0f}% and CVVP {(cvvp_amount * 100):2.0f}%")
-                    for batch in tqdm(samples, disable=not verbose):
-                        for i in range(batch.shape[0]):
-                            batch[i] = fix_autoregressive_output(batch[i], stop_mel_token)
-                        if cvvp_amount != 1:
-                            clvp_out = clvp(text_tokens.repeat(batch.shape[0], 1), batch, return_loss=False)
-                        if auto_conds is not None and cvvp_amount > 0:
-                            cvvp_accumulator = 0
-                            for cl in range(auto_conds.shape[1]):
-                                cvvp_accumulator = cvvp_accumulator + self.cvvp(auto_conds[:, cl].repeat(batch.shape[0], 1, 1), batch, return_loss=False)
-                            cvvp = cvvp_accumulator / auto_conds.shape[1]
-                            if cvvp_amount == 1:
-                                clip_results.append(cvvp)
+                if not torch.backends.mps.is_available():
+                    with timed_stage(self.hooks, 'clvp', self.device), self.placement.use(self.clvp) as clvp, torch.autocast(
+                        device_type="cuda" if not torch.backends.mps.is_available() else 'mps', dtype=torch.float16, enabled=self.half
+                    ):
+                        if cvvp_amount > 0:
+                            if self.cvvp is None:
+                                self.load_cvvp()
+                            self.placement.fetch(self.cvvp)
+                        if verbose:
+                            if self.cvvp is None:
+                                print("Computing best candidates using CLVP")
                             else:
-                                clip_results.append(cvvp * cvvp_amount + clvp_out * (1-cvvp_amount))
-                        else:
-                            clip_results.append(clvp_out)
-                    clip_results = torch.cat(clip_results, dim=0)
-                    samples = torch.cat(samples, dim=0)
-                    best_results = samples[torch.topk(clip_results, k=k).indices]
-            else:
-                with self.temporary_cuda(self.clvp) as clvp:
-                    if cvvp_amount > 0:
-                        if self.cvvp is None:
-                            self.load_cvvp()
-                        self.cvvp = self.cvvp.to(self.device)
-                    if verbose:
-                        if self.cvvp is None:
-                            print("Computing best candidates using CLVP")
-                        else:
-                            print(f"Computing best candidates using CLVP {((1-cvvp_amount) * 100):2.0f}% and CVVP {(cvvp_amount * 100):2.0f}%")
-                    for batch in tqdm(samples, disable=not verbose):
-                        for i in range(batch.shape[0]):
-                            batch[i] = fix_autoregressive_output(batch[i], stop_mel_token)
-                        if cvvp_amount != 1:
-                            clvp_out = clvp(text_tokens.repeat(batch.shape[0], 1), batch, return_loss=False)
-                        if auto_conds is not None and cvvp_amount > 0:
-                            cvvp_accumulator = 0
-                            for cl in range(auto_conds.shape[1]):
-                                cvvp_accumulator = cvvp_accumulator + self.cvvp(auto_conds[:, cl].repeat(batch.shape[0], 1, 1), batch, return_loss=False)
-                            cvvp = cvvp_accumulator / auto_conds.shape[1]
-                            if cvvp_amount == 1:
-                                clip_results.append(cvvp)
+                                print(f"Computing best candidates using CLVP {((1-cvvp_amount) * 100):2.0f}% and CVVP {(cvvp_amount * 100):2.0f}%")
+                        for batch in tqdm(samples, disable=not verbose):
+                            clip_results.append(self.score_candidates(clvp, text_tokens, batch, stop_mel_token, auto_conds, cvvp_amount))
+                            search.add(clip_results[-1], batch)
+                        clip_results = torch.cat(clip_results, dim=0)
+                        samples = torch.cat(samples, dim=0)
+                        best_indices = torch.topk(clip_results, k=k).indices
+                        best_results = samples[best_indices]
+                        count(self.hooks, 'samples_discarded', samples.shape[0] - k)
+                else:
+                    with timed_stage(self.hooks, 'clvp', self.device), self.placement.use(self.clvp) as clvp:
+                        if cvvp_amount > 0:
+                            if self.cvvp is None:
+                                self.load_cvvp()
+                            self.placement.fetch(self.cvvp)
+                        if verbose:
+                            if self.cvvp is None:
+                                print("Computing best candidates using CLVP")
                             else:
-                                clip_results.append(cvvp * cvvp_amount + clvp_out * (1-cvvp_amount))
-                        else:
-                            clip_results.append(clvp_out)
-                    clip_results = torch.cat(clip_results, dim=0)
-                    samples = torch.cat(samples, dim=0)
-                    best_results = samples[torch.topk(clip_results, k=k).indices]
-            if self.cvvp is not None:
-                self.cvvp = self.cvvp.cpu()
-            del samples
+                                print(f"Computing best candidates using CLVP {((1-cvvp_amount) * 100):2.0f}% and CVVP {(cvvp_amount * 100):2.0f}%")
+                        for batch in tqdm(samples, disable=not verbose):
+                            clip_results.append(self.score_candidates(clvp, text_tokens, batch, stop_mel_token, auto_conds, cvvp_amount))
+                            search.add(clip_results[-1], batch)
+                        clip_results = torch.cat(clip_results, dim=0)
+                        samples = torch.cat(samples, dim=0)
+                        best_indices = torch.topk(clip_results, k=k).indices
+                        best_results = samples[best_indices]
+                        count(self.hooks, 'samples_discarded', samples.shape[0] - k)
+                if cvvp_amount > 0:
+                    self.placement.release(self.cvvp)
+                del samples
+            self.last_search_stats = search.stats(num_batches * self.autoregressive_batch_size)
+            count(self.hooks, 'samples_skipped', num_batches * self.autoregressive_batch_size - search.samples)
+            if verbose and search.enabled:
+                print(f"Candidate search stopped ({self.last_search_stats['stop_reason']}) after {search.samples} of "
+                      f"{num_batches * self.autoregressive_batch_size} samples")
 
             # The diffusion model actually wants the last hidden layer from the autoregressive model as conditioning
             # inputs. Re-produce those for the top results. This could be made more efficient by storing all of these
-            # results, but will increase memory usage.
-            if not torch.backends.mps.is_available():
-                with self.temporary_cuda(
-                    self.autoregressive
-                ) as autoregressive, torch.autocast(
-                    device_type="cuda" if not torch.backends.mps.is_available() else 'mps', dtype=torch.float16, enabled=self.half
-                ):
-                    best_latents = autoregressive(auto_conditioning.repeat(k, 1), text_tokens.repeat(k, 1),
-                                                    torch.tensor([text_tokens.shape[-1]], device=text_tokens.device), best_results,
-                                                    torch.tensor([best_results.shape[-1]*self.autoregressive.mel_length_compression], device=text_tokens.device),
-                                                    return_latent=True, clip_inputs=False)
-                    del auto_conditioning
-            else:
-                with self.temporary_cuda(
-                    self.autoregressive
-                ) as autoregressive:
-                    best_latents = autoregressive(auto_conditioning.repeat(k, 1), text_tokens.repeat(k, 1),
-                                                    torch.tensor([text_tokens.shape[-1]], device=text_tokens.device), best_results,
-                                                    torch.tensor([best_results.shape[-1]*self.autoregressive.mel_length_compression], device=text_tokens.device),
-                                                    return_latent=True, clip_inputs=False)
-                    del auto_conditioning
+            # results, but will increase memory usage; that is what reuse_ar_latents does.
+            best_latents = None
+            if latent_store is not None:
+                best_latents = self.stored_latents(latent_store, best_indices, best_results, calm_token)
+                latent_store.clear()
+            if best_latents is None:
+                if not torch.backends.mps.is_available():
+                    with timed_stage(self.hooks, 'latents', self.device), self.placement.use(
+                        self.autoregressive
+                    ) as autoregressive, torch.autocast(
+                        device_type="cuda" if not torch.backends.mps.is_available() else 'mps', dtype=torch.float16, enabled=self.half
+                    ):
+                        best_latents = autoregressive(auto_conditioning.repeat(k, 1), text_tokens.repeat(k, 1),
+                                                        torch.tensor([text_tokens.shape[-1]], device=text_tokens.device), best_results,
+                                                        torch.tensor([best_results.shape[-1]*self.autoregressive.mel_length_compression], device=text_tokens.device),
+                                                        return_latent=True, clip_inputs=False)
+                        del auto_conditioning
+                else:
+                    with timed_stage(self.hooks, 'latents', self.device), self.placement.use(
+                        self.autoregressive
+                    ) as autoregressive:
+                        best_latents = autoregressive(auto_conditioning.repeat(k, 1), text_tokens.repeat(k, 1),
+                                                        torch.tensor([text_tokens.shape[-1]], device=text_tokens.device), best_results,
+                                                        torch.tensor([best_results.shape[-1]*self.autoregressive.mel_length_compression], device=text_tokens.device),
+                                                        return_latent=True, clip_inputs=False)
+                        del auto_conditioning
 
             if verbose:
                 print("Transforming autoregressive outputs into audio..")
-            wav_candidates = []
-            if not torch.backends.mps.is_available():
-                with self.temporary_cuda(self.diffusion) as diffusion, self.temporary_cuda(
-                    self.vocoder
-                ) as vocoder:
-                    for b in range(best_results.shape[0]):
-                        codes = best_results[b].unsqueeze(0)
-                        latents = best_latents[b].unsqueeze(0)
-
-                        # Find the first occurrence of the "calm" token and trim the codes to that.
-                        ctokens = 0
-                        for k in range(codes.shape[-1]):
-                            if codes[0, k] == calm_token:
-                                ctokens += 1
-                            else:
-                                ctokens = 0
-                            if ctokens > 8:  # 8 tokens gives the diffusion model some "breathing room" to terminate speech.
-                                latents = latents[:, :k]
-                                break
-                        mel = do_spectrogram_diffusion(diffusion, diffuser, latents, diffusion_conditioning, temperature=diffusion_temperature, 
-                                                    verbose=verbose)
-                        wav = vocoder.inference(mel)
-                        wav_candidates.append(wav.cpu())
-            else:
-                diffusion, vocoder = self.diffusion, self.vocoder
-                diffusion_conditioning = diffusion_conditioning.cpu()
-                for b in range(best_results.shape[0]):
-                    codes = best_results[b].unsqueeze(0).cpu()
-                    latents = best_latents[b].unsqueeze(0).cpu()
-
-                    # Find the first occurrence of the "calm" token and trim the codes to that.
-                    ctokens = 0
-                    for k in range(codes.shape[-1]):
-                        if codes[0, k] == calm_token:
-                            ctokens += 1
-                        else:
-                            ctokens = 0
-                        if ctokens > 8:  # 8 tokens gives the diffusion model some "breathing room" to terminate speech.
-                            latents = latents[:, :k]
-                            break
-                    mel = do_spectrogram_diffusion(diffusion, diffuser, latents, diffusion_conditioning, temperature=diffusion_temperature, 
-                                                verbose=verbose)
-                    wav = vocoder.inference(mel)
-                    wav_candidates.append(wav.cpu())
+            # Find the first occurrence of the "calm" token and trim the codes to that.
+            trims = calm_trim_points(best_results, calm_token)
+            wav_candidates = self.decode_candidates([best_latents[b][:trims[b]] for b in range(best_results.shape[0])],
+                                                    diffusion_conditioning, diffuser, diffusion_temperature,
+                                                    diffusion_batch_size, diffusion_bucket_slack, verbose)
 
             def potentially_redact(clip, text):
-                if self.enable_redaction:
+                # The aligner is only loaded for text that has something to redact.
+                if self.enable_redaction and '[' in text:
                     return self.aligner.redact(clip.squeeze(1), text).unsqueeze(1)
                 return clip
-            wav_candidates = [potentially_redact(wav_candidate, text) for wav_candidate in wav_candidates]
+            with timed_stage(self.hooks if self.enable_redaction else None, 'redaction', self.device):
+                wav_candidates = [potentially_redact(wav_candidate, text) for wav_candidate in wav_candidates]
 
             if len(wav_candidates) > 1:
                 res = wav_candidates
             else:
                 res = wav_candidates[0]
 
+            if cache_key is not None:
+                self.result_cache.put(cache_key, res)
+
             if return_deterministic_state:
                 return res, (deterministic_seed, text, voice_samples, conditioning_latents)
             else:
                 return res
+    def tts_batch(self, texts, voice_samples=None, conditioning_latents=None, k=1, verbose=True, use_deterministic_seed=None,
+                  return_deterministic_state=False,
+                  # autoregressive generation parameters follow
+                  num_autoregressive_samples=512, temperature=.8, length_penalty=1, repetition_penalty=2.0, top_p=.8, max_mel_tokens=500,
+                  # CVVP parameters follow
+                  cvvp_amount=.0,
+                  # diffusion generation parameters follow
+                  diffusion_iterations=100, cond_free=True, cond_free_k=2, diffusion_temperature=1.0, diffusion_sampler='p',
+                  # batching parameters follow
+                  diffusion_batch_size=4, diffusion_bucket_slack=64,
+                  **hf_generate_kwargs):
+        """
+        Produces audio for several texts spoken by the same voice, batching every stage across texts instead of calling
+        tts() once per text. Takes the same parameters as tts(); diffusion_batch_size and diffusion_bucket_slack apply
+        across the candidates of all texts.
+        :return: A list with, for every text, what tts() would return for it.
+
+        Texts are sorted by length and sampled together: each autoregressive call holds up to autoregressive_batch_size
+        texts (fewer when there are fewer texts) with autoregressive_batch_size // texts samples of each (at least one),
+        until every text has num_autoregressive_samples. Shorter texts are right-padded and the padding is masked out of
+        attention, so each text is conditioned exactly as in tts(). CLVP still ranks the candidates of each text
+        separately. Results are not cached, and for a given seed they differ from those of tts() because the random
+        stream is shared by the batch.
+        """
+        deterministic_seed = self.deterministic_state(seed=use_deterministic_seed)
+
+        with timed_stage(self.hooks, 'tokenization'):
+            encoded_texts = [self.tokenizer.encode(text) for text in texts]
+        for encoded_text in encoded_texts:
+            assert len(encoded_text) + 1 < 400, 'Too much text provided. Break the text up into separate segments and re-try inference.'
+
+        auto_conds = None
+        with timed_stage(self.hooks, 'conditioning', self.device):
+            if voice_samples is not None:
+                auto_conditioning, diffusion_conditioning, auto_conds, _ = self.get_conditioning_latents(voice_samples, return_mels=True)
+            elif conditioning_latents is not None:
+                auto_conditioning, diffusion_conditioning = conditioning_latents
+            else:
+                auto_conditioning, diffusion_conditioning = self.get_random_conditioning_latents()
+            auto_conditioning = auto_conditioning.to(self.device)
+            diffusion_conditioning = diffusion_conditioning.to(self.device)
+
+        diffuser = self.vocoder_diffuser(diffusion_iterations, cond_free, cond_free_k, diffusion_sampler)
+
+        def autocast():
+            return torch.autocast(device_type="cuda", dtype=torch.float16, enabled=self.half and not torch.backends.mps.is_available())
+
+        # Each generate() call samples up to `per_text` sequences for each of up to `texts_per_call` texts, so that a
+        # call holds about autoregressive_batch_size sequences. Every text ends in the two stop tokens tts() gives it;
+        # the right padding after them is masked out of attention by inference_speech (text_lengths).
+        texts_per_call = max(1, min(len(texts), self.autoregressive_batch_size))
+        per_text = max(1, self.autoregressive_batch_size // texts_per_call)
+        by_length = sorted(range(len(texts)), key=lambda i: len(encoded_texts[i]))
+        groups = [by_length[i:i + texts_per_call] for i in range(0, len(by_length), texts_per_call)]
+        stop_text_token = self.autoregressive.stop_text_token
+        group_tokens = []
+        for group in groups:
+            tokens = pad_sequence([torch.IntTensor(encoded_texts[i] + [stop_text_token] * 2) for i in group],
+                                  batch_first=True, padding_value=stop_text_token)
+            lengths = torch.tensor([len(encoded_texts[i]) + 2 for i in group])
+            group_tokens.append((tokens.to(self.device), lengths.to(self.device)))
+
+        with torch.no_grad():
+            stop_mel_token = self.autoregressive.stop_mel_token
+            calm_token = 83  # This is the token for coding silence, which is fixed in place with "fix_autoregressive_output"
+            samples = [[] for _ in texts]
+            if verbose:
+                print(f"Generating autoregressive samples for {len(texts)} texts in {len(groups)} groups..")
+            with timed_stage(self.hooks, 'autoregressive', self.device), self.placement.use(self.autoregressive) as autoregressive, autocast():
+                for group, (tokens, lengths) in tqdm(list(zip(groups, group_tokens)), disable=not verbose):
+                    for drawn in range(0, num_autoregressive_samples, per_text):
+                        n = min(per_text, num_autoregressive_samples - drawn)
+                        codes = autoregressive.inference_speech(auto_conditioning.repeat(len(group), 1), tokens,
+                                                                text_lengths=lengths,
+                                                                do_sample=True,
+                                                                top_p=top_p,
+                                                                temperature=temperature,
+                                                                num_return_sequences=n,
+                                                                length_penalty=length_penalty,
+                                                                repetition_penalty=repetition_penalty,
+                                                                max_generate_length=max_mel_tokens,
+                                                                **hf_generate_kwargs)
+                        count(self.hooks, 'tokens_generated', codes.numel())
+                        codes = F.pad(codes, (0, max_mel_tokens - codes.shape[1]), value=stop_mel_token)
+                        # generate() returns the sequences of each input row next to each other.
+                        for j, i in enumerate(group):
+                            samples[i].append(codes[j * n:(j + 1) * n])
+
+            best_results = []
+            with timed_stage(self.hooks, 'clvp', self.device), self.placement.use(self.clvp) as clvp, autocast():
+                if cvvp_amount > 0:
+                    if self.cvvp is None:
+                        self.load_cvvp()
+                    self.placement.fetch(self.cvvp)
+                if verbose:
+                    print("Computing best candidates using CLVP")
+                for i, encoded_text in enumerate(tqdm(encoded_texts, disable=not verbose)):
+                    text_tokens = F.pad(torch.IntTensor(encoded_text).unsqueeze(0).to(self.device), (0, 1))
+                    clip_results = torch.cat([self.score_candidates(clvp, text_tokens, batch, stop_mel_token, auto_conds, cvvp_amount)
+                                              for batch in samples[i]], dim=0)
+                    candidates = torch.cat(samples[i], dim=0)
+                    best_results.append(candidates[torch.topk(clip_results, k=k).indices])
+                    count(self.hooks, 'samples_discarded', candidates.shape[0] - k)
+                if cvvp_amount > 0:
+                    self.placement.release(self.cvvp)
+            del samples
+
+            # Latents of the selected candidates, recomputed per text with its unpadded tokens, as tts() does.
+            best_latents = []
+            with timed_stage(self.hooks, 'latents', self.device), self.placement.use(self.autoregressive) as autoregressive, autocast():
+                for encoded_text, codes in zip(encoded_texts, best_results):
+                    text_tokens = F.pad(torch.IntTensor(encoded_text).unsqueeze(0).to(self.device), (0, 1))
+                    best_latents.append(autoregressive(auto_conditioning.repeat(k, 1), text_tokens.repeat(k, 1),
+                                                       torch.tensor([text_tokens.shape[-1]], device=text_tokens.device), codes,
+                                                       torch.tensor([codes.shape[-1]*self.autoregressive.mel_length_compression], device=text_tokens.device),
+                                                       return_latent=True, clip_inputs=False))
+
+            # Trim every selected candidate at its calm tokens, like tts() does, and diffuse them in length buckets.
+            latents = []
+            for i in range(len(texts)):
+                trims = calm_trim_points(best_results[i], calm_token)
+                latents.extend(best_latents[i][c][:trims[c]] for c in range(k))
+            wavs = self.decode_candidates(latents, diffusion_conditioning, diffuser, diffusion_temperature,
+                                          diffusion_batch_size, diffusion_bucket_slack, verbose)
+            wav_candidates = [wavs[i * k:(i + 1) * k] for i in range(len(texts))]
+
+            results = []
+            with timed_stage(self.hooks if self.enable_redaction else None, 'redaction', self.device):
+                for text, candidates in zip(texts, wav_candidates):
+                    if self.enable_redaction and '[' in text:
+                        candidates = [self.aligner.redact(wav.squeeze(1), text).unsqueeze(1) for wav in candidates]
+                    results.append(candidates if len(candidates) > 1 else candidates[0])
+
+            if return_deterministic_state:
+                return results, (deterministic_seed, texts, voice_samples, conditioning_latents)
+            return results
+
+    def progressive_search(self, search, auto_conditioning, text_tokens, auto_conds, num_batches, latent_store,
+                           cvvp_amount=.0, verbose=True, max_generate_length=500, **generate_kwargs):
+        """
+        Draws batches of autoregressive samples and scores each one with CLVP right away, until `search` (a
+        CandidateSearch) stops or num_batches have been drawn. Returns the indices and codes of the chosen candidates.
+        """
+        stop_mel_token = self.autoregressive.stop_mel_token
+        ar_timer = StageTimer(self.hooks, 'autoregressive', self.device)
+        clvp_timer = StageTimer(self.hooks, 'clvp', self.device)
+        if cvvp_amount > 0 and self.cvvp is None:
+            self.load_cvvp()
+        if verbose:
+            print("Generating autoregressive samples and scoring them with CLVP..")
+        with self.placement.use(self.autoregressive) as autoregressive, self.placement.use(self.clvp) as clvp, \
+                self.placement.use(self.cvvp) if cvvp_amount > 0 else nullcontext(), torch.autocast(
+                    device_type="cuda", dtype=torch.float16, enabled=self.half and not torch.backends.mps.is_available()):
+            for b in tqdm(range(num_batches), disable=not verbose):
+                with ar_timer:
+                    codes = autoregressive.inference_speech(auto_conditioning, text_tokens, do_sample=True,
+                                                            num_return_sequences=self.autoregressive_batch_size,
+                                                            max_generate_length=max_generate_length,
+                                                            return_latents=latent_store is not None, **generate_kwargs)
+                    if latent_store is not None:
+                        codes, sampled_latents = codes
+                        latent_store.add_batch(sampled_latents, codes.shape[0])
+                    count(self.hooks, 'tokens_generated', codes.numel())
+                    codes = F.pad(codes, (0, max_generate_length - codes.shape[1]), value=stop_mel_token)
+                with clvp_timer:
+                    search.add(self.score_candidates(clvp, text_tokens, codes, stop_mel_token, auto_conds, cvvp_amount),
+                               codes)
+                if search.should_stop():
+                    break
+        ar_timer.report()
+        clvp_timer.report()
+        count(self.hooks, 'samples_discarded', search.samples - search.k)
+        best_indices, best_results, _ = search.best()
+        return best_indices, best_results
+
+    def decode_candidates(self, latents, diffusion_conditioning, diffuser, temperature=1.0, batch_size=4, slack=None,
+                          verbose=True):
+        """
+        Turns the autoregressive latents (S,D) of the selected candidates into waveforms, diffusing and vocoding them in
+        length buckets (see do_spectrogram_diffusion_batch). Returns one (1,1,samples) CPU waveform per latent.
+        """
+        buckets = length_buckets([lat.shape[0] for lat in latents], batch_size, slack)
+        if not torch.backends.mps.is_available():
+            diffusion_context = self.placement.use(self.diffusion), self.placement.use(self.vocoder)
+            device = self.device
+        else:
+            # Diffusion and vocoding run on the CPU here.
+            diffusion_context = nullcontext(self.placement.offload(self.diffusion)), nullcontext(self.placement.offload(self.vocoder))
+            device = None
+            diffusion_conditioning = diffusion_conditioning.cpu()
+        wavs = [None] * len(latents)
+        with diffusion_context[0] as diffusion, diffusion_context[1] as vocoder:
+            for bucket in buckets:
+                with timed_stage(self.hooks, 'diffusion', device):
+                    mels = do_spectrogram_diffusion_batch(diffusion, diffuser,
+                                                          [latents[i].to(diffusion_conditioning.device) for i in bucket],
+                                                          diffusion_conditioning, temperature=temperature, verbose=verbose)
+                with timed_stage(self.hooks, 'vocoder', device):
+                    for i, wav in zip(bucket, vocode_batch(vocoder, mels)):
+                        wavs[i] = wav.cpu()
+        return wavs
+
+    def score_candidates(self, clvp, text_tokens, codes, stop_mel_token, auto_conds=None, cvvp_amount=.0):
+        """
+        Fixes up a batch of sampled codes in place (see fix_autoregressive_output) and returns their CLVP score, blended
+        with the CVVP score when cvvp_amount > 0. The models must already be on the device.
+        """
+        fix_autoregressive_codes(codes, stop_mel_token)
+        if cvvp_amount != 1:
+            clvp_out = clvp(text_tokens.repeat(codes.shape[0], 1), codes, return_loss=False)
+        if auto_conds is not None and cvvp_amount > 0:
+            cvvp_accumulator = 0
+            for cl in range(auto_conds.shape[1]):
+                cvvp_accumulator = cvvp_accumulator + self.cvvp(auto_conds[:, cl].repeat(codes.shape[0], 1, 1), codes, return_loss=False)
+            cvvp = cvvp_accumulator / auto_conds.shape[1]
+            if cvvp_amount == 1:
+                return cvvp
+            return cvvp * cvvp_amount + clvp_out * (1-cvvp_amount)
+        return clvp_out
+
+    def stored_latents(self, latent_store, indices, codes, calm_token):
+        """
+        Latents of the chosen candidates from `latent_store`, already cut at their calm-token trim point, or None if
+        any of them has to be recomputed.
+        """
+        latents = []
+        for index, trim in zip(indices.tolist(), calm_trim_points(codes, calm_token)):
+            stored = latent_store.get(index)
+            if stored is None or trim is None or stored.shape[0] < trim:
+                return None
+            latents.append(stored[:trim])
+        count(self.hooks, 'latents_reused', len(latents))
+        return latents
+
     def deterministic_state(self, seed=None):
         """
         Sets the random seeds that tortoise uses to the current time() and returns that seed so results can be
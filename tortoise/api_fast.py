@@ -22,6 +22,7 @@ from tortoise.models.vocoder import UnivNetGenerator
 from tortoise.utils.audio import wav_to_univnet_mel, denormalize_tacotron_mel
 from tortoise.utils.diffusion import SpacedDiffusion, space_timesteps, get_named_beta_schedule
 from tortoise.utils.tokenizer import VoiceBpeTokenizer
+from tortoise.utils.codes import fix_autoregressive_codes
 from tortoise.utils.wav2vec_alignment import Wav2VecAlignment
 from contextlib import contextmanager
 from tortoise.models.stream_generator import init_stream_support
@@ -92,25 +93,10 @@ def fix_autoregressive_output(codes, stop_token, complain=True):
     and copying out the last few codes.
 
     Failing to do this padding will produce speech with a harsh end that sounds like "BLAH" or similar.
-    """
-    # Strip off the autoregressive stop token and add padding.
-    stop_token_indices = (codes == stop_token).nonzero()
-    if len(stop_token_indices) == 0:
-        if complain:
-            print("No stop tokens found in one of the generated voice clips. This typically means the spoken audio is "
-                  "too long. In some cases, the output will still be good, though. Listen to it and if it is missing words, "
-                  "try breaking up your input text.")
-        return codes
-    else:
-        codes[stop_token_indices] = 83
-    stm = stop_token_indices.min().item()
-    codes[stm:] = 83
-    if stm - 3 < codes.shape[0]:
-        codes[-3] = 45
-        codes[-2] = 45
-        codes[-1] = 248
 
-    return codes
+    Works on a single clip (1D); see tortoise.utils.codes.fix_autoregressive_codes for whole batches.
+    """
+    return fix_autoregressive_codes(codes.unsqueeze(0), stop_token, complain=complain).squeeze(0)
 
 
 def do_spectrogram_diffusion(diffusion_model, diffuser, latents, conditioning_latents, temperature=1, verbose=True):
@@ -177,7 +163,7 @@ class TextToSpeech:
 
     def __init__(self, autoregressive_batch_size=None, models_dir=MODELS_DIR, 
                  enable_redaction=True, kv_cache=False, use_deepspeed=False, half=False, device=None,
-                 tokenizer_vocab_file=None, tokenizer_basic=False):
+                 tokenizer_vocab_file=None, tokenizer_basic=False, prefix_cache=None):
 
         """
         Constructor
@@ -189,6 +175,11 @@ class TextToSpeech:
                                  (but are still rendered by the model). This can be used for prompt engineering.
                                  Default is true.
         :param device: Device to use when running the model. If omitted, the device will be automatically chosen.
+        :param kv_cache: Reuse the attention keys/values of earlier tokens while sampling. 'static' keeps them in a
+                         cache preallocated for the whole generation instead of growing it every token.
+        :param prefix_cache: Optional tortoise.utils.prefix_cache.PrefixCache (requires kv_cache). Prompts of
+                             voice + text that were sampled from before are restored from it instead of being run
+                             through the autoregressive model again.
         """
         self.models_dir = models_dir
         self.autoregressive_batch_size = pick_best_batch_size_for_gpu() if autoregressive_batch_size is None else autoregressive_batch_size
@@ -214,6 +205,7 @@ class TextToSpeech:
                                           train_solo_embeddings=False).to(self.device).eval()
             self.autoregressive.load_state_dict(torch.load(get_model_path('autoregressive.pth', models_dir)), strict=False)
             self.autoregressive.post_init_gpt2_config(use_deepspeed=use_deepspeed, kv_cache=kv_cache, half=self.half)
+            self.autoregressive.inference_model.prefix_cache = prefix_cache
 
         self.hifi_decoder = HifiganGenerator(in_channels=1024, out_channels = 1, resblock_type = "1",
         resblock_dilation_sizes = [[1, 3, 5], [1, 3, 5], [1, 3, 5]], resblock_kernel_sizes = [3, 7, 11],
@@ -294,7 +286,7 @@ class TextToSpeech:
 
 
     def tts_stream(self, text, voice_samples=None, conditioning_latents=None, k=1, verbose=True, use_deterministic_seed=None,
-            return_deterministic_state=False, overlap_wav_len=1024, stream_chunk_size=40,
+            return_deterministic_state=False, overlap_wav_len=1024, stream_chunk_size=40, vocoder_context=16,
             # autoregressive generation parameters follow
             num_autoregressive_samples=512, temperature=.8, length_penalty=1, repetition_penalty=2.0, top_p=.8, max_mel_tokens=500,
             # CVVP parameters follow
@@ -311,6 +303,11 @@ class TextToSpeech:
                                      Conditioning latents can be retrieved via get_conditioning_latents().
         :param k: The number of returned clips. The most likely (as determined by Tortoises' CLVP model) clips are returned.
         :param verbose: Whether or not to print log messages indicating the progress of creating a clip. Default=true.
+        :param overlap_wav_len: Samples crossfaded between consecutive chunks.
+        :param stream_chunk_size: Number of autoregressive tokens per yielded chunk (the first chunk waits for at least 60).
+        :param vocoder_context: Vocoder frames decoded to the left of each chunk. Each chunk only vocodes its new latents
+                                plus this context instead of the whole utterance so far; 16 covers the HiFi-GAN receptive
+                                field.
         ~~AUTOREGRESSIVE KNOBS~~
         :param num_autoregressive_samples: Number of samples taken from the autoregressive model, all of which are filtered using CLVP.
                As Tortoise is a probabilistic model, more samples means a higher probability of creating something "great".
@@ -378,7 +375,7 @@ class TextToSpeech:
                 )
             all_latents = []
             codes_ = []
-            wav_gen_prev = None
+            decoded_len = 0  # Samples of the utterance vocoded so far.
             wav_overlap = None
             is_end = False
             first_buffer = 60
@@ -396,11 +393,13 @@ class TextToSpeech:
                 if is_end or (stream_chunk_size > 0 and len(codes_) >= max(stream_chunk_size, first_buffer)):
                     first_buffer = 0
                     gpt_latents = torch.cat(all_latents, dim=0)[None, :]
-                    wav_gen = self.hifi_decoder.inference(gpt_latents.to(self.device), auto_conditioning)
+                    # Only vocode from the start of the previous chunk's overlap on: everything before it was yielded.
+                    start = max(decoded_len - overlap_wav_len, 0)
+                    wav_gen = self.hifi_decoder.inference_window(gpt_latents.to(self.device), auto_conditioning, start,
+                                                                 context_frames=vocoder_context)
                     wav_gen = wav_gen.squeeze()
-                    wav_chunk, wav_gen_prev, wav_overlap = self.handle_chunks(
-                        wav_gen.squeeze(), wav_gen_prev, wav_overlap, overlap_wav_len
-                    )
+                    decoded_len = start + wav_gen.shape[0]
+                    wav_chunk, _, wav_overlap = self.handle_chunks(wav_gen, None, wav_overlap, overlap_wav_len)
                     codes_ = []
                     yield wav_chunk
     def tts(self, text, voice_samples=None, k=1, verbose=True, use_deterministic_seed=None,
@@ -2,10 +2,11 @@ import argparse
 import os
 
 import torch
-import torchaudio
 
 from api import TextToSpeech, MODELS_DIR
 from utils.audio import load_voices
+from utils.audio_encoders import FORMATS, output_filename, save_audio
+from utils.diffusion import SAMPLERS
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser()
@@ -13,10 +14,12 @@ if __name__ == '__main__':
     parser.add_argument('--voice', type=str, help='Selects the voice to use for generation. See options in voices/ directory (and add your own!) '
                                                  'Use the & character to join two voices together. Use a comma to perform inference on multiple voices.', default='random')
     parser.add_argument('--preset', type=str, help='Which voice preset to use.', default='fast')
+    parser.add_argument('--diffusion_sampler', type=str, help='Diffusion sampler, overriding the preset\'s.', choices=list(SAMPLERS), default=None)
     parser.add_argument('--use_deepspeed', type=str, help='Which voice preset to use.', default=False)
     parser.add_argument('--kv_cache', type=bool, help='If you disable this please wait for a long a time to get the output', default=True)
     parser.add_argument('--half', type=bool, help="float16(half) precision inference if True it's faster and take less vram and ram", default=True)
     parser.add_argument('--output_path', type=str, help='Where to store outputs.', default='results/')
+    parser.add_argument('--format', type=str, help='Output audio format.', choices=list(FORMATS), default='wav')
     parser.add_argument('--model_dir', type=str, help='Where to find pretrained model checkpoints. Tortoise automatically downloads these to .models, so this'
                                                       'should only be specified if you have custom checkpoints.', default=MODELS_DIR)
     parser.add_argument('--candidates', type=int, help='How many output candidates to produce per-voice.', default=3)
@@ -24,6 +27,9 @@ if __name__ == '__main__':
     parser.add_argument('--produce_debug_state', type=bool, help='Whether or not to produce debug_state.pth, which can aid in reproducing problems. Defaults to true.', default=True)
     parser.add_argument('--cvvp_amount', type=float, help='How much the CVVP model should influence the output.'
                                                           'Increasing this can in some cases reduce the likelihood of multiple speakers. Defaults to 0 (disabled)', default=.0)
+    parser.add_argument('--score_threshold', type=float, help='Stop sampling once the best candidates reach this CLVP score.', default=None)
+    parser.add_argument('--search_patience', type=int, help='Stop sampling once this many batches in a row did not improve the candidates.', default=None)
+    parser.add_argument('--search_time_budget', type=float, help='Seconds the autoregressive candidate search may take.', default=None)
     args = parser.parse_args()
     if torch.backends.mps.is_available():
         args.use_deepspeed = False
@@ -37,14 +43,17 @@ if __name__ == '__main__':
         else:
             voice_sel = [selected_voice]
         voice_samples, conditioning_latents = load_voices(voice_sel)
+        sampler_kwargs = {'diffusion_sampler': args.diffusion_sampler} if args.diffusion_sampler else {}
 
         gen, dbg_state = tts.tts_with_preset(args.text, k=args.candidates, voice_samples=voice_samples, conditioning_latents=conditioning_latents,
-                                  preset=args.preset, use_deterministic_seed=args.seed, return_deterministic_state=True, cvvp_amount=args.cvvp_amount)
+                                  preset=args.preset, use_deterministic_seed=args.seed, return_deterministic_state=True, cvvp_amount=args.cvvp_amount,
+                                  score_threshold=args.score_threshold, search_patience=args.search_patience,
+                                  search_time_budget=args.search_time_budget, **sampler_kwargs)
         if isinstance(gen, list):
             for j, g in enumerate(gen):
-                torchaudio.save(os.path.join(args.output_path, f'{selected_voice}_{k}_{j}.wav'), g.squeeze(0).cpu(), 24000)
+                save_audio(os.path.join(args.output_path, output_filename(f'{selected_voice}_{k}_{j}', args.format)), g.squeeze(0).cpu(), 24000, args.format)
         else:
-            torchaudio.save(os.path.join(args.output_path, f'{selected_voice}_{k}.wav'), gen.squeeze(0).cpu(), 24000)
+            save_audio(os.path.join(args.output_path, output_filename(f'{selected_voice}_{k}', args.format)), gen.squeeze(0).cpu(), 24000, args.format)
 
         if args.produce_debug_state:
             os.makedirs('debug_states', exist_ok=True)
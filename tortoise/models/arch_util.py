@@ -67,11 +67,12 @@ class QKVAttentionLegacy(nn.Module):
         )  # More stable with f16 than dividing afterwards
         if rel_pos is not None:
             weight = rel_pos(weight.reshape(bs, self.n_heads, weight.shape[-2], weight.shape[-1])).reshape(bs * self.n_heads, weight.shape[-2], weight.shape[-1])
-        weight = torch.softmax(weight.float(), dim=-1).type(weight.dtype)
         if mask is not None:
-            # The proper way to do this is to mask before the softmax using -inf, but that doesn't work properly on CPUs.
-            mask = mask.repeat(self.n_heads, 1).unsqueeze(1)
-            weight = weight * mask
+            # The proper way to do this is to mask before the softmax using -inf, but that doesn't work properly on CPUs;
+            # the lowest finite value does.
+            mask = mask.repeat_interleave(self.n_heads, dim=0).unsqueeze(1)
+            weight = weight.masked_fill_(mask == 0, torch.finfo(weight.dtype).min)
+        weight = torch.softmax(weight.float(), dim=-1).type(weight.dtype)
         a = torch.einsum("bts,bcs->bct", weight, v)
 
         return a.reshape(bs, -1, length)
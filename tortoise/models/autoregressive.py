@@ -7,6 +7,7 @@ from transformers import GPT2Config, GPT2PreTrainedModel, LogitsProcessorList
 from transformers.modeling_outputs import CausalLMOutputWithCrossAttentions
 from transformers.utils.model_parallel_utils import get_device_map, assert_device_map
 from tortoise.models.arch_util import AttentionBlock
+from tortoise.utils.prefix_cache import prefix_key
 from tortoise.utils.typical_sampling import TypicalLogitsWarper
 
 
@@ -32,7 +33,91 @@ class ResBlock(nn.Module):
         return F.relu(self.net(x) + x)
 
 
+def repeat_rows(x, rows):
+    """Repeats every batch row of a tensor (or of the tensors in a nested tuple) `rows` times, like repeat_interleave."""
+    if x is None or rows == 1:
+        return x
+    if isinstance(x, tuple):
+        return tuple(repeat_rows(t, rows) for t in x)
+    return x.repeat_interleave(rows, 0)
+
+
+class StaticKVCache:
+    """
+    Preallocated key/value cache for GPT2InferenceModel (kv_cache='static'). Every layer writes its keys and values
+    in place into fixed (batch, heads, max_length, head_dim) buffers and attends over the whole buffer under a
+    fixed-width mask, so a decoding step allocates nothing that depends on the current length and every step has
+    the same shapes (usable with CUDA graphs / torch.compile).
+    """
+    def __init__(self, layers, batch_size, heads, head_dim, max_length, device):
+        self.layers = layers
+        self.shape = (batch_size, heads, max_length, head_dim)
+        self.max_length = max_length
+        self.keys = None  # Allocated on the first write, in the dtype the attention produces (autocast or not).
+        self.values = None
+        self.positions = torch.arange(max_length, device=device)
+        self.valid = torch.zeros((batch_size, max_length), dtype=torch.bool, device=device)
+        self.length = 0
+
+    def __len__(self):
+        return self.length
+
+    def begin(self, num_tokens, attention_mask=None, rows=1):
+        """
+        Reserves the next num_tokens slots and returns the (batch, 1, num_tokens, max_length) mask of the keys
+        these tokens may attend to. attention_mask (batch, num_tokens) marks padding in the written tokens.
+        With rows > 1, the tokens are fed for every rows-th batch row only and are shared by the rows after it.
+        """
+        start, end = self.length, self.length + num_tokens
+        assert end <= self.max_length, f"Static KV cache is full ({self.max_length} positions)"
+        if attention_mask is None:
+            self.valid[:, start:end] = True
+        else:
+            self.valid[:, start:end] = repeat_rows(attention_mask.bool(), rows)
+        self.length = end
+        mask = self.valid[::rows, None, None, :]
+        if num_tokens > 1:
+            mask = mask & (self.positions[None, :] <= self.positions[start:end, None])
+        return mask
+
+    def update(self, layer, key, value):
+        """Writes the keys and values of the tokens reserved by the last begin() and returns the layer's buffers."""
+        if self.keys is None:
+            self.keys = key.new_zeros((self.layers,) + self.shape)
+            self.values = value.new_zeros((self.layers,) + self.shape)
+        rows = self.shape[0] // key.shape[0]
+        slots = self.positions[self.length - key.shape[-2]:self.length]
+        self.keys[layer].index_copy_(2, slots, repeat_rows(key.to(self.keys.dtype), rows))
+        self.values[layer].index_copy_(2, slots, repeat_rows(value.to(self.values.dtype), rows))
+        return self.keys[layer][::rows], self.values[layer][::rows]
+
+
+def static_cache_attention(attn, hidden_states, cache, layer, mask):
+    """Equivalent of GPT2Attention.forward (inference, self-attention only) on top of a StaticKVCache."""
+    query, key, value = attn.c_attn(hidden_states).split(attn.split_size, dim=2)
+    query = attn._split_heads(query, attn.num_heads, attn.head_dim)
+    key, value = cache.update(layer,
+                              attn._split_heads(key, attn.num_heads, attn.head_dim),
+                              attn._split_heads(value, attn.num_heads, attn.head_dim))
+    weights = torch.matmul(query, key.transpose(-1, -2))
+    if attn.scale_attn_weights:
+        weights = weights / (value.size(-1) ** 0.5)
+    if attn.scale_attn_by_inverse_layer_idx:
+        weights = weights / float(layer + 1)
+    weights = torch.where(mask, weights, torch.finfo(weights.dtype).min)
+    weights = F.softmax(weights, dim=-1).type(value.dtype)
+    output = attn._merge_heads(torch.matmul(weights, value), attn.num_heads, attn.head_dim)
+    return attn.c_proj(output)
+
+
 class GPT2InferenceModel(GPT2PreTrainedModel):
+    """
+    kv_cache: False recomputes the whole sequence for every token, True uses Hugging Face's past_key_values (grown
+              by concatenation on every step), 'static' uses a StaticKVCache sized by the `static_cache_length`
+              generate() kwarg (else config.n_positions).
+    prefix_cache: Optional tortoise.utils.prefix_cache.PrefixCache. With a kv_cache, prompts whose rows were all
+                  prefilled before are restored from it instead of being run again.
+    """
     def __init__(self, config, gpt, text_pos_emb, embeddings, norm, linear, kv_cache=False):
         super().__init__(config)
         self.transformer = gpt
@@ -41,6 +126,7 @@ class GPT2InferenceModel(GPT2PreTrainedModel):
         self.final_norm = norm
         self.lm_head = nn.Sequential(norm, linear)
         self.kv_cache = kv_cache
+        self.prefix_cache = None
         
         # Model parallel
         self.model_parallel = False
@@ -75,7 +161,9 @@ class GPT2InferenceModel(GPT2PreTrainedModel):
     def store_mel_emb(self, mel_emb):
         self.cached_mel_emb = mel_emb
 
-    def prepare_inputs_for_generation(self, input_ids, past_key_values=None, **kwargs):
+    def prepare_inputs_for_generation(self, input_ids, past_key_values=None, static_cache_length=None, **kwargs):
+        if self.kv_cache == 'static':
+            return self._prepare_static_inputs(input_ids, past_key_values, static_cache_length, **kwargs)
         token_type_ids = kwargs.get("token_type_ids", None)  # usually None
         if not self.kv_cache:
             past_key_values = None
@@ -105,6 +193,103 @@ class GPT2InferenceModel(GPT2PreTrainedModel):
             "token_type_ids": token_type_ids,
         }
 
+    def _prepare_static_inputs(self, input_ids, cache, static_cache_length=None, attention_mask=None, **kwargs):
+        if cache is None:
+            attn = self.transformer.h[0].attn
+            # generate() still samples one token when the prompt already reaches max_length.
+            max_length = max(static_cache_length or self.config.n_positions, input_ids.shape[1] + 1)
+            cache = StaticKVCache(len(self.transformer.h), input_ids.shape[0], attn.num_heads, attn.head_dim,
+                                  max_length, input_ids.device)
+        else:
+            # The mask of the cached positions lives in the cache; only the new token is fed.
+            input_ids = input_ids[:, -1:]
+            attention_mask = None
+        return {
+            "input_ids": input_ids,
+            "past_key_values": cache,
+            "attention_mask": attention_mask,
+        }
+
+    def _update_model_kwargs_for_generation(self, outputs, model_kwargs, *args, **kwargs):
+        if isinstance(outputs.past_key_values, StaticKVCache):
+            # Nothing grows: the cache already holds the keys, values and mask of every position.
+            model_kwargs["past_key_values"] = outputs.past_key_values
+            return model_kwargs
+        return super()._update_model_kwargs_for_generation(outputs, model_kwargs, *args, **kwargs)
+
+    def _shared_prefix_rows(self, input_ids, attention_mask):
+        """
+        Number of consecutive batch rows of a prompt that are copies of each other: generate() repeats every prompt
+        num_return_sequences times. With a key/value cache the prompt runs once per distinct row, and its keys,
+        values and outputs are repeated for the copies.
+        """
+        batch_size, cond_batch = input_ids.shape[0], self.cached_mel_emb.shape[0]
+        if not self.kv_cache or batch_size % cond_batch:
+            return 1
+        per_cond = batch_size // cond_batch
+        for rows in range(per_cond, 1, -1):
+            if per_cond % rows:
+                continue
+            inputs = [input_ids] if attention_mask is None else [input_ids, attention_mask]
+            if all(torch.equal(x.view(-1, rows, x.shape[1]), x[::rows, None].expand(-1, rows, -1)) for x in inputs):
+                return rows
+        return 1
+
+    def _prefix_keys(self, input_ids, emb, attention_mask, use_cache):
+        """PrefixCache keys of the rows of a prompt about to be prefilled, or None if it cannot be cached."""
+        if self.prefix_cache is None or not self.kv_cache or use_cache is False:
+            return None
+        if attention_mask is not None and not bool(attention_mask.all()):
+            return None  # Padded prompts are not cached.
+        return [prefix_key(e, ids) for e, ids in zip(emb, input_ids)]
+
+    def _store_prefix(self, keys, hidden_states, layers):
+        for i, key in enumerate(keys):
+            self.prefix_cache.put(key, (hidden_states[i],) + tuple(t[i] for kv in layers for t in kv))
+
+    def _restore_prefix(self, entries, past_key_values, attention_mask, rows, output_hidden_states, return_dict, device):
+        """Outputs of a prompt pass rebuilt from PrefixCache entries (one per prompt row)."""
+        hidden_states = torch.stack([entry[0] for entry in entries]).to(device)
+        layers = tuple(
+            (torch.stack([entry[1 + 2 * layer] for entry in entries]).to(device),
+             torch.stack([entry[2 + 2 * layer] for entry in entries]).to(device))
+            for layer in range(len(self.transformer.h))
+        )
+        if isinstance(past_key_values, StaticKVCache):
+            past_key_values.begin(hidden_states.shape[1], attention_mask, rows)
+            for layer, (key, value) in enumerate(layers):
+                past_key_values.update(layer, key, value)
+        else:
+            past_key_values = repeat_rows(layers, rows)
+        lm_logits = repeat_rows(self.lm_head(hidden_states), rows)
+        output_hidden_states = (
+            output_hidden_states if output_hidden_states is not None else self.config.output_hidden_states
+        )
+        # Only the final hidden states are cached, which is all that generation reads.
+        all_hidden_states = (repeat_rows(hidden_states, rows),) if output_hidden_states else None
+        if not return_dict:
+            return (lm_logits, past_key_values) + ((all_hidden_states,) if output_hidden_states else ())
+        return CausalLMOutputWithCrossAttentions(
+            loss=None,
+            logits=lm_logits,
+            past_key_values=past_key_values,
+            hidden_states=all_hidden_states,
+        )
+
+    def _static_forward(self, emb, cache, attention_mask, output_hidden_states, rows):
+        mask = cache.begin(emb.shape[1], attention_mask, rows)
+        hidden_states = self.transformer.drop(emb)
+        all_hidden_states = () if output_hidden_states else None
+        for layer, block in enumerate(self.transformer.h):
+            if output_hidden_states:
+                all_hidden_states = all_hidden_states + (hidden_states,)
+            hidden_states = hidden_states + static_cache_attention(block.attn, block.ln_1(hidden_states), cache, layer, mask)
+            hidden_states = hidden_states + block.mlp(block.ln_2(hidden_states))
+        hidden_states = self.transformer.ln_f(hidden_states)
+        if output_hidden_states:
+            all_hidden_states = all_hidden_states + (hidden_states,)
+        return hidden_states, all_hidden_states
+
     def forward(
         self,
         input_ids=None,
@@ -131,7 +316,15 @@ class GPT2InferenceModel(GPT2PreTrainedModel):
 
         # Create embedding
         mel_len = self.cached_mel_emb.shape[1]
+        rows = 1
         if input_ids.shape[1] != 1:
+            if not past_key_values:
+                rows = self._shared_prefix_rows(input_ids, attention_mask)
+            if rows > 1:
+                input_ids, attention_mask, position_ids, token_type_ids = (
+                    x[::rows] if x is not None else None
+                    for x in (input_ids, attention_mask, position_ids, token_type_ids)
+                )
             text_inputs = input_ids[:, mel_len:]
             text_emb = self.embeddings(text_inputs)
             text_emb = text_emb + self.text_pos_embedding(text_emb)
@@ -142,10 +335,41 @@ class GPT2InferenceModel(GPT2PreTrainedModel):
             else:  # this outcome only occurs once per loop in most cases
                 mel_emb = self.cached_mel_emb
             emb = torch.cat([mel_emb, text_emb], dim=1)
+            prefix_keys = None if past_key_values else self._prefix_keys(input_ids, emb, attention_mask, use_cache)
+            if prefix_keys is not None:
+                entries = [self.prefix_cache.get(key) for key in prefix_keys]
+                if all(entry is not None for entry in entries):
+                    return self._restore_prefix(entries, past_key_values, attention_mask, rows, output_hidden_states,
+                                                return_dict, emb.device)
         else:
+            prefix_keys = None
             emb = self.embeddings(input_ids)
+            seq_len = len(past_key_values) + 1 if isinstance(past_key_values, StaticKVCache) else attention_mask.shape[1]
             emb = emb + self.text_pos_embedding.get_fixed_embedding(
-                attention_mask.shape[1] - mel_len, attention_mask.device
+                seq_len - mel_len, input_ids.device
+            )
+        if isinstance(past_key_values, StaticKVCache):
+            output_hidden_states = (
+                output_hidden_states if output_hidden_states is not None else self.config.output_hidden_states
+            )
+            hidden_states, all_hidden_states = self._static_forward(
+                emb, past_key_values, attention_mask, output_hidden_states, rows
+            )
+            if prefix_keys is not None:
+                seq_len = emb.shape[1]
+                self._store_prefix(prefix_keys, hidden_states, [
+                    (past_key_values.keys[layer][::rows, :, :seq_len], past_key_values.values[layer][::rows, :, :seq_len])
+                    for layer in range(len(self.transformer.h))
+                ])
+            lm_logits = repeat_rows(self.lm_head(hidden_states), rows)
+            all_hidden_states = repeat_rows(all_hidden_states, rows)
+            if not return_dict:
+                return (lm_logits, past_key_values) + ((all_hidden_states,) if output_hidden_states else ())
+            return CausalLMOutputWithCrossAttentions(
+                loss=None,
+                logits=lm_logits,
+                past_key_values=past_key_values,
+                hidden_states=all_hidden_states,
             )
         transformer_outputs = self.transformer(
             inputs_embeds=emb,
@@ -162,6 +386,8 @@ class GPT2InferenceModel(GPT2PreTrainedModel):
             return_dict=return_dict,
         )
         hidden_states = transformer_outputs[0]
+        if prefix_keys is not None:
+            self._store_prefix(prefix_keys, hidden_states, transformer_outputs[1])
 
         # Set device for model parallelism
         if self.model_parallel:
@@ -172,6 +398,13 @@ class GPT2InferenceModel(GPT2PreTrainedModel):
             hidden_states = hidden_states.to(self.lm_head.weight.device)
 
         lm_logits = self.lm_head(hidden_states)
+        if rows > 1:
+            lm_logits = repeat_rows(lm_logits, rows)
+            if return_dict:
+                for key, value in transformer_outputs.items():
+                    transformer_outputs[key] = repeat_rows(value, rows)
+            else:
+                transformer_outputs = repeat_rows(transformer_outputs, rows)
 
         if not return_dict:
             return (lm_logits,) + transformer_outputs[1:]
@@ -510,16 +743,23 @@ class UnifiedVoice(nn.Module):
         loss_text = F.cross_entropy(text_logits, text_targets.long())
         loss_mel = F.cross_entropy(mel_logits, mel_targets.long())
         return loss_text.mean(), loss_mel.mean(), mel_logits
+    def prompt_embeddings(self, cond_latents, text_inputs):
+        """
+        The embedded prompt that precedes the start mel token: conditioning latent, then the text between its start and
+        stop tokens. Unlike compute_embeddings(), this does not store it in the inference model.
+        """
+        text_inputs = F.pad(text_inputs, (0, 1), value=self.stop_text_token)
+        text_inputs = F.pad(text_inputs, (1, 0), value=self.start_text_token)
+        emb = self.text_embedding(text_inputs) + self.text_pos_embedding(text_inputs)
+        conds = cond_latents.unsqueeze(1)
+        return torch.cat([conds, emb], dim=1)
+
     def compute_embeddings(
         self,
         cond_latents,
         text_inputs,
     ):
-        text_inputs = F.pad(text_inputs, (0, 1), value=self.stop_text_token)
-        text_inputs = F.pad(text_inputs, (1, 0), value=self.start_text_token)
-        emb = self.text_embedding(text_inputs) + self.text_pos_embedding(text_inputs)
-        conds = cond_latents.unsqueeze(1)
-        emb = torch.cat([conds, emb], dim=1)
+        emb = self.prompt_embeddings(cond_latents, text_inputs)
         self.inference_model.store_mel_emb(emb)
         gpt_inputs = torch.full(
             (
@@ -533,8 +773,17 @@ class UnifiedVoice(nn.Module):
         gpt_inputs[:, -1] = self.start_mel_token
         return gpt_inputs
     def inference_speech(self, speech_conditioning_latent, text_inputs, input_tokens=None, num_return_sequences=1,
-                         max_generate_length=None, typical_sampling=False, typical_mass=.9, **hf_generate_kwargs):        
+                         max_generate_length=None, typical_sampling=False, typical_mass=.9, return_latents=False,
+                         text_lengths=None, **hf_generate_kwargs):
+        """
+        Samples mel codes. With return_latents, returns (codes, latents) where latents[:, i] is the final-norm hidden
+        state that codes[:, i] was sampled from, i.e. what forward(..., return_latent=True) computes for those codes.
 
+        text_lengths (one per row of text_inputs) batches texts of different lengths: every row must end in its own
+        stop token(s) within its length, and the rest of the row, including the stop token appended here, is masked
+        out of attention. Each row then samples as if it had been passed alone.
+        """
+        text_width = text_inputs.shape[1]
         text_inputs = F.pad(text_inputs, (0, 1), value=self.stop_text_token)
         text_inputs, _ = self.build_aligned_inputs_and_targets(text_inputs, self.start_text_token, self.stop_text_token)
         text_emb = self.text_embedding(text_inputs) + self.text_pos_embedding(text_inputs)
@@ -554,13 +803,42 @@ class UnifiedVoice(nn.Module):
             fake_inputs = fake_inputs.repeat(num_return_sequences, 1)
             input_tokens = input_tokens.repeat(num_return_sequences // input_tokens.shape[0], 1)
             inputs = torch.cat([fake_inputs, input_tokens], dim=1)
+        if text_lengths is not None:
+            # Prompt layout: conditioning latent, start text token, text_width tokens, appended stop, start mel token.
+            positions = torch.arange(fake_inputs.shape[1], device=text_inputs.device)
+            text_lengths = text_lengths.to(text_inputs.device)
+            attention_mask = ~((positions >= 2 + text_lengths[:, None]) & (positions < 3 + text_width))
+            attention_mask = attention_mask.repeat(inputs.shape[0] // attention_mask.shape[0], 1).long()
+            attention_mask = F.pad(attention_mask, (0, inputs.shape[1] - attention_mask.shape[1]), value=1)
+            hf_generate_kwargs['attention_mask'] = attention_mask
 
         logits_processor = LogitsProcessorList([TypicalLogitsWarper(mass=typical_mass)]) if typical_sampling else LogitsProcessorList()
         max_length = trunc_index + self.max_mel_tokens - 1  if max_generate_length is None else trunc_index + max_generate_length
-        gen = self.inference_model.generate(inputs, bos_token_id=self.start_mel_token, pad_token_id=self.stop_mel_token, eos_token_id=self.stop_mel_token,
-                                            max_length=max_length, logits_processor=logits_processor,
-                                            num_return_sequences=num_return_sequences, **hf_generate_kwargs)
-        return gen[:, trunc_index:]
+        latents = []
+        hook = None
+        if return_latents:
+            def capture(module, args, output):
+                # The first call covers the prompt (run once for the samples sharing it); the state at its last
+                # position predicts the first code.
+                if not latents:
+                    output = output[:, trunc_index - 1:]
+                    output = output.repeat_interleave(inputs.shape[0] * num_return_sequences // output.shape[0], 0)
+                else:
+                    output = output[:, -1:]
+                latents.append(output)
+            hook = self.inference_model.final_norm.register_forward_hook(capture)
+        try:
+            gen = self.inference_model.generate(inputs, bos_token_id=self.start_mel_token, pad_token_id=self.stop_mel_token, eos_token_id=self.stop_mel_token,
+                                                max_length=max_length, logits_processor=logits_processor,
+                                                num_return_sequences=num_return_sequences,
+                                                static_cache_length=max_length, **hf_generate_kwargs)
+        finally:
+            if hook is not None:
+                hook.remove()
+        codes = gen[:, trunc_index:]
+        if return_latents:
+            return codes, torch.cat(latents, dim=1)[:, :codes.shape[1]]
+        return codes
 
     def get_generator(self, fake_inputs, **hf_generate_kwargs):
         return self.inference_model.generate_stream(
@@ -569,6 +847,7 @@ class UnifiedVoice(nn.Module):
             pad_token_id=self.stop_mel_token,
             eos_token_id=self.stop_mel_token,
             max_length=500,
+            static_cache_length=500,
             do_stream=True,
             **hf_generate_kwargs,
         )
@@ -1,13 +1,14 @@
 import math
 import random
 from abc import abstractmethod
+from contextlib import contextmanager
 
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
 from torch import autocast
 
-from tortoise.models.arch_util import normalization, AttentionBlock
+from tortoise.models.arch_util import normalization, AttentionBlock, GroupNorm32
 
 
 def is_latent(t):
@@ -39,6 +40,28 @@ def timestep_embedding(timesteps, dim, max_period=10000):
     return embedding
 
 
+def masked_group_norm(norm, x, mask):
+    """
+    GroupNorm `norm` applied to x (b,c,t) with statistics taken only over the positions where mask (b,t) is 1, i.e. what
+    each sample would get if it were normalized on its own, without the padding.
+    """
+    b, c, t = x.shape
+    h = x.float()
+    grouped = h.reshape(b, norm.num_groups, -1, t)
+    m = mask.reshape(b, 1, 1, t).to(h.dtype)
+    count = m.sum(dim=(2, 3)) * grouped.shape[2]
+    masked = grouped * m
+    mean = masked.sum(dim=(2, 3)) / count
+    var = ((masked * grouped).sum(dim=(2, 3)) / count - mean ** 2).clamp(min=0)
+    # Fold normalization and the affine transform into one scale and shift per sample and channel.
+    scale = torch.rsqrt(var + norm.eps).repeat_interleave(c // norm.num_groups, dim=1)
+    shift = -mean.repeat_interleave(c // norm.num_groups, dim=1) * scale
+    if norm.affine:
+        scale = scale * norm.weight
+        shift = shift * norm.weight + norm.bias
+    return torch.addcmul(shift.unsqueeze(-1), h, scale.unsqueeze(-1)).type(x.dtype)
+
+
 class TimestepBlock(nn.Module):
     @abstractmethod
     def forward(self, x, emb):
@@ -132,6 +155,9 @@ class DiffusionLayer(TimestepBlock):
 
 
 class DiffusionTts(nn.Module):
+    # forward() accepts a per-element conditioning_free Tensor (see GaussianDiffusion.p_mean_variance).
+    fused_conditioning_free = True
+
     def __init__(
             self,
             model_channels=512,
@@ -259,6 +285,53 @@ class DiffusionTts(nn.Module):
             mel_pred = mel_pred * unconditioned_batches.logical_not()
             return expanded_code_emb, mel_pred
 
+    @contextmanager
+    def valid_lengths(self, lengths):
+        """
+        Context manager for running a batch of differently long samples padded to a common length: while it is active,
+        forward() treats the positions of sample i past lengths[i] as padding. Padding is left out of the attention
+        keys and of the GroupNorm statistics, and zeroed before every convolution wider than one step, so the valid
+        part of each sample's output matches running it alone (up to floating point error).
+        """
+        if lengths is None:
+            yield
+            return
+        lengths = torch.as_tensor(lengths)
+        state = {}
+
+        def mask_for(x):
+            t = x.shape[-1]
+            mask = state.get(t)
+            if mask is None:
+                mask = state[t] = (torch.arange(t)[None] < lengths[:, None]).to(x.device)
+            # Conditioning-free guidance may run the batch twice over in a single forward pass.
+            return mask.repeat(x.shape[0] // mask.shape[0], 1)
+
+        def mask_conv_input(module, args):
+            return (args[0] * mask_for(args[0]).unsqueeze(1).to(args[0].dtype),) + args[1:]
+
+        def mask_norm(module, args, output):
+            return masked_group_norm(module, args[0], mask_for(args[0]))
+
+        def mask_attention(module, args, kwargs):
+            kwargs['mask'] = mask_for(args[0]).to(args[0].dtype)
+            return args, kwargs
+
+        handles = []
+        for part in (self.inp_block, self.conditioning_timestep_integrator, self.layers, self.out):
+            for module in part.modules():
+                if isinstance(module, nn.Conv1d) and module.kernel_size[0] > 1:
+                    handles.append(module.register_forward_pre_hook(mask_conv_input))
+                elif isinstance(module, GroupNorm32):
+                    handles.append(module.register_forward_hook(mask_norm))
+                elif isinstance(module, AttentionBlock):
+                    handles.append(module.register_forward_pre_hook(mask_attention, with_kwargs=True))
+        try:
+            yield
+        finally:
+            for handle in handles:
+                handle.remove()
+
     def forward(self, x, timesteps, aligned_conditioning=None, conditioning_latent=None, precomputed_aligned_embeddings=None, conditioning_free=False, return_code_pred=False):
         """
         Apply the model to an input batch.
@@ -269,13 +342,15 @@ class DiffusionTts(nn.Module):
         :param conditioning_latent: a pre-computed conditioning latent; see get_conditioning().
         :param precomputed_aligned_embeddings: Embeddings returned from self.timestep_independent()
         :param conditioning_free: When set, all conditioning inputs (including tokens and conditioning_input) will not be considered.
+                                  May also be a boolean [N] Tensor selecting the batch elements this applies to, which
+                                  lets a sampler compute the conditioned and conditioning-free outputs in one pass.
         :return: an [N x C x ...] Tensor of outputs.
         """
         assert precomputed_aligned_embeddings is not None or (aligned_conditioning is not None and conditioning_latent is not None)
         assert not (return_code_pred and precomputed_aligned_embeddings is not None)  # These two are mutually exclusive.
 
         unused_params = []
-        if conditioning_free:
+        if conditioning_free is True:
             code_emb = self.unconditioned_embedding.repeat(x.shape[0], 1, x.shape[-1])
             unused_params.extend(list(self.code_converter.parameters()) + list(self.code_embedding.parameters()))
             unused_params.extend(list(self.latent_conditioner.parameters()))
@@ -288,8 +363,11 @@ class DiffusionTts(nn.Module):
                     unused_params.extend(list(self.code_converter.parameters()) + list(self.code_embedding.parameters()))
                 else:
                     unused_params.extend(list(self.latent_conditioner.parameters()))
-
-            unused_params.append(self.unconditioned_embedding)
+            if torch.is_tensor(conditioning_free):
+                # Per batch element: rows flagged here are computed conditioning-free (fused guidance).
+                code_emb = torch.where(conditioning_free.view(-1, 1, 1), self.unconditioned_embedding.to(code_emb.dtype), code_emb)
+            else:
+                unused_params.append(self.unconditioned_embedding)
 
         time_emb = self.time_embed(timestep_embedding(timesteps, self.model_channels))
         code_emb = self.conditioning_timestep_integrator(code_emb, time_emb)
@@ -1,4 +1,6 @@
 # adopted from https://github.com/jik876/hifi-gan/blob/master/models.py
+import math
+
 import torch
 from torch import nn
 from torch.nn import Conv1d, ConvTranspose1d
@@ -196,6 +198,7 @@ class HifiganGenerator(torch.nn.Module):
         self.inference_padding = inference_padding
         self.num_kernels = len(resblock_kernel_sizes)
         self.num_upsamples = len(upsample_factors)
+        self.hop_length = math.prod(upsample_factors)
         # initial upsampling layers
         self.conv_pre = weight_norm(Conv1d(in_channels, upsample_initial_channel, 7, 1, padding=3))
         resblock = ResBlock1 if resblock_type == "1" else ResBlock2
@@ -280,18 +283,42 @@ class HifiganGenerator(torch.nn.Module):
         """
         # c = c.to(self.conv_pre.weight.device)
         # c = torch.nn.functional.pad(c, (self.inference_padding, self.inference_padding), "replicate")
+        up_2 = self.latents_to_frames(c)
+        g = g.unsqueeze(0)
+        return self.forward(up_2.to(self.device), g.transpose(1,2))
+
+    def latents_to_frames(self, c):
+        """Resamples GPT latents [B, T, C] to the vocoder frame rate: [B, C, T']."""
         up_1 = torch.nn.functional.interpolate(
                 c.transpose(1,2),
                 scale_factor=[1024 / 256],
                 mode="linear",
             )
-        up_2 = torch.nn.functional.interpolate(
+        return torch.nn.functional.interpolate(
             up_1,
             scale_factor=[24000 / 22050],
             mode="linear",
         )
-        g = g.unsqueeze(0)
-        return self.forward(up_2.to(self.device), g.transpose(1,2))
+
+    @torch.no_grad()
+    def inference_window(self, c, g, start, context_frames=16):
+        """
+        Same as inference(c, g)[..., start:], but the convolutions only run over the frames those samples depend on.
+        Decoding the new tail of a growing latent sequence then costs the same however long the sequence already is.
+
+        Args:
+            start (int): first output sample to return.
+            context_frames (int): frames decoded to the left of `start`. The receptive field of the default
+                configuration is about 13 frames on each side, so 16 gives the same samples as a full decode.
+
+        Shapes:
+            c: [B, T, C]
+            Tensor: [B, 1, T' * hop_length - start]
+        """
+        frames = self.latents_to_frames(c)
+        first = max(start // self.hop_length - context_frames, 0)
+        o = self.forward(frames[..., first:].to(self.device), g.unsqueeze(0).transpose(1, 2))
+        return o[..., start - first * self.hop_length:]
 
     def remove_weight_norm(self):
         print("Removing weight norm...")
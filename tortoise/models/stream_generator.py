@@ -911,6 +911,15 @@ class NewGenerationMixin(GenerationMixin):
         # keep track of which sequences are already finished
         unfinished_sequences = input_ids.new(input_ids.shape[0]).fill_(1)
 
+        # generated ids are written in place into a buffer of the final length (when it is known) instead of being
+        # concatenated on every step; input_ids is a view of its filled part
+        cur_len = input_ids.shape[-1]
+        ids_buffer = None
+        if stopping_criteria.max_length is not None and stopping_criteria.max_length > cur_len:
+            ids_buffer = input_ids.new_empty((input_ids.shape[0], stopping_criteria.max_length))
+            ids_buffer[:, :cur_len] = input_ids
+            input_ids = ids_buffer[:, :cur_len]
+
         this_peer_finished = False  # used by synced_gpus only
         # auto-regressive generation
         while True:
@@ -981,7 +990,12 @@ class NewGenerationMixin(GenerationMixin):
                 )
             yield next_tokens, self.final_norm(outputs.hidden_states[-1][:, -1])
             # update generated ids, model inputs, and length for next step
-            input_ids = torch.cat([input_ids, next_tokens[:, None]], dim=-1)
+            if ids_buffer is not None and cur_len < ids_buffer.shape[-1]:
+                ids_buffer[:, cur_len] = next_tokens
+                cur_len += 1
+                input_ids = ids_buffer[:, :cur_len]
+            else:
+                input_ids = torch.cat([input_ids, next_tokens[:, None]], dim=-1)
             model_kwargs = self._update_model_kwargs_for_generation(
                 outputs, model_kwargs, is_encoder_decoder=self.config.is_encoder_decoder
             )
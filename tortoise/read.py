@@ -3,10 +3,11 @@ import os
 from time import time
 
 import torch
-import torchaudio
 
 from api import TextToSpeech, MODELS_DIR
 from utils.audio import load_audio, load_voices
+from utils.audio_encoders import FORMATS, output_filename, save_audio
+from utils.diffusion import SAMPLERS
 from utils.text import split_and_recombine_text
 
 
@@ -17,8 +18,11 @@ if __name__ == '__main__':
                                                  'Use the & character to join two voices together. Use a comma to perform inference on multiple voices.', default='pat')
     parser.add_argument('--output_path', type=str, help='Where to store outputs.', default='results/longform/')
     parser.add_argument('--output_name', type=str, help='How to name the output file', default='combined.wav')
+    parser.add_argument('--format', type=str, help='Output audio format.', choices=list(FORMATS), default='wav')
     parser.add_argument('--preset', type=str, help='Which voice preset to use.', default='standard')
+    parser.add_argument('--diffusion_sampler', type=str, help='Diffusion sampler, overriding the preset\'s.', choices=list(SAMPLERS), default=None)
     parser.add_argument('--regenerate', type=str, help='Comma-separated list of clip numbers to re-generate, or nothing.', default=None)
+    parser.add_argument('--batch_size', type=int, help='How many text segments to synthesize together (tts_batch). 1 synthesizes them one by one.', default=1)
     parser.add_argument('--candidates', type=int, help='How many output candidates to produce per-voice. Only the first candidate is actually used in the final product, the others can be used manually.', default=1)
     parser.add_argument('--model_dir', type=str, help='Where to find pretrained model checkpoints. Tortoise automatically downloads these to .models, so this'
                                                       'should only be specified if you have custom checkpoints.', default=MODELS_DIR)
@@ -62,27 +66,37 @@ if __name__ == '__main__':
             voice_sel = [selected_voice]
 
         voice_samples, conditioning_latents = load_voices(voice_sel)
-        all_parts = []
-        for j, text in enumerate(texts):
-            if regenerate is not None and j not in regenerate:
-                all_parts.append(load_audio(os.path.join(voice_outpath, f'{j}.wav'), 24000))
-                continue
-            gen = tts.tts_with_preset(text, voice_samples=voice_samples, conditioning_latents=conditioning_latents,
-                                      preset=args.preset, k=args.candidates, use_deterministic_seed=seed)
-            if args.candidates == 1:
-                audio_ = gen.squeeze(0).cpu()
-                torchaudio.save(os.path.join(voice_outpath, f'{j}.wav'), audio_, 24000)
+        sampler_kwargs = {'diffusion_sampler': args.diffusion_sampler} if args.diffusion_sampler else {}
+        todo = [j for j in range(len(texts)) if regenerate is None or j in regenerate]
+        parts = {}
+        for start in range(0, len(todo), args.batch_size):
+            batch = todo[start:start + args.batch_size]
+            if len(batch) > 1:
+                gens = tts.tts_batch_with_preset([texts[j] for j in batch], voice_samples=voice_samples,
+                                                 conditioning_latents=conditioning_latents, preset=args.preset,
+                                                 k=args.candidates, use_deterministic_seed=seed, **sampler_kwargs)
             else:
-                candidate_dir = os.path.join(voice_outpath, str(j))
-                os.makedirs(candidate_dir, exist_ok=True)
-                for k, g in enumerate(gen):
-                    torchaudio.save(os.path.join(candidate_dir, f'{k}.wav'), g.squeeze(0).cpu(), 24000)
-                audio_ = gen[0].squeeze(0).cpu()
-            all_parts.append(audio_)
+                gens = [tts.tts_with_preset(texts[batch[0]], voice_samples=voice_samples, conditioning_latents=conditioning_latents,
+                                            preset=args.preset, k=args.candidates, use_deterministic_seed=seed, **sampler_kwargs)]
+            # Save every segment as soon as it exists, so --regenerate can resume after an interrupted run.
+            for j, gen in zip(batch, gens):
+                if args.candidates == 1:
+                    audio_ = gen.squeeze(0).cpu()
+                    save_audio(os.path.join(voice_outpath, output_filename(str(j), args.format)), audio_, 24000, args.format)
+                else:
+                    candidate_dir = os.path.join(voice_outpath, str(j))
+                    os.makedirs(candidate_dir, exist_ok=True)
+                    for k, g in enumerate(gen):
+                        save_audio(os.path.join(candidate_dir, output_filename(str(k), args.format)), g.squeeze(0).cpu(), 24000, args.format)
+                    audio_ = gen[0].squeeze(0).cpu()
+                parts[j] = audio_
+
+        all_parts = [parts[j] if j in parts else load_audio(os.path.join(voice_outpath, output_filename(str(j), args.format)), 24000)
+                     for j in range(len(texts))]
 
         if args.candidates == 1:
             full_audio = torch.cat(all_parts, dim=-1)
-            torchaudio.save(os.path.join(voice_outpath, f"{outname}.wav"), full_audio, 24000)
+            save_audio(os.path.join(voice_outpath, output_filename(outname, args.format)), full_audio, 24000, args.format)
 
         if args.produce_debug_state:
             os.makedirs('debug_states', exist_ok=True)
@@ -94,8 +108,8 @@ if __name__ == '__main__':
             audio_clips = []
             for candidate in range(args.candidates):
                 for line in range(len(texts)):
-                    wav_file = os.path.join(voice_outpath, str(line), f"{candidate}.wav")
+                    wav_file = os.path.join(voice_outpath, str(line), output_filename(str(candidate), args.format))
                     audio_clips.append(load_audio(wav_file, 24000))
                 audio_clips = torch.cat(audio_clips, dim=-1)
-                torchaudio.save(os.path.join(voice_outpath, f"{outname}_{candidate:02d}.wav"), audio_clips, 24000)
+                save_audio(os.path.join(voice_outpath, output_filename(f"{outname}_{candidate:02d}", args.format)), audio_clips, 24000, args.format)
                 audio_clips = []
@@ -30,7 +30,7 @@ def load_audio(audiopath, sampling_rate):
     extension = os.path.splitext(audiopath)[1].casefold()
     if extension == '.wav':
         audio, lsr = load_wav_to_torch(audiopath)
-    elif extension == '.mp3':
+    elif extension in ('.mp3', '.flac', '.ogg', '.opus'):
         audio, lsr = librosa.load(audiopath, sr=sampling_rate)
         audio = torch.FloatTensor(audio)
     else:
@@ -0,0 +1,222 @@
+"""
+Output encoders for generated audio.
+
+Every format is written through libsndfile (via soundfile, which librosa already depends on) into an in-memory sink,
+so audio can be encoded incrementally: feed chunks to AudioEncoder.encode() as they are produced and ship the
+returned bytes immediately. Containers whose header carries the total length (WAV, FLAC) are rewritten by libsndfile
+when the file is closed; those late writes are recorded as patches against bytes that were already handed out, and
+AudioEncoder.patch_head() applies them to the beginning of the stream (see the Storybook API's streaming upload, which
+holds back its first part for exactly this).
+
+Audio sent to a client as it is produced (AudioEncoder(..., streaming=True)) cannot be patched: there, WAV headers
+declare an unknown length (0xFFFFFFFF sizes, as other streaming WAV writers do) and the header rewrites are dropped.
+FLAC needs nothing special: its initial STREAMINFO already says "unknown" (0 total samples, no MD5), which streaming
+FLAC decoders accept, though libsndfile itself only reads such files from a seekable source. pcm16, wav and opus are
+the formats to prefer for live playback.
+"""
+
+import io
+import os
+
+import soundfile as sf
+import torch
+
+
+# name -> (soundfile format, subtype, file extension, MIME type)
+FORMATS = {
+    'wav': ('WAV', 'FLOAT', 'wav', 'audio/wav'),  # 32-bit float, what torchaudio.save writes for float tensors.
+    'pcm16': ('WAV', 'PCM_16', 'wav', 'audio/wav'),
+    'flac': ('FLAC', 'PCM_16', 'flac', 'audio/flac'),
+    'opus': ('OGG', 'OPUS', 'opus', 'audio/ogg'),
+    'mp3': ('MP3', 'MPEG_LAYER_III', 'mp3', 'audio/mpeg'),
+}
+
+
+def get_format(name):
+    if name not in FORMATS:
+        raise ValueError(f'Unsupported output format "{name}". Options: {", ".join(FORMATS)}')
+    return FORMATS[name]
+
+
+_UNKNOWN_SIZE = b'\xff\xff\xff\xff'
+
+
+def _mark_unknown_length(header):
+    """Sets the RIFF size, and the data and fact sizes, of the start of a WAV stream to 0xFFFFFFFF."""
+    header = bytearray(header)
+    header[4:8] = _UNKNOWN_SIZE
+    offset = 12
+    while offset + 8 <= len(header):
+        chunk_id = bytes(header[offset:offset + 4])
+        if chunk_id == b'data':
+            header[offset + 4:offset + 8] = _UNKNOWN_SIZE
+            break
+        size = int.from_bytes(header[offset + 4:offset + 8], 'little')
+        if chunk_id == b'fact' and size >= 4 and offset + 12 <= len(header):
+            header[offset + 8:offset + 12] = _UNKNOWN_SIZE
+        offset += 8 + size + (size & 1)
+    return bytes(header)
+
+
+class _StreamSink(io.RawIOBase):
+    """
+    Write-only file object handed to libsndfile. Bytes appended at the end are buffered until drained; writes into
+    the already-drained region (header rewrites on close) are kept as (offset, data) patches.
+    """
+
+    def __init__(self):
+        self.pos = 0
+        self.drained = 0  # Bytes handed out so far.
+        self.buffer = bytearray()  # Bytes after `drained`.
+        self.patches = []
+
+    def seekable(self):
+        return True
+
+    def writable(self):
+        return True
+
+    def readable(self):
+        return True
+
+    def tell(self):
+        return self.pos
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        end = self.drained + len(self.buffer)
+        self.pos = {io.SEEK_SET: 0, io.SEEK_CUR: self.pos, io.SEEK_END: end}[whence] + offset
+        return self.pos
+
+    def read(self, size=-1):
+        # libsndfile only reads back what it has just written; anything that was already drained is gone.
+        start = self.pos - self.drained
+        if start < 0:
+            return b''
+        data = bytes(self.buffer[start:] if size < 0 else self.buffer[start:start + size])
+        self.pos += len(data)
+        return data
+
+    def write(self, data):
+        data = bytes(data)
+        written = len(data)
+        if self.pos < self.drained:
+            # Rewrite of bytes that were already drained; remember it as a patch.
+            n = min(len(data), self.drained - self.pos)
+            self.patches.append((self.pos, data[:n]))
+            self.pos += n
+            data = data[n:]
+        if data:
+            end = self.drained + len(self.buffer)
+            if self.pos > end:
+                self.buffer += b'\0' * (self.pos - end)
+            start = self.pos - self.drained
+            self.buffer[start:start + len(data)] = data
+            self.pos += len(data)
+        return written
+
+    def drain(self):
+        data = bytes(self.buffer)
+        self.drained += len(data)
+        self.buffer = bytearray()
+        return data
+
+
+class AudioEncoder:
+    """
+    Incremental encoder for one output stream.
+
+        encoder = AudioEncoder('opus')
+        for wav in chunks:
+            send(encoder.encode(wav))
+        send(encoder.finish())
+        # For seekable containers, fix up the first bytes sent: head = encoder.patch_head(head)
+
+    :param format: One of FORMATS.
+    :param sample_rate: Sample rate of the audio fed to encode().
+    :param streaming: The bytes go straight to a client and cannot be rewritten later: WAV headers declare an unknown
+                      length and finish() records no header patches.
+    """
+
+    def __init__(self, format='wav', sample_rate=24000, channels=1, streaming=False):
+        self.format = format
+        sf_format, subtype, self.extension, self.content_type = get_format(format)
+        self.sample_rate = sample_rate
+        self.streaming = streaming
+        self._unknown_length = streaming and sf_format == 'WAV'
+        self._sink = _StreamSink()
+        self._file = sf.SoundFile(self._sink, mode='w', samplerate=sample_rate, channels=channels,
+                                  format=sf_format, subtype=subtype)
+        self.total_bytes = 0
+
+    def _drain(self):
+        data = self._sink.drain()
+        if self._unknown_length and self.total_bytes == 0 and data:
+            # libsndfile writes the whole header when the file is opened, so it is all in the first bytes.
+            data = _mark_unknown_length(data)
+        self.total_bytes += len(data)
+        return data
+
+    def encode(self, wav):
+        """Encodes a chunk of audio (any tensor/array shape holding mono samples in [-1, 1]); returns new bytes."""
+        if torch.is_tensor(wav):
+            wav = wav.detach().reshape(-1).float().cpu().numpy()
+        self._file.write(wav.reshape(-1))
+        return self._drain()
+
+    def finish(self):
+        """
+        Flushes the encoder; returns the remaining bytes. Header rewrites become available to patch_head(), except
+        when streaming (they are dropped).
+        """
+        self._file.close()
+        data = self._drain()
+        if self.streaming:
+            self._sink.patches = []
+        return data
+
+    @property
+    def patches(self):
+        return list(self._sink.patches)
+
+    def patch_head(self, head):
+        """Applies the header rewrites made by finish() to `head`, the first len(head) bytes of the stream."""
+        head = bytearray(head)
+        for offset, data in self._sink.patches:
+            if offset + len(data) > len(head):
+                raise ValueError(f'Header patch at byte {offset} lies outside the {len(head)} held-back bytes.')
+            head[offset:offset + len(data)] = data
+        return bytes(head)
+
+
+def iter_encoded(chunks, encoder):
+    """Yields the encoded bytes of an iterable of audio chunks, finishing the encoder at the end."""
+    for chunk in chunks:
+        data = encoder.encode(chunk)
+        if data:
+            yield data
+    data = encoder.finish()
+    if data:
+        yield data
+
+
+def encode_audio(wav, format='wav', sample_rate=24000):
+    """Encodes a complete clip and returns the file contents."""
+    encoder = AudioEncoder(format, sample_rate)
+    data = encoder.encode(wav) + encoder.finish()
+    return encoder.patch_head(data)
+
+
+def save_audio(path, wav, sample_rate=24000, format=None):
+    """
+    Writes a clip to `path`. The format defaults to the one matching the file extension (float WAV for .wav).
+    """
+    if format is None:
+        extension = os.path.splitext(path)[1].lstrip('.').casefold()
+        format = {'wav': 'wav', 'flac': 'flac', 'opus': 'opus', 'ogg': 'opus', 'mp3': 'mp3'}.get(extension, 'wav')
+    with open(path, 'wb') as f:
+        f.write(encode_audio(wav, format, sample_rate))
+
+
+def output_filename(name, format):
+    """`name` (without extension) with the extension of `format`."""
+    return f'{name}.{get_format(format)[2]}'
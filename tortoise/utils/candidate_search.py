@@ -0,0 +1,104 @@
+"""
+Progressive candidate search.
+
+By default tts() draws all num_autoregressive_samples before CLVP scores any of them. In progressive mode every batch
+is scored as soon as it has been sampled, the k best candidates so far are kept in a heap, and sampling stops as soon
+as one of the stopping criteria is met:
+
+    score_threshold  the k best candidates all score at least this much.
+    patience         the k-th best score has not improved (by more than min_delta) for this many batches.
+    time_budget      sampling and scoring another batch would exceed this many seconds.
+
+num_autoregressive_samples becomes the upper bound of the search. Only the k best candidates are kept, not every
+sample drawn.
+"""
+
+import heapq
+from time import perf_counter
+
+import torch
+
+
+class CandidateSearch:
+    """
+    :param k: Number of candidates to select.
+    :param score_threshold: Stop once the k best scores are all at least this.
+    :param patience: Stop once this many batches in a row did not improve the k-th best score.
+    :param time_budget: Wall-clock budget of the search, in seconds.
+    :param min_delta: Improvement of the k-th best score below which a batch counts towards `patience`.
+    :param min_samples: Never stop before this many samples were drawn (at least k).
+    """
+
+    def __init__(self, k=1, score_threshold=None, patience=None, time_budget=None, min_delta=0., min_samples=0):
+        self.k = k
+        self.score_threshold = score_threshold
+        self.patience = patience
+        self.time_budget = time_budget
+        self.min_delta = min_delta
+        self.min_samples = max(min_samples, k)
+        self.samples = 0
+        self.batches = 0
+        self.stale_batches = 0
+        self.stop_reason = None
+        self._heap = []  # (score, sample index, codes), worst of the k best first
+        self._start = self._batch_end = perf_counter()
+        self._last_batch_seconds = 0.
+
+    @property
+    def enabled(self):
+        return self.score_threshold is not None or self.patience is not None or self.time_budget is not None
+
+    @property
+    def kth_score(self):
+        """k-th best score so far, or -inf while fewer than k candidates have been seen."""
+        return self._heap[0][0] if len(self._heap) == self.k else float('-inf')
+
+    def add(self, scores, codes):
+        """Offers one batch of candidates: `scores` (b,), `codes` (b,s). Sample indices follow the order of the calls."""
+        previous = self.kth_score
+        for i, score in enumerate(scores.tolist()):
+            entry = (score, self.samples + i, codes[i].clone())
+            if len(self._heap) < self.k:
+                heapq.heappush(self._heap, entry)
+            elif score > self._heap[0][0]:
+                heapq.heapreplace(self._heap, entry)
+        self.samples += len(scores)
+        self.batches += 1
+        self.stale_batches = 0 if self.kth_score > previous + self.min_delta else self.stale_batches + 1
+        batch_start, self._batch_end = self._batch_end, perf_counter()
+        self._last_batch_seconds = self._batch_end - batch_start
+
+    def should_stop(self):
+        """Whether to stop sampling now; sets stop_reason."""
+        if self.samples < self.min_samples:
+            return False
+        if self.score_threshold is not None and self.kth_score >= self.score_threshold:
+            self.stop_reason = 'threshold'
+        elif self.patience is not None and self.stale_batches >= self.patience:
+            self.stop_reason = 'plateau'
+        elif self.time_budget is not None and self.elapsed + self._last_batch_seconds > self.time_budget:
+            self.stop_reason = 'time_budget'
+        return self.stop_reason is not None
+
+    @property
+    def elapsed(self):
+        return perf_counter() - self._start
+
+    def best(self):
+        """Returns (indices, codes, scores) of the k best candidates, best first."""
+        ranked = sorted(self._heap, key=lambda entry: entry[0], reverse=True)
+        indices = torch.tensor([index for _, index, _ in ranked])
+        return indices, torch.stack([codes for _, _, codes in ranked]), [score for score, _, _ in ranked]
+
+    def stats(self, max_samples=None):
+        """Summary of the search: samples spent, best and k-th best score, why it stopped and how long it took."""
+        scores = sorted((entry[0] for entry in self._heap), reverse=True)
+        return {
+            'samples': self.samples,
+            'max_samples': max_samples,
+            'batches': self.batches,
+            'best_score': scores[0] if scores else None,
+            'kth_score': scores[-1] if scores else None,
+            'stop_reason': self.stop_reason or 'exhausted',
+            'seconds': self.elapsed,
+        }
@@ -0,0 +1,113 @@
+"""
+Batch-wide post-processing of the mel codes sampled from the autoregressive model.
+
+These replace the per-row Python loops that ran before CLVP scoring (fix_autoregressive_output) and before diffusion
+(finding where to cut the latents after a run of calm tokens) with a few tensor operations over the whole batch. The
+results are identical to the row-by-row versions in tortoise.api, which now call these.
+
+Run this module to benchmark both on 256 samples x 500 tokens:
+    python -m tortoise.utils.codes
+"""
+
+import torch
+
+
+CALM_TOKEN = 83  # DVAE code of silence.
+# Codes written over the last three positions of every clip that stopped, so the diffusion model hears a proper end.
+END_CODES = (45, 45, 248)
+
+
+def fix_autoregressive_codes(codes, stop_token, calm_token=CALM_TOKEN, complain=True):
+    """
+    Batch version of tortoise.api.fix_autoregressive_output. Modifies `codes` (b,s) in place and returns it: in every
+    row that contains `stop_token`, everything from the first stop token on becomes `calm_token` and the last three
+    codes become END_CODES. Rows without a stop token are left as they are.
+    """
+    is_stop = codes == stop_token
+    stopped = is_stop.any(dim=1)
+    if complain:
+        for _ in range(int((~stopped).sum())):
+            print("No stop tokens found in one of the generated voice clips. This typically means the spoken audio is "
+                  "too long. In some cases, the output will still be good, though. Listen to it and if it is missing words, "
+                  "try breaking up your input text.")
+    if not stopped.any():
+        return codes
+    # cumsum > 0 marks the first stop token and everything after it.
+    codes.masked_fill_(is_stop.cumsum(dim=1) > 0, calm_token)
+    codes[stopped, -len(END_CODES):] = torch.tensor(END_CODES, dtype=codes.dtype, device=codes.device)
+    return codes
+
+
+def calm_trim_points(codes, calm_token=CALM_TOKEN, max_calm=8):
+    """
+    For each row of `codes` (b,s), the index at which its latents are cut before diffusion: the position of the first
+    calm token that follows `max_calm` consecutive calm tokens. Returns a list with None for rows without such a run.
+    """
+    positions = torch.arange(codes.shape[1], device=codes.device).expand_as(codes)
+    # Length of the calm run ending at each position: distance to the last non-calm token (-1 before the first one).
+    last_other = torch.where(codes == calm_token, torch.full_like(positions, -1), positions).cummax(dim=1).values
+    past_limit = (positions - last_other) > max_calm
+    found = past_limit.any(dim=1)
+    first = past_limit.int().argmax(dim=1)
+    return [int(f) if ok else None for f, ok in zip(first.tolist(), found.tolist())]
+
+
+# The row-by-row implementations the functions above replace, kept as references for _benchmark() and the tests.
+def _fix_autoregressive_output_loop(codes, stop_token):
+    stop_token_indices = (codes == stop_token).nonzero()
+    if len(stop_token_indices) == 0:
+        return codes
+    else:
+        codes[stop_token_indices] = 83
+    stm = stop_token_indices.min().item()
+    codes[stm:] = 83
+    if stm - 3 < codes.shape[0]:
+        codes[-3] = 45
+        codes[-2] = 45
+        codes[-1] = 248
+    return codes
+
+
+def _calm_trim_point_loop(codes, calm_token, max_calm=8):
+    ctokens = 0
+    for k in range(codes.shape[-1]):
+        if codes[k] == calm_token:
+            ctokens += 1
+        else:
+            ctokens = 0
+        if ctokens > max_calm:
+            return k
+    return None
+
+
+def _benchmark(samples=256, length=500, stop_token=8193, repeats=5):
+    from time import perf_counter
+
+    torch.manual_seed(0)
+    codes = torch.randint(0, 8192, (samples, length))
+    # Most samples stop somewhere in the second half; a few never do.
+    stops = torch.randint(length // 2, length + length // 10, (samples,))
+    for row, stop in enumerate(stops.tolist()):
+        if stop < length:
+            codes[row, stop] = stop_token
+
+    def timed(fn):
+        start = perf_counter()
+        for _ in range(repeats):
+            result = fn()
+        return result, (perf_counter() - start) / repeats
+
+    fixed_loop, loop_fix = timed(lambda: torch.stack([_fix_autoregressive_output_loop(row, stop_token)
+                                                      for row in codes.clone()]))
+    fixed, vec_fix = timed(lambda: fix_autoregressive_codes(codes.clone(), stop_token, complain=False))
+    assert torch.equal(fixed, fixed_loop)
+    trims_loop, loop_trim = timed(lambda: [_calm_trim_point_loop(row, CALM_TOKEN) for row in fixed])
+    trims, vec_trim = timed(lambda: calm_trim_points(fixed, CALM_TOKEN))
+    assert trims == trims_loop
+    print(f'{samples} samples x {length} tokens')
+    print(f'fix_autoregressive_output: loop {loop_fix * 1000:.1f}ms, batched {vec_fix * 1000:.2f}ms')
+    print(f'calm-token trim:           loop {loop_trim * 1000:.1f}ms, batched {vec_trim * 1000:.2f}ms')
+
+
+if __name__ == '__main__':
+    _benchmark()
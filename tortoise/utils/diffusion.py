@@ -172,6 +172,24 @@ class LossType(enum.Enum):
         return self == LossType.KL or self == LossType.RESCALED_KL
 
 
+# Schedule arrays that GaussianDiffusion._extract reads during sampling.
+_SCHEDULE_TABLES = (
+    "alphas_cumprod",
+    "alphas_cumprod_prev",
+    "alphas_cumprod_next",
+    "sqrt_alphas_cumprod",
+    "sqrt_one_minus_alphas_cumprod",
+    "log_one_minus_alphas_cumprod",
+    "sqrt_recip_alphas_cumprod",
+    "sqrt_recipm1_alphas_cumprod",
+    "posterior_variance",
+    "posterior_log_variance_clipped",
+    "posterior_mean_coef1",
+    "posterior_mean_coef2",
+    "log_betas",
+)
+
+
 class GaussianDiffusion:
     """
     Utilities for training and sampling diffusion models.
@@ -187,6 +205,7 @@ class GaussianDiffusion:
     :param rescale_timesteps: if True, pass floating point timesteps into the
                               model so that they are always scaled like in the
                               original paper (0 to 1000).
+    :param sampler: the sampling loop used by sample_loop(), one of SAMPLERS.
     """
 
     def __init__(
@@ -200,7 +219,11 @@ class GaussianDiffusion:
         conditioning_free=False,
         conditioning_free_k=1,
         ramp_conditioning_free=True,
+        sampler="p",
     ):
+        if sampler not in SAMPLERS:
+            raise ValueError(f"Unknown sampler: {sampler}. Options: {', '.join(SAMPLERS)}")
+        self.sampler = sampler
         self.model_mean_type = ModelMeanType(model_mean_type)
         self.model_var_type = ModelVarType(model_var_type)
         self.loss_type = LossType(loss_type)
@@ -247,6 +270,30 @@ class GaussianDiffusion:
             * np.sqrt(alphas)
             / (1.0 - self.alphas_cumprod)
         )
+        self.log_betas = np.log(betas)
+
+        # float32 copies of the arrays above, materialized once per device (see _extract).
+        self._device_tables = {}
+
+    def _tables(self, device):
+        tables = self._device_tables.get(device)
+        if tables is None:
+            tables = {
+                name: th.from_numpy(getattr(self, name).astype(np.float32)).to(device)
+                for name in _SCHEDULE_TABLES
+            }
+            self._device_tables[device] = tables
+        return tables
+
+    def _extract(self, name, timesteps, broadcast_shape):
+        """
+        Like _extract_into_tensor(getattr(self, name), ...), but indexes a tensor
+        kept on the device of `timesteps` instead of converting the numpy array
+        on every call.
+        """
+        return _extract_into_tensor(
+            self._tables(timesteps.device)[name], timesteps, broadcast_shape
+        )
 
     def q_mean_variance(self, x_start, t):
         """
@@ -257,11 +304,11 @@ class GaussianDiffusion:
         :return: A tuple (mean, variance, log_variance), all of x_start's shape.
         """
         mean = (
-            _extract_into_tensor(self.sqrt_alphas_cumprod, t, x_start.shape) * x_start
+            self._extract("sqrt_alphas_cumprod", t, x_start.shape) * x_start
         )
         variance = _extract_into_tensor(1.0 - self.alphas_cumprod, t, x_start.shape)
-        log_variance = _extract_into_tensor(
-            self.log_one_minus_alphas_cumprod, t, x_start.shape
+        log_variance = self._extract(
+            "log_one_minus_alphas_cumprod", t, x_start.shape
         )
         return mean, variance, log_variance
 
@@ -280,8 +327,8 @@ class GaussianDiffusion:
             noise = th.randn_like(x_start)
         assert noise.shape == x_start.shape
         return (
-            _extract_into_tensor(self.sqrt_alphas_cumprod, t, x_start.shape) * x_start
-            + _extract_into_tensor(self.sqrt_one_minus_alphas_cumprod, t, x_start.shape)
+            self._extract("sqrt_alphas_cumprod", t, x_start.shape) * x_start
+            + self._extract("sqrt_one_minus_alphas_cumprod", t, x_start.shape)
             * noise
         )
 
@@ -294,12 +341,12 @@ class GaussianDiffusion:
         """
         assert x_start.shape == x_t.shape
         posterior_mean = (
-            _extract_into_tensor(self.posterior_mean_coef1, t, x_t.shape) * x_start
-            + _extract_into_tensor(self.posterior_mean_coef2, t, x_t.shape) * x_t
+            self._extract("posterior_mean_coef1", t, x_t.shape) * x_start
+            + self._extract("posterior_mean_coef2", t, x_t.shape) * x_t
         )
-        posterior_variance = _extract_into_tensor(self.posterior_variance, t, x_t.shape)
-        posterior_log_variance_clipped = _extract_into_tensor(
-            self.posterior_log_variance_clipped, t, x_t.shape
+        posterior_variance = self._extract("posterior_variance", t, x_t.shape)
+        posterior_log_variance_clipped = self._extract(
+            "posterior_log_variance_clipped", t, x_t.shape
         )
         assert (
             posterior_mean.shape[0]
@@ -337,9 +384,21 @@ class GaussianDiffusion:
 
         B, C = x.shape[:2]
         assert t.shape == (B,)
-        model_output = model(x, self._scale_timesteps(t), **model_kwargs)
-        if self.conditioning_free:
-            model_output_no_conditioning = model(x, self._scale_timesteps(t), conditioning_free=True, **model_kwargs)
+        if self.conditioning_free and getattr(model, "fused_conditioning_free", False):
+            # One forward pass over the batch twice: conditioned, then conditioning-free.
+            doubled_kwargs = {
+                k: th.cat([v, v]) if th.is_tensor(v) and v.shape[:1] == (B,) else v
+                for k, v in model_kwargs.items()
+            }
+            conditioning_free = th.arange(2 * B, device=x.device) >= B
+            model_output, model_output_no_conditioning = model(
+                th.cat([x, x]), self._scale_timesteps(th.cat([t, t])), conditioning_free=conditioning_free,
+                **doubled_kwargs
+            ).split(B)
+        else:
+            model_output = model(x, self._scale_timesteps(t), **model_kwargs)
+            if self.conditioning_free:
+                model_output_no_conditioning = model(x, self._scale_timesteps(t), conditioning_free=True, **model_kwargs)
 
         if self.model_var_type in [ModelVarType.LEARNED, ModelVarType.LEARNED_RANGE]:
             assert model_output.shape == (B, C * 2, *x.shape[2:])
@@ -350,10 +409,10 @@ class GaussianDiffusion:
                 model_log_variance = model_var_values
                 model_variance = th.exp(model_log_variance)
             else:
-                min_log = _extract_into_tensor(
-                    self.posterior_log_variance_clipped, t, x.shape
+                min_log = self._extract(
+                    "posterior_log_variance_clipped", t, x.shape
                 )
-                max_log = _extract_into_tensor(np.log(self.betas), t, x.shape)
+                max_log = self._extract("log_betas", t, x.shape)
                 # The model_var_values is [-1, 1] for [min_var, max_var].
                 frac = (model_var_values + 1) / 2
                 model_log_variance = frac * max_log + (1 - frac) * min_log
@@ -376,7 +435,8 @@ class GaussianDiffusion:
 
         if self.conditioning_free:
             if self.ramp_conditioning_free:
-                assert t.shape[0] == 1  # This should only be used in inference.
+                # This should only be used in inference, where a batch is sampled at one timestep (see p_sample_loop).
+                assert (t == t[0]).all()
                 cfk = self.conditioning_free_k * (1 - self._scale_timesteps(t)[0].item() / self.num_timesteps)
             else:
                 cfk = self.conditioning_free_k
@@ -420,8 +480,8 @@ class GaussianDiffusion:
     def _predict_xstart_from_eps(self, x_t, t, eps):
         assert x_t.shape == eps.shape
         return (
-            _extract_into_tensor(self.sqrt_recip_alphas_cumprod, t, x_t.shape) * x_t
-            - _extract_into_tensor(self.sqrt_recipm1_alphas_cumprod, t, x_t.shape) * eps
+            self._extract("sqrt_recip_alphas_cumprod", t, x_t.shape) * x_t
+            - self._extract("sqrt_recipm1_alphas_cumprod", t, x_t.shape) * eps
         )
 
     def _predict_xstart_from_xprev(self, x_t, t, xprev):
@@ -436,9 +496,9 @@ class GaussianDiffusion:
 
     def _predict_eps_from_xstart(self, x_t, t, pred_xstart):
         return (
-            _extract_into_tensor(self.sqrt_recip_alphas_cumprod, t, x_t.shape) * x_t
+            self._extract("sqrt_recip_alphas_cumprod", t, x_t.shape) * x_t
             - pred_xstart
-        ) / _extract_into_tensor(self.sqrt_recipm1_alphas_cumprod, t, x_t.shape)
+        ) / self._extract("sqrt_recipm1_alphas_cumprod", t, x_t.shape)
 
     def _scale_timesteps(self, t):
         if self.rescale_timesteps:
@@ -470,7 +530,7 @@ class GaussianDiffusion:
         Unlike condition_mean(), this instead uses the conditioning strategy
         from Song et al (2020).
         """
-        alpha_bar = _extract_into_tensor(self.alphas_cumprod, t, x.shape)
+        alpha_bar = self._extract("alphas_cumprod", t, x.shape)
 
         eps = self._predict_eps_from_xstart(x, t, p_mean_var["pred_xstart"])
         eps = eps - (1 - alpha_bar).sqrt() * cond_fn(
@@ -530,6 +590,17 @@ class GaussianDiffusion:
         sample = out["mean"] + nonzero_mask * th.exp(0.5 * out["log_variance"]) * noise
         return {"sample": sample, "pred_xstart": out["pred_xstart"]}
 
+    def sample_loop(self, model, shape, **kwargs):
+        """
+        Generate samples from the model with the sampling loop of self.sampler.
+
+        Same usage as p_sample_loop(); the DPM-Solver++ samplers take no cond_fn.
+        """
+        loop = SAMPLERS[self.sampler][1]
+        if loop == "dpm_solver_sample_loop" and kwargs.pop("cond_fn", None) is not None:
+            raise ValueError(f"cond_fn is not supported by the {self.sampler} sampler")
+        return getattr(self, loop)(model, shape, **kwargs)
+
     def p_sample_loop(
         self,
         model,
@@ -651,8 +722,8 @@ class GaussianDiffusion:
         # in case we used x_start or x_prev prediction.
         eps = self._predict_eps_from_xstart(x, t, out["pred_xstart"])
 
-        alpha_bar = _extract_into_tensor(self.alphas_cumprod, t, x.shape)
-        alpha_bar_prev = _extract_into_tensor(self.alphas_cumprod_prev, t, x.shape)
+        alpha_bar = self._extract("alphas_cumprod", t, x.shape)
+        alpha_bar_prev = self._extract("alphas_cumprod_prev", t, x.shape)
         sigma = (
             eta
             * th.sqrt((1 - alpha_bar_prev) / (1 - alpha_bar))
@@ -695,10 +766,10 @@ class GaussianDiffusion:
         # Usually our model outputs epsilon, but we re-derive it
         # in case we used x_start or x_prev prediction.
         eps = (
-            _extract_into_tensor(self.sqrt_recip_alphas_cumprod, t, x.shape) * x
+            self._extract("sqrt_recip_alphas_cumprod", t, x.shape) * x
             - out["pred_xstart"]
-        ) / _extract_into_tensor(self.sqrt_recipm1_alphas_cumprod, t, x.shape)
-        alpha_bar_next = _extract_into_tensor(self.alphas_cumprod_next, t, x.shape)
+        ) / self._extract("sqrt_recipm1_alphas_cumprod", t, x.shape)
+        alpha_bar_next = self._extract("alphas_cumprod_next", t, x.shape)
 
         # Equation 12. reversed
         mean_pred = (
@@ -792,6 +863,101 @@ class GaussianDiffusion:
                 yield out
                 img = out["sample"]
 
+    def dpm_solver_sample_loop(
+        self,
+        model,
+        shape,
+        noise=None,
+        clip_denoised=True,
+        denoised_fn=None,
+        model_kwargs=None,
+        device=None,
+        progress=False,
+    ):
+        """
+        Generate samples from the model using DPM-Solver++(2M).
+
+        Same usage as p_sample_loop(), without cond_fn.
+        """
+        final = None
+        for sample in self.dpm_solver_sample_loop_progressive(
+            model,
+            shape,
+            noise=noise,
+            clip_denoised=clip_denoised,
+            denoised_fn=denoised_fn,
+            model_kwargs=model_kwargs,
+            device=device,
+            progress=progress,
+        ):
+            final = sample
+        return final["sample"]
+
+    def dpm_solver_sample_loop_progressive(
+        self,
+        model,
+        shape,
+        noise=None,
+        clip_denoised=True,
+        denoised_fn=None,
+        model_kwargs=None,
+        device=None,
+        progress=False,
+    ):
+        """
+        Use DPM-Solver++(2M) to sample from the model and yield intermediate
+        samples from each timestep.
+
+        DPM-Solver++ (Lu et al., https://arxiv.org/abs/2211.01095) solves the
+        probability flow ODE in terms of the x_0 prediction. The 2M variant is
+        second order and reuses the previous step's prediction instead of
+        evaluating the model twice per step, so it reaches the quality of many
+        more ancestral steps with 10-25 model evaluations. The final step is
+        first order, landing on the x_0 prediction.
+
+        Same usage as p_sample_loop_progressive(), without cond_fn.
+        """
+        if device is None:
+            device = next(model.parameters()).device
+        assert isinstance(shape, (tuple, list))
+        if noise is not None:
+            img = noise
+        else:
+            img = th.randn(*shape, device=device)
+        indices = list(range(self.num_timesteps))[::-1]
+
+        alphas = np.sqrt(self.alphas_cumprod)
+        sigmas = np.sqrt(1.0 - self.alphas_cumprod)
+        lambdas = np.log(alphas) - np.log(sigmas)
+        prev_xstart = None
+        prev_h = None
+        for i in tqdm(indices, disable=not progress):
+            t = th.tensor([i] * shape[0], device=device)
+            with th.no_grad():
+                out = self.p_mean_variance(
+                    model,
+                    img,
+                    t,
+                    clip_denoised=clip_denoised,
+                    denoised_fn=denoised_fn,
+                    model_kwargs=model_kwargs,
+                )
+                pred_xstart = out["pred_xstart"]
+                if i == 0:
+                    sample = pred_xstart
+                else:
+                    # Step from timestep i to i - 1.
+                    h = lambdas[i - 1] - lambdas[i]
+                    denoised = pred_xstart
+                    if prev_xstart is not None:
+                        r = prev_h / h
+                        denoised = (1 + 1 / (2 * r)) * pred_xstart - (1 / (2 * r)) * prev_xstart
+                    sample = float(sigmas[i - 1] / sigmas[i]) * img - float(alphas[i - 1] * np.expm1(-h)) * denoised
+                    prev_h = h
+                prev_xstart = pred_xstart
+                yield {"sample": sample, "pred_xstart": pred_xstart}
+                img = sample
+
     def _vb_terms_bpd(
         self, model, x_start, x_t, t, clip_denoised=True, model_kwargs=None
     ):
@@ -1114,6 +1280,8 @@ class SpacedDiffusion(GaussianDiffusion):
                 self.timestep_map.append(i)
         kwargs["betas"] = np.array(new_betas)
         super().__init__(**kwargs)
+        # The last wrapper handed out per kind, reused while the model stays the same.
+        self._wrapped = {}
 
     def p_mean_variance(
         self, model, *args, **kwargs
@@ -1139,10 +1307,14 @@ class SpacedDiffusion(GaussianDiffusion):
     def _wrap_model(self, model, autoregressive=False):
         if isinstance(model, _WrappedModel) or isinstance(model, _WrappedAutoregressiveModel):
             return model
-        mod = _WrappedAutoregressiveModel if autoregressive else _WrappedModel
-        return mod(
-            model, self.timestep_map, self.rescale_timesteps, self.original_num_steps
-        )
+        wrapped = self._wrapped.get(autoregressive)
+        if wrapped is None or wrapped.model is not model:
+            mod = _WrappedAutoregressiveModel if autoregressive else _WrappedModel
+            wrapped = mod(
+                model, self.timestep_map, self.rescale_timesteps, self.original_num_steps
+            )
+            self._wrapped[autoregressive] = wrapped
+        return wrapped
 
     def _scale_timesteps(self, t):
         # Scaling is done by the wrapped model.
@@ -1205,16 +1377,69 @@ def space_timesteps(num_timesteps, section_counts):
     return set(all_steps)
 
 
+def karras_timesteps(betas, count, rho=7.0):
+    """
+    Pick `count` timesteps of the diffusion process with the given betas whose
+    noise levels sigma = sqrt((1 - alpha_bar) / alpha_bar) follow the schedule
+    of Karras et al. (https://arxiv.org/abs/2206.00364): evenly spaced in
+    sigma ** (1 / rho), i.e. concentrated at low noise levels.
+
+    :return: a set of diffusion steps from the original process to use.
+    """
+    alphas_cumprod = np.cumprod(1.0 - np.asarray(betas, dtype=np.float64))
+    sigmas = np.sqrt((1.0 - alphas_cumprod) / alphas_cumprod)
+    if count > len(sigmas):
+        raise ValueError(f"cannot pick {count} steps from {len(sigmas)}")
+    ramp = np.linspace(0, 1, count)
+    max_inv_rho = sigmas[-1] ** (1 / rho)
+    min_inv_rho = sigmas[0] ** (1 / rho)
+    targets = (max_inv_rho + ramp * (min_inv_rho - max_inv_rho)) ** rho
+    steps = []
+    # Lowest noise first. Each step is the one nearest to its target, moved up
+    # past the previous step when the low-noise end is crowded, and kept low
+    # enough to leave a distinct step for every remaining target.
+    for i, target in enumerate(targets[::-1]):
+        step = int(np.abs(np.log(sigmas) - np.log(target)).argmin())
+        lowest = steps[-1] + 1 if steps else 0
+        highest = len(sigmas) - (count - i)
+        steps.append(min(max(step, lowest), highest))
+    return set(steps)
+
+
+# Samplers selectable with GaussianDiffusion(sampler=...): how the timesteps
+# of a SpacedDiffusion are picked, and the sampling loop run by sample_loop().
+SAMPLERS = {
+    "p": ("uniform", "p_sample_loop"),  # Ancestral sampling.
+    "ddim": ("uniform", "ddim_sample_loop"),
+    "dpm++2m": ("uniform", "dpm_solver_sample_loop"),
+    "dpm++2m-karras": ("karras", "dpm_solver_sample_loop"),
+}
+
+
+def sampler_timesteps(sampler, betas, count):
+    """
+    The timesteps of the process with `betas` that `sampler` (see SAMPLERS)
+    uses when sampling in `count` steps.
+    """
+    if sampler not in SAMPLERS:
+        raise ValueError(f"Unknown sampler: {sampler}. Options: {', '.join(SAMPLERS)}")
+    if SAMPLERS[sampler][0] == "karras":
+        return karras_timesteps(betas, count)
+    return space_timesteps(len(betas), [count])
+
+
 class _WrappedModel:
     def __init__(self, model, timestep_map, rescale_timesteps, original_num_steps):
         self.model = model
         self.timestep_map = timestep_map
         self.rescale_timesteps = rescale_timesteps
         self.original_num_steps = original_num_steps
+        # Traced models do not have it and keep the two-pass conditioning-free guidance.
+        self.fused_conditioning_free = getattr(model, "fused_conditioning_free", False)
+        self._map_tensors = {}
 
     def __call__(self, x, ts, **kwargs):
-        map_tensor = th.tensor(self.timestep_map, device=ts.device, dtype=ts.dtype)
-        new_ts = map_tensor[ts]
+        new_ts = _map_timesteps(self._map_tensors, self.timestep_map, ts)
         if self.rescale_timesteps:
             new_ts = new_ts.float() * (1000.0 / self.original_num_steps)
         return self.model(x, new_ts, **kwargs)
@@ -1226,25 +1451,36 @@ class _WrappedAutoregressiveModel:
         self.timestep_map = timestep_map
         self.rescale_timesteps = rescale_timesteps
         self.original_num_steps = original_num_steps
+        self._map_tensors = {}
 
     def __call__(self, x, x0, ts, **kwargs):
-        map_tensor = th.tensor(self.timestep_map, device=ts.device, dtype=ts.dtype)
-        new_ts = map_tensor[ts]
+        new_ts = _map_timesteps(self._map_tensors, self.timestep_map, ts)
         if self.rescale_timesteps:
             new_ts = new_ts.float() * (1000.0 / self.original_num_steps)
         return self.model(x, x0, new_ts, **kwargs)
 
+
+def _map_timesteps(map_tensors, timestep_map, ts):
+    """Maps spaced timesteps to the original ones, with timestep_map kept as a tensor per device and dtype."""
+    key = (ts.device, ts.dtype)
+    map_tensor = map_tensors.get(key)
+    if map_tensor is None:
+        map_tensor = map_tensors[key] = th.tensor(timestep_map, device=ts.device, dtype=ts.dtype)
+    return map_tensor[ts]
+
 def _extract_into_tensor(arr, timesteps, broadcast_shape):
     """
     Extract values from a 1-D numpy array for a batch of indices.
 
-    :param arr: the 1-D numpy array.
+    :param arr: the 1-D numpy array, or a 1-D tensor on the device of timesteps.
     :param timesteps: a tensor of indices into the array to extract.
     :param broadcast_shape: a larger shape of K dimensions with the batch
                             dimension equal to the length of timesteps.
     :return: a tensor of shape [batch_size, 1, ...] where the shape has K dims.
     """
-    res = th.from_numpy(arr.astype(np.float32)).to(device=timesteps.device)[timesteps]
+    if not th.is_tensor(arr):
+        arr = th.from_numpy(arr.astype(np.float32)).to(device=timesteps.device)
+    res = arr[timesteps]
     while len(res.shape) < len(broadcast_shape):
         res = res[..., None]
     return res.expand(broadcast_shape)
\ No newline at end of file
@@ -0,0 +1,284 @@
+"""
+Instrumentation for the synthesis pipeline.
+
+TextToSpeech(hooks=...) reports the wall time of every pipeline stage and a few counters to a PipelineHooks object.
+Subclass PipelineHooks to forward them anywhere (logs, tracing, StatsD...); MetricsHooks records them in a
+MetricsRegistry, which renders the Prometheus text exposition format without needing prometheus_client.
+
+Stages: tokenization, conditioning, autoregressive, clvp, latents (recomputing the AR latents of the best candidates),
+diffusion, vocoder, redaction, and upload (reported by the Storybook API).
+Counters: cache_hits, cache_misses, tokens_generated, samples_discarded, samples_skipped (autoregressive samples not
+drawn because the candidate search stopped early), latents_reused.
+"""
+
+import threading
+from contextlib import contextmanager
+from time import perf_counter
+
+import torch
+
+
+STAGES = ('tokenization', 'conditioning', 'autoregressive', 'clvp', 'latents', 'diffusion', 'vocoder', 'redaction',
+          'upload')
+COUNTERS = ('cache_hits', 'cache_misses', 'tokens_generated', 'samples_discarded', 'samples_skipped', 'latents_reused')
+
+# Stage durations range from milliseconds (tokenization) to minutes (diffusion of long clips on CPU).
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 25, 60, 120, 300)
+
+
+class PipelineHooks:
+    """
+    Receives pipeline events. All methods are no-ops; override the ones you need. Hooks are called from the thread
+    running the synthesis and must be thread-safe if one hooks object is shared by several engines.
+
+    synchronize: when True, CUDA is synchronized around each stage so that asynchronous kernels are charged to the
+    stage that launched them. That costs a little throughput, so it is up to the hooks.
+    """
+    synchronize = False
+
+    def on_stage(self, stage, seconds):
+        pass
+
+    def on_count(self, name, value=1):
+        pass
+
+
+class CompositeHooks(PipelineHooks):
+    """Fans events out to several hooks."""
+
+    def __init__(self, *hooks):
+        self.hooks = [h for h in hooks if h is not None]
+        self.synchronize = any(h.synchronize for h in self.hooks)
+
+    def on_stage(self, stage, seconds):
+        for h in self.hooks:
+            h.on_stage(stage, seconds)
+
+    def on_count(self, name, value=1):
+        for h in self.hooks:
+            h.on_count(name, value)
+
+
+def _synchronize(device):
+    if device is not None and torch.device(device).type == 'cuda':
+        torch.cuda.synchronize(device)
+
+
+@contextmanager
+def timed_stage(hooks, stage, device=None):
+    """Times the enclosed block and reports it as `stage`. Does nothing when hooks is None."""
+    if hooks is None:
+        yield
+        return
+    if hooks.synchronize:
+        _synchronize(device)
+    start = perf_counter()
+    try:
+        yield
+    finally:
+        if hooks.synchronize:
+            _synchronize(device)
+        hooks.on_stage(stage, perf_counter() - start)
+
+
+class StageTimer:
+    """
+    Times a stage that runs in several pieces, interleaved with other stages: each `with timer:` block adds to the
+    total, and report() sends it to the hooks as a single observation.
+    """
+
+    def __init__(self, hooks, stage, device=None):
+        self.hooks = hooks
+        self.stage = stage
+        self.device = device
+        self.seconds = 0.
+
+    def __enter__(self):
+        if self.hooks is not None and self.hooks.synchronize:
+            _synchronize(self.device)
+        self._start = perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        if self.hooks is not None and self.hooks.synchronize:
+            _synchronize(self.device)
+        self.seconds += perf_counter() - self._start
+
+    def report(self):
+        if self.hooks is not None:
+            self.hooks.on_stage(self.stage, self.seconds)
+
+
+def count(hooks, name, value=1):
+    if hooks is not None:
+        hooks.on_count(name, value)
+
+
+# ------------------------------------------------------------------------------
+# Metrics in the Prometheus text format
+# ------------------------------------------------------------------------------
+def _format_labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ''
+    escaped = (str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, v in pairs)
+    return '{' + ','.join(f'{k}="{v}"' for (k, _), v in zip(pairs, escaped)) + '}'
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class _Metric:
+    type = None
+
+    def __init__(self, name, help, labelnames=()):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def _key(self, labels):
+        if set(labels) != set(self.labelnames):
+            raise ValueError(f'{self.name} expects labels {self.labelnames}, got {tuple(labels)}')
+        return tuple(labels[n] for n in self.labelnames)
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} {self.type}']
+        with self._lock:
+            items = sorted(self._values.items())
+        for key, value in items:
+            lines.extend(self._render_sample(key, value))
+        return lines
+
+    def _render_sample(self, key, value):
+        return [f'{self.name}{_format_labels(self.labelnames, key)} {_format_value(value)}']
+
+
+class Counter(_Metric):
+    type = 'counter'
+
+    def __init__(self, name, help, labelnames=()):
+        super().__init__(name, help, labelnames)
+        if not self.labelnames:
+            self._values[()] = 0  # Export unlabelled counters from the start.
+
+    def inc(self, value=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + value
+
+    def get(self, **labels):
+        with self._lock:
+            return self._values.get(self._key(labels), 0)
+
+
+class Gauge(_Metric):
+    type = 'gauge'
+
+    def set(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+
+class Histogram(_Metric):
+    type = 'histogram'
+
+    def __init__(self, name, help, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, help, labelnames)
+        self.buckets = tuple(sorted(buckets)) + (float('inf'),)
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            state = self._values.get(key)
+            if state is None:
+                state = self._values[key] = [[0] * len(self.buckets), 0.0, 0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    state[0][i] += 1
+            state[1] += value
+            state[2] += 1
+
+    def get(self, **labels):
+        """Returns (count, sum) for the given labels."""
+        with self._lock:
+            state = self._values.get(self._key(labels))
+            return (state[2], state[1]) if state is not None else (0, 0.0)
+
+    def _render_sample(self, key, state):
+        buckets, total, n = state
+        lines = [f'{self.name}_bucket{_format_labels(self.labelnames, key, [("le", _format_value(b))])} {c}'
+                 for b, c in zip(self.buckets, buckets)]
+        lines.append(f'{self.name}_sum{_format_labels(self.labelnames, key)} {_format_value(total)}')
+        lines.append(f'{self.name}_count{_format_labels(self.labelnames, key)} {n}')
+        return lines
+
+
+class MetricsRegistry:
+    CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+    def __init__(self):
+        self._metrics = {}
+        self._lock = threading.Lock()
+
+    def _register(self, metric):
+        with self._lock:
+            existing = self._metrics.get(metric.name)
+            if existing is not None:
+                if type(existing) is not type(metric) or existing.labelnames != metric.labelnames:
+                    raise ValueError(f'Metric {metric.name} is already registered with a different type or labels.')
+                return existing
+            self._metrics[metric.name] = metric
+            return metric
+
+    def counter(self, name, help, labelnames=()):
+        return self._register(Counter(name, help, labelnames))
+
+    def gauge(self, name, help, labelnames=()):
+        return self._register(Gauge(name, help, labelnames))
+
+    def histogram(self, name, help, labelnames=(), buckets=DEFAULT_BUCKETS):
+        return self._register(Histogram(name, help, labelnames, buckets))
+
+    def render(self):
+        with self._lock:
+            metrics = list(self._metrics.values())
+        lines = []
+        for metric in metrics:
+            lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
+
+
+class MetricsHooks(PipelineHooks):
+    """
+    Records pipeline events in `registry`:
+        tortoise_stage_seconds{stage=...}    histogram of stage durations
+        tortoise_<counter>_total             one counter per entry of COUNTERS (and any other name reported)
+    """
+
+    def __init__(self, registry=None, synchronize=True, buckets=DEFAULT_BUCKETS):
+        self.registry = MetricsRegistry() if registry is None else registry
+        self.synchronize = synchronize
+        self.stage_seconds = self.registry.histogram('tortoise_stage_seconds', 'Wall time of each synthesis stage.',
+                                                     ('stage',), buckets)
+        self.counters = {}
+        for name in COUNTERS:
+            self._counter(name)
+
+    def _counter(self, name):
+        counter = self.counters.get(name)
+        if counter is None:
+            counter = self.counters[name] = self.registry.counter(f'tortoise_{name}_total',
+                                                                  f'Total {name.replace("_", " ")}.')
+        return counter
+
+    def on_stage(self, stage, seconds):
+        self.stage_seconds.observe(seconds, stage=stage)
+
+    def on_count(self, name, value=1):
+        self._counter(name).inc(value)
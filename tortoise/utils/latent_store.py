@@ -0,0 +1,50 @@
+"""
+Bounded store for the autoregressive latents captured while sampling.
+
+With TextToSpeech(reuse_ar_latents=True), inference_speech() also returns the final-norm hidden state of every sampling
+step (the same values tortoise.models.stream_generator's sample_stream yields). They are kept here per candidate so
+that, once CLVP has picked the best candidates, their latents can be looked up instead of re-running the autoregressive
+model over them. The store has a byte budget; batches that do not fit are dropped, and their candidates fall back to
+the recomputation pass.
+"""
+
+
+class LatentStore:
+    """
+    :param max_bytes: Maximum bytes of latents held at once.
+    """
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.bytes = 0
+        self._batches = []  # (first candidate index, latents (b,s,d) or None)
+        self._count = 0
+
+    def __len__(self):
+        return self._count
+
+    def add_batch(self, latents, batch_size):
+        """
+        Stores the latents (batch_size, steps, dim) of the next `batch_size` candidates; pass latents=None, or exceed the
+        budget, to record them as missing.
+        """
+        if latents is not None:
+            size = latents.numel() * latents.element_size()
+            if self.bytes + size > self.max_bytes:
+                latents = None
+            else:
+                self.bytes += size
+        self._batches.append((self._count, latents))
+        self._count += batch_size
+
+    def get(self, index):
+        """Latents (steps, dim) of candidate `index`, or None if they were not kept."""
+        for first, latents in reversed(self._batches):
+            if index >= first:
+                return None if latents is None else latents[index - first]
+        return None
+
+    def clear(self):
+        self._batches = []
+        self._count = 0
+        self.bytes = 0
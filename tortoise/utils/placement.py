@@ -0,0 +1,136 @@
+"""
+Placement of the TextToSpeech sub-models (autoregressive, CLVP, CVVP, diffusion, vocoder) between uses.
+
+The original pipeline moved every model to the GPU before each stage and back to the CPU after it, paying the weight
+transfer on every call. A ModelPlacement keeps models on the compute device instead, according to a policy:
+
+    'all-resident'  A model stays on the device once it has been used.
+    'offload-lru'   Models stay resident while they fit in `budget` bytes; when a model does not fit, the least
+                    recently used models that are not in use are moved back to the CPU to make room.
+    'cpu-only'      Everything runs on the CPU.
+
+On the CPU every operation is a no-op, so no weights are ever copied.
+"""
+
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+
+import torch
+
+
+POLICIES = ('all-resident', 'offload-lru', 'cpu-only')
+
+# Share of the GPU's memory that 'offload-lru' lets resident weights occupy by default; the rest is left for
+# activations, the KV cache and the diffusion batch.
+DEFAULT_BUDGET_FRACTION = 0.5
+
+
+def model_bytes(model):
+    """Bytes taken by the parameters and buffers of `model`."""
+    tensors = list(model.parameters()) + list(model.buffers())
+    return sum(t.numel() * t.element_size() for t in tensors)
+
+
+def default_budget(device):
+    """DEFAULT_BUDGET_FRACTION of the CUDA device's memory; None (unlimited) for other devices."""
+    if device.type == 'cuda':
+        return int(torch.cuda.get_device_properties(device).total_memory * DEFAULT_BUDGET_FRACTION)
+    return None
+
+
+class ModelPlacement:
+    """
+    :param device: Compute device the models run on.
+    :param policy: One of POLICIES.
+    :param budget: 'offload-lru' only: bytes of device memory the resident models may occupy. Defaults to
+                   default_budget(device). A model larger than the whole budget is still loaded for its stage and
+                   offloaded right after.
+    """
+
+    def __init__(self, device, policy='offload-lru', budget=None):
+        if policy not in POLICIES:
+            raise ValueError(f'Unknown placement policy "{policy}". Options: {", ".join(POLICIES)}')
+        self.policy = policy
+        self.device = torch.device('cpu') if policy == 'cpu-only' else torch.device(device)
+        self.budget = budget if budget is not None or policy != 'offload-lru' else default_budget(self.device)
+        self._resident = OrderedDict()  # id(model) -> (model, bytes), least recently used first
+        self._in_use = {}  # id(model) -> number of active fetches
+        self._lock = threading.Lock()
+        self.transfers = 0  # Host -> device model moves, for monitoring.
+
+    @property
+    def resident_bytes(self):
+        return sum(size for _, size in self._resident.values())
+
+    def fetch(self, model):
+        """Makes sure `model` is on the compute device and marks it as in use until release()."""
+        if self.device.type == 'cpu':
+            return model
+        key = id(model)
+        with self._lock:
+            if key not in self._resident:
+                size = model_bytes(model)
+                if self.policy == 'offload-lru':
+                    self._evict(size)
+                model.to(self.device)
+                self.transfers += 1
+                self._resident[key] = (model, size)
+            self._resident.move_to_end(key)
+            self._in_use[key] = self._in_use.get(key, 0) + 1
+        return model
+
+    def release(self, model):
+        if self.device.type == 'cpu':
+            return
+        key = id(model)
+        with self._lock:
+            self._in_use[key] -= 1
+            if not self._in_use[key]:
+                del self._in_use[key]
+            if self.policy == 'offload-lru':
+                # Only over budget when a model larger than the budget had to be loaded.
+                self._evict(0)
+
+    @contextmanager
+    def use(self, model):
+        """Context manager form of fetch()/release()."""
+        self.fetch(model)
+        try:
+            yield model
+        finally:
+            self.release(model)
+
+    def offload(self, model):
+        """Moves `model` back to the CPU (for stages that deliberately run on the CPU)."""
+        key = id(model)
+        with self._lock:
+            if key in self._resident:
+                del self._resident[key]
+            model.cpu()
+        return model
+
+    def _evict(self, needed):
+        """Offloads unused models, least recently used first, until `needed` more bytes fit. Caller holds the lock."""
+        if self.budget is None:
+            return
+        total = self.resident_bytes
+        for key in list(self._resident):
+            if total + needed <= self.budget:
+                break
+            if key in self._in_use:
+                continue
+            model, size = self._resident.pop(key)
+            model.cpu()
+            total -= size
+
+    def status(self):
+        with self._lock:
+            return {
+                'policy': self.policy,
+                'device': str(self.device),
+                'budget_bytes': self.budget,
+                'resident_bytes': self.resident_bytes,
+                'resident_models': [type(model).__name__ for model, _ in self._resident.values()],
+                'transfers': self.transfers,
+            }
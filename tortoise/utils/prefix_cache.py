@@ -0,0 +1,87 @@
+"""
+LRU cache of prefilled autoregressive prompts.
+
+Every generate() call starts by running the GPT over its prompt: the conditioning latent, the text tokens and the start
+token. Pages rendered with the same voice, and retries of the same text, run the identical prompt again. With a
+PrefixCache attached to the GPT2InferenceModel (TextToSpeech(prefix_cache=...)), the keys/values and final hidden states
+of each prompt row are kept on the device, and a later call whose prompt rows are all cached skips the prompt pass.
+tortoise.utils.stream_engine.StreamingEngine uses the cache of its TextToSpeech's model for joining sessions as well.
+
+Entries are keyed by prefix_key(): a hash of the prompt embedding row (conditioning latent and text embeddings), the
+prompt token ids and the dtype/autocast state they were computed under. They belong to one model: do not share a cache
+between models with different weights.
+"""
+import threading
+from collections import OrderedDict
+
+import torch
+
+from tortoise.utils.result_cache import hash_tensors
+
+
+def prefix_key(prompt_emb, prompt_ids=None):
+    """
+    :param prompt_emb: (seq, dim) conditioning + text embeddings of one prompt row.
+    :param prompt_ids: (seq,) token ids of the same row, including the start token and any input tokens. May be
+                       omitted when prompt_emb already embeds every token.
+    """
+    autocast = None
+    if torch.is_autocast_enabled():
+        autocast = torch.get_autocast_dtype('cuda') if hasattr(torch, 'get_autocast_dtype') else torch.get_autocast_gpu_dtype()
+    ids = None if prompt_ids is None else tuple(prompt_ids.tolist())
+    return (hash_tensors(prompt_emb), ids, str(prompt_emb.dtype), str(autocast))
+
+
+class PrefixCache:
+    """
+    :param max_bytes: Budget for the tensors held by the cache (device memory when the model runs on a GPU). Least
+                      recently used prompts are evicted first; an entry larger than the budget is not stored.
+    """
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()  # key -> (tensors, size in bytes), oldest first
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key):
+        """Tuple of tensors stored for `key`, or None."""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def put(self, key, tensors):
+        """Stores a tuple of tensors (copies of them, so they do not keep larger batches alive)."""
+        tensors = tuple(t.detach().clone() for t in tensors)
+        size = sum(t.numel() * t.element_size() for t in tensors)
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self.bytes -= old[1]
+            self._entries[key] = (tensors, size)
+            self.bytes += size
+            while self.bytes > self.max_bytes:
+                _, (_, evicted) = self._entries.popitem(last=False)
+                self.bytes -= evicted
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.bytes = 0
+
+    def stats(self):
+        with self._lock:
+            return {'entries': len(self._entries), 'bytes': self.bytes, 'max_bytes': self.max_bytes,
+                    'hits': self.hits, 'misses': self.misses}
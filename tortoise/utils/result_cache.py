@@ -0,0 +1,193 @@
+import hashlib
+import io
+import json
+import os
+import threading
+import uuid
+from collections import OrderedDict
+
+import torch
+
+
+# Bump when anything about how results are produced changes in a way that should invalidate stored entries.
+CACHE_FORMAT_VERSION = 1
+
+
+def hash_tensors(tensors):
+    """
+    Stable content hash of a (possibly nested) list/tuple of tensors. Used as the voice identity of a request.
+    """
+    h = hashlib.sha256()
+
+    def _update(t):
+        if isinstance(t, (list, tuple)):
+            h.update(f'seq{len(t)}'.encode())
+            for x in t:
+                _update(x)
+            return
+        t = t.detach().cpu().contiguous()
+        h.update(f'{t.dtype}{tuple(t.shape)}'.encode())
+        h.update(t.numpy().tobytes() if t.dtype != torch.bfloat16 else t.float().numpy().tobytes())
+
+    _update(tensors)
+    return h.hexdigest()
+
+
+def hash_voice(voice_samples=None, conditioning_latents=None):
+    """
+    Identity of the voice a tts() call will use. Mirrors the precedence in TextToSpeech.tts(): clips win over latents,
+    and neither means the (deterministic) random latents.
+    """
+    if voice_samples is not None:
+        return 'clips:' + hash_tensors(voice_samples)
+    if conditioning_latents is not None:
+        return 'latents:' + hash_tensors(conditioning_latents)
+    return 'random'
+
+
+def make_cache_key(text_tokens, voice_hash, settings, seed):
+    """
+    Content address of a synthesis result.
+    :param text_tokens: Token ids produced by VoiceBpeTokenizer.encode() (already normalized by its cleaners).
+    :param voice_hash: Output of hash_voice().
+    :param settings: Dict of every generation setting that affects the output.
+    :param seed: The deterministic seed. Results produced without a fixed seed must not be cached.
+    """
+    payload = {
+        'v': CACHE_FORMAT_VERSION,
+        'tokens': [int(t) for t in text_tokens],
+        'voice': voice_hash,
+        'settings': settings,
+        'seed': seed,
+    }
+    return hashlib.sha256(json.dumps(payload, sort_keys=True, default=str).encode('utf-8')).hexdigest()
+
+
+def _serialize(result):
+    buffer = io.BytesIO()
+    if isinstance(result, list):
+        torch.save([r.detach().cpu() for r in result], buffer)
+    else:
+        torch.save(result.detach().cpu(), buffer)
+    return buffer.getvalue()
+
+
+def _deserialize(data):
+    return torch.load(io.BytesIO(data), map_location='cpu')
+
+
+class SynthesisCache:
+    """
+    Content-addressed cache of finished tts() outputs.
+
+    Entries live as files under `cache_dir` and are evicted least-recently-used first once their total size exceeds
+    `max_bytes`. Recency is tracked through file modification times, so the cache survives restarts.
+
+    Several processes on one host may point at the same directory: an entry another process wrote after this one
+    scanned the directory is picked up (and counted) when it is first looked up. The budget is enforced by each process
+    over the entries it knows about, so the directory can hold up to `max_bytes` per process.
+
+    :param cache_dir: Directory for the on-disk tier.
+    :param max_bytes: Size budget of the on-disk tier.
+    :param remote: Optional shared tier, any object with get(key) -> bytes|None and put(key, bytes). Disk misses are
+                   looked up there and new results are written through to it.
+    """
+
+    def __init__(self, cache_dir, max_bytes=2 * 1024 ** 3, remote=None):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.remote = remote
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._index = OrderedDict()  # key -> size in bytes, oldest first
+        self._total_bytes = 0
+        os.makedirs(cache_dir, exist_ok=True)
+        self._scan()
+
+    def _path(self, key):
+        return os.path.join(self.cache_dir, key[:2], key + '.pt')
+
+    def _scan(self):
+        entries = []
+        for root, _, files in os.walk(self.cache_dir):
+            for f in files:
+                if not f.endswith('.pt'):
+                    continue
+                st = os.stat(os.path.join(root, f))
+                entries.append((st.st_mtime, f[:-3], st.st_size))
+        for _, key, size in sorted(entries):
+            self._index[key] = size
+            self._total_bytes += size
+
+    def _evict(self):
+        while self._total_bytes > self.max_bytes and self._index:
+            key, size = self._index.popitem(last=False)
+            self._total_bytes -= size
+            try:
+                os.remove(self._path(key))
+            except FileNotFoundError:
+                pass
+
+    def _write_local(self, key, data):
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp = f'{path}.{uuid.uuid4().hex}.tmp'
+        with open(tmp, 'wb') as f:
+            f.write(data)
+        os.replace(tmp, path)
+        with self._lock:
+            self._total_bytes -= self._index.pop(key, 0)
+            self._index[key] = len(data)
+            self._total_bytes += len(data)
+            self._evict()
+
+    def _read_local(self, key):
+        path = self._path(key)
+        with self._lock:
+            if key in self._index:
+                self._index.move_to_end(key)
+            else:
+                # Not written or seen by this process; another one sharing the directory may have stored it.
+                try:
+                    size = os.stat(path).st_size
+                except FileNotFoundError:
+                    return None
+                self._index[key] = size
+                self._total_bytes += size
+                self._evict()
+        try:
+            with open(path, 'rb') as f:
+                data = f.read()
+            os.utime(path)
+        except FileNotFoundError:
+            # Evicted by another process sharing the directory.
+            with self._lock:
+                self._total_bytes -= self._index.pop(key, 0)
+            return None
+        return data
+
+    def get(self, key):
+        """Returns the cached result for `key` (a tensor or list of tensors on the CPU), or None."""
+        data = self._read_local(key)
+        if data is None and self.remote is not None:
+            data = self.remote.get(key)
+            if data is not None:
+                self._write_local(key, data)
+        with self._lock:
+            if data is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+        return _deserialize(data)
+
+    def put(self, key, result):
+        data = _serialize(result)
+        self._write_local(key, data)
+        if self.remote is not None:
+            self.remote.put(key, data)
+
+    def stats(self):
+        with self._lock:
+            return {'entries': len(self._index), 'bytes': self._total_bytes, 'max_bytes': self.max_bytes,
+                    'hits': self.hits, 'misses': self.misses}
@@ -0,0 +1,362 @@
+"""
+Continuous batching of concurrent streaming sessions.
+
+tortoise.api_fast.TextToSpeech.tts_stream runs its own generate() loop at batch size 1, so N listeners cost N
+autoregressive forward passes per token. StreamingEngine owns one api_fast.TextToSpeech and a decoding thread that
+advances every active session by one token in a single batched forward pass:
+
+- Sessions join and leave the batch at token boundaries. A joining session's prompt (conditioning latent, text and
+  start token) is run on its own to fill its KV cache, which is then added to the batch.
+- The KV caches of the batch are left-padded to a common length and the attention mask hides the padding. Tortoise
+  does not use GPT-2's position embeddings; the mel position embedding of every session is added here, so padding
+  does not shift positions.
+- Each session has its own sampling parameters (temperature, top_k, top_p, repetition_penalty) and random generator.
+- Each session's latents are vocoded incrementally (HifiganGenerator.inference_window) and its chunks are put on its
+  own queue, which its tts_stream() generator yields from.
+
+    engine = StreamingEngine(TextToSpeech(), max_batch_size=8)
+    for wav_chunk in engine.tts_stream(text, voice_samples=voice_samples):  # from any number of threads
+        ...
+
+The engine must be the only user of its TextToSpeech's autoregressive model and vocoder while it runs.
+"""
+
+import queue
+import random
+import threading
+from collections import deque
+
+import torch
+import torch.nn.functional as F
+
+from tortoise.utils.prefix_cache import prefix_key
+
+
+_END = object()
+
+
+class StreamSession:
+    """
+    One tts_stream() request inside a StreamingEngine. Iterating it yields its waveform chunks as they are produced
+    and re-raises the engine's error if decoding failed.
+    """
+
+    def __init__(self, prompt, conditioning, max_tokens, temperature=.8, top_k=50, top_p=.8, repetition_penalty=2.0,
+                 stream_chunk_size=40, overlap_wav_len=1024, vocoder_context=16, seed=None):
+        self.prompt = prompt
+        self.conditioning = conditioning
+        self.max_tokens = max_tokens
+        self.temperature = temperature
+        self.top_k = top_k
+        self.top_p = top_p
+        self.repetition_penalty = repetition_penalty
+        self.stream_chunk_size = stream_chunk_size
+        self.overlap_wav_len = overlap_wav_len
+        self.vocoder_context = vocoder_context
+        self.rng = random.Random(seed)
+        self.chunks = queue.Queue()
+        self._cancelled = threading.Event()
+        # Decoding state, only touched by the engine thread.
+        self.codes = []
+        self.latents = []
+        self.pending = 0  # Codes generated since the last chunk.
+        self.first_buffer = 60  # The first chunk waits for this many codes, as in tts_stream.
+        self.decoded_len = 0
+        self.wav_overlap = None
+
+    def cancel(self):
+        """Stops decoding this session; the engine drops it at the next token boundary."""
+        self._cancelled.set()
+
+    @property
+    def cancelled(self):
+        return self._cancelled.is_set()
+
+    def __iter__(self):
+        while True:
+            item = self.chunks.get()
+            if item is _END:
+                return
+            if isinstance(item, BaseException):
+                raise item
+            yield item
+
+
+class StreamingEngine:
+    """
+    :param tts: A tortoise.api_fast.TextToSpeech, used by this engine only.
+    :param max_batch_size: Most sessions decoded together; further sessions wait for one to finish.
+    :param max_width: Longest padded KV cache the batch may grow to. A session only joins a running batch if the batch
+                      can finish within it; on its own a session may exceed it.
+    """
+
+    def __init__(self, tts, max_batch_size=8, max_width=2048):
+        self.tts = tts
+        self.autoregressive = tts.autoregressive
+        self.gpt = tts.autoregressive.inference_model.transformer
+        self.prefix_cache = tts.autoregressive.inference_model.prefix_cache
+        self.device = tts.device
+        self.max_batch_size = max_batch_size
+        self.max_width = max_width
+        self.steps = 0
+        self._waiting = deque()
+        self._active = []  # Sessions in the order of the batch rows.
+        self._past = None  # Per layer (key, value), each (batch, heads, width, head_dim).
+        self._mask = None  # (batch, width), 0 over left padding.
+        self._seen = None  # (batch, mel codes), the codes each row's repetition penalty applies to.
+        self._cond = threading.Condition()
+        self._closed = False
+        self._thread = threading.Thread(target=self._run, name="tts-stream-engine", daemon=True)
+        self._thread.start()
+
+    # --------------------------------------------------------------------------
+    # Requests
+    # --------------------------------------------------------------------------
+    def tts_stream(self, text, voice_samples=None, conditioning_latents=None, use_deterministic_seed=None,
+                   overlap_wav_len=1024, stream_chunk_size=40, vocoder_context=16, temperature=.8, top_k=50, top_p=.8,
+                   repetition_penalty=2.0, max_mel_tokens=500, **kwargs):
+        """
+        Drop-in for api_fast.TextToSpeech.tts_stream: yields 24kHz waveform chunks of `text`. Closing the generator
+        cancels the session. Arguments tts_stream accepts but does not use (k, verbose, diffusion and CVVP knobs...)
+        are ignored here too.
+        """
+        session = self.submit(text, voice_samples, conditioning_latents, use_deterministic_seed,
+                              overlap_wav_len=overlap_wav_len, stream_chunk_size=stream_chunk_size,
+                              vocoder_context=vocoder_context, temperature=temperature, top_k=top_k, top_p=top_p,
+                              repetition_penalty=repetition_penalty, max_mel_tokens=max_mel_tokens)
+        try:
+            yield from session
+        finally:
+            session.cancel()
+
+    def submit(self, text, voice_samples=None, conditioning_latents=None, seed=None, max_mel_tokens=500, **kwargs):
+        """
+        Queues `text` for decoding and returns its StreamSession. The conditioning latent and prompt embedding are
+        computed in the calling thread. Keyword arguments are StreamSession's.
+        """
+        tts, ar = self.tts, self.autoregressive
+        text_tokens = torch.IntTensor(tts.tokenizer.encode(text)).unsqueeze(0).to(self.device)
+        text_tokens = F.pad(text_tokens, (0, 1))  # As in tts_stream.
+        assert text_tokens.shape[-1] < 400, 'Too much text provided. Break the text up into separate segments and re-try inference.'
+        with torch.no_grad(), self._autocast():
+            if voice_samples is not None:
+                conditioning = tts.get_conditioning_latents(voice_samples)
+            elif conditioning_latents is not None:
+                conditioning = conditioning_latents[0] if isinstance(conditioning_latents, (tuple, list)) else conditioning_latents
+            else:
+                conditioning = tts.get_random_conditioning_latents()
+            conditioning = conditioning.to(self.device)
+            start = torch.full((1, 1), ar.start_mel_token, dtype=torch.long, device=self.device)
+            prompt = torch.cat([ar.prompt_embeddings(conditioning, text_tokens),
+                                ar.mel_embedding(start) + ar.mel_pos_embedding(start)], dim=1)
+        session = StreamSession(prompt, conditioning, max_tokens=min(max_mel_tokens, ar.max_mel_tokens),
+                                seed=random.getrandbits(32) if seed is None else seed, **kwargs)
+        with self._cond:
+            if self._closed:
+                raise RuntimeError('StreamingEngine is closed.')
+            self._waiting.append(session)
+            self._cond.notify()
+        return session
+
+    def close(self):
+        """Stops the decoding thread; sessions still waiting or running end with an error."""
+        with self._cond:
+            self._closed = True
+            self._cond.notify()
+        self._thread.join()
+
+    @property
+    def active_sessions(self):
+        return len(self._active)
+
+    @property
+    def waiting_sessions(self):
+        return len(self._waiting)
+
+    # --------------------------------------------------------------------------
+    # Decoding thread
+    # --------------------------------------------------------------------------
+    def _autocast(self):
+        return torch.autocast(device_type="cuda", dtype=torch.float16, enabled=self.tts.half)
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._closed and not self._waiting and not self._active:
+                    self._cond.wait()
+                if self._closed:
+                    break
+                joining = self._admit()
+            try:
+                with torch.no_grad(), self._autocast():
+                    if self._active:
+                        self._step()
+                    for session in joining:
+                        self._prefill(session)
+                    self._emit()
+            except Exception as e:
+                for session in set(self._active + joining):
+                    session.chunks.put(e)
+                self._reset()
+        error = RuntimeError('StreamingEngine was closed.')
+        for session in list(self._active) + list(self._waiting):
+            session.chunks.put(error)
+        self._reset()
+
+    def _admit(self):
+        """Takes the waiting sessions that fit in the batch, first come first served. Called under self._cond."""
+        joining = []
+        width = 0 if self._mask is None else self._mask.shape[1]
+        remaining = max((s.max_tokens - len(s.codes) for s in self._active), default=0)
+        while self._waiting and len(self._active) + len(joining) < self.max_batch_size:
+            session = self._waiting[0]
+            if session.cancelled:
+                self._waiting.popleft()
+                session.chunks.put(_END)
+                continue
+            new_width = max(width, session.prompt.shape[1])
+            new_remaining = max(remaining, session.max_tokens)
+            if (self._active or joining) and new_width + new_remaining > self.max_width:
+                break
+            self._waiting.popleft()
+            joining.append(session)
+            width, remaining = new_width, new_remaining
+        return joining
+
+    def _step(self):
+        """Feeds every active session its last code and samples the next one."""
+        codes = torch.tensor([s.codes[-1] for s in self._active], device=self.device)
+        # Same mel positions as GPT2InferenceModel: the n-th sampled code is fed at position n + 1.
+        positions = torch.tensor([len(s.codes) + 1 for s in self._active], device=self.device)
+        emb = self.autoregressive.mel_embedding(codes) + self.autoregressive.mel_pos_embedding.emb(positions)
+        self._mask = F.pad(self._mask, (0, 1), value=1)
+        self._widen_causal_mask(self._mask.shape[1])
+        out = self.gpt(inputs_embeds=emb[:, None], past_key_values=self._past, attention_mask=self._mask,
+                       use_cache=True, return_dict=True)
+        self._past = out.past_key_values
+        self.steps += 1
+        self._sample(out.last_hidden_state[:, -1], self._active, self._seen)
+
+    def _prefill(self, session):
+        """Runs a joining session's prompt, samples its first code and adds its KV cache to the batch."""
+        key = prefix_key(session.prompt[0]) if self.prefix_cache is not None else None
+        entry = self.prefix_cache.get(key) if key is not None else None
+        if entry is None:
+            out = self.gpt(inputs_embeds=session.prompt, use_cache=True, return_dict=True)
+            hidden, prompt_past = out.last_hidden_state, out.past_key_values
+            if key is not None:
+                self.prefix_cache.put(key, (hidden[0],) + tuple(t[0] for kv in prompt_past for t in kv))
+        else:
+            hidden = entry[0][None]
+            prompt_past = tuple((entry[1 + 2 * layer][None], entry[2 + 2 * layer][None]) for layer in range(len(self.gpt.h)))
+        width = session.prompt.shape[1]
+        seen = torch.zeros((1, self.autoregressive.number_mel_codes), dtype=torch.bool, device=self.device)
+        # generate() also penalizes the placeholder ids of the prompt and the start token.
+        seen[:, [1, self.autoregressive.start_mel_token]] = True
+        self._sample(hidden[:, -1], [session], seen)
+        mask = torch.ones((1, width), dtype=torch.long, device=self.device)
+        if self._past is None:
+            self._past, self._mask, self._seen = prompt_past, mask, seen
+        else:
+            batch_width = self._mask.shape[1]
+            past, self._past = self._left_pad(prompt_past, batch_width - width), self._left_pad(self._past, width - batch_width)
+            self._past = tuple((torch.cat([k, nk]), torch.cat([v, nv])) for (k, v), (nk, nv) in zip(self._past, past))
+            self._mask = torch.cat([F.pad(self._mask, (max(width - batch_width, 0), 0)),
+                                    F.pad(mask, (max(batch_width - width, 0), 0))])
+            self._seen = torch.cat([self._seen, seen])
+        self._active.append(session)
+
+    @staticmethod
+    def _left_pad(past, amount):
+        if amount <= 0:
+            return past
+        return tuple((F.pad(k, (0, 0, amount, 0)), F.pad(v, (0, 0, amount, 0))) for k, v in past)
+
+    def _sample(self, hidden, sessions, seen):
+        """Samples one code per row of `hidden` with each session's settings (as generate() would) and records it."""
+        latents = self.autoregressive.final_norm(hidden)
+        logits = self.autoregressive.mel_head(latents).float()
+
+        def per_row(values):
+            return torch.tensor(values, dtype=torch.float, device=logits.device)[:, None]
+
+        penalty = per_row([s.repetition_penalty for s in sessions])
+        logits = torch.where(seen, torch.where(logits < 0, logits * penalty, logits / penalty), logits)
+        logits = logits / per_row([s.temperature for s in sessions])
+        logits, order = logits.sort(dim=-1, descending=True)
+        ranks = torch.arange(logits.shape[-1], device=logits.device)
+        top_k = per_row([s.top_k if s.top_k > 0 else logits.shape[-1] for s in sessions])
+        logits = logits.masked_fill(ranks >= top_k, -float('inf'))
+        probs = logits.softmax(dim=-1)
+        # Top-p keeps the most likely codes until their mass reaches top_p (at least one).
+        logits = logits.masked_fill(probs.cumsum(dim=-1) - probs >= per_row([s.top_p for s in sessions]), -float('inf'))
+        cdf = logits.softmax(dim=-1).cumsum(dim=-1)
+        draws = per_row([s.rng.random() for s in sessions]) * cdf[:, -1:]
+        picked = torch.searchsorted(cdf, draws).clamp_(max=cdf.shape[-1] - 1)
+        codes = order.gather(1, picked)
+        seen.scatter_(1, codes, True)
+        for session, code, latent in zip(sessions, codes[:, 0].tolist(), latents):
+            session.codes.append(code)
+            session.latents.append(latent)
+            session.pending += 1
+
+    def _emit(self):
+        """Vocodes the sessions that have a chunk due and removes the finished and cancelled ones from the batch."""
+        stop_token = self.autoregressive.stop_mel_token
+        done = []
+        for row, session in enumerate(self._active):
+            if session.cancelled:
+                done.append(row)
+                continue
+            finished = session.codes[-1] == stop_token or len(session.codes) >= session.max_tokens
+            chunk_size = max(session.stream_chunk_size, session.first_buffer)
+            if finished or (session.stream_chunk_size > 0 and session.pending >= chunk_size):
+                session.chunks.put(self._vocode(session))
+            if finished:
+                done.append(row)
+        for row in done:
+            self._active[row].chunks.put(_END)
+        if done:
+            self._remove(done)
+
+    def _vocode(self, session):
+        session.first_buffer = 0
+        session.pending = 0
+        latents = torch.stack(session.latents)[None]
+        start = max(session.decoded_len - session.overlap_wav_len, 0)
+        wav = self.tts.hifi_decoder.inference_window(latents, session.conditioning, start,
+                                                     context_frames=session.vocoder_context).squeeze()
+        session.decoded_len = start + wav.shape[0]
+        chunk, _, session.wav_overlap = self.tts.handle_chunks(wav, None, session.wav_overlap, session.overlap_wav_len)
+        return chunk
+
+    def _remove(self, rows):
+        keep = [row for row in range(len(self._active)) if row not in rows]
+        if not keep:
+            self._reset()
+            return
+        self._active = [self._active[row] for row in keep]
+        index = torch.tensor(keep, device=self.device)
+        mask = self._mask[index]
+        # Drop the columns that only held padding for the rows that are left.
+        first = int(mask.any(dim=0).int().argmax())
+        self._mask = mask[:, first:]
+        self._past = tuple((k[index, :, first:], v[index, :, first:]) for k, v in self._past)
+        self._seen = self._seen[index]
+
+    def _reset(self):
+        self._active = []
+        self._past = self._mask = self._seen = None
+
+    def _widen_causal_mask(self, width):
+        """
+        GPT-2 slices its causal mask from a buffer sized for the longest single sequence; padded batches can be wider.
+        The replacement is a larger lower-triangular mask shared by all layers, so unpadded use is unchanged.
+        """
+        bias = self.gpt.h[0].attn.bias
+        if bias.shape[-1] >= width:
+            return
+        width = max(width, self.max_width)
+        bias = torch.tril(torch.ones((width, width), dtype=torch.bool, device=bias.device)).view(1, 1, width, width)
+        for block in self.gpt.h:
+            block.attn.bias = bias
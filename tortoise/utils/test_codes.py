@@ -0,0 +1,115 @@
+"""
+Checks the batched code post-processing of tortoise.utils.codes against the row-by-row loops it replaced.
+
+Run with: python -m unittest tortoise.utils.test_codes
+"""
+import unittest
+
+import torch
+
+from tortoise.utils.codes import (CALM_TOKEN, END_CODES, _calm_trim_point_loop, _fix_autoregressive_output_loop,
+                                  calm_trim_points, fix_autoregressive_codes)
+
+STOP = 8193
+
+
+def _row(length, at=None):
+    """A row of non-calm codes, with at={index: code} written over it."""
+    row = torch.full((length,), 7, dtype=torch.long)
+    for index, value in (at or {}).items():
+        row[index] = value
+    return row
+
+
+def _calm_row(length, start, run):
+    """A row of non-calm codes with `run` calm tokens from `start`."""
+    row = torch.arange(length, dtype=torch.long) % 50 + 100  # never CALM_TOKEN
+    row[start:start + run] = CALM_TOKEN
+    return row
+
+
+class FixAutoregressiveCodesTest(unittest.TestCase):
+    def assert_matches_loop(self, codes):
+        expected = torch.stack([_fix_autoregressive_output_loop(row, STOP) for row in codes.clone()])
+        actual = fix_autoregressive_codes(codes.clone(), STOP, complain=False)
+        self.assertTrue(torch.equal(actual, expected), f'\n{actual}\n!=\n{expected}')
+        return actual
+
+    def test_row_without_stop_token(self):
+        codes = torch.stack([_row(12), _row(12, at={5: STOP})])
+        fixed = self.assert_matches_loop(codes)
+        self.assertTrue(torch.equal(fixed[0], codes[0]))
+
+    def test_no_row_stops(self):
+        codes = torch.randint(0, 8192, (3, 10))
+        self.assertTrue(torch.equal(self.assert_matches_loop(codes), codes))
+
+    def test_stop_token_at_index_zero(self):
+        codes = torch.stack([_row(10, at={0: STOP}), _row(10, at={9: STOP})])
+        fixed = self.assert_matches_loop(codes)
+        self.assertEqual(fixed[0].tolist(), [CALM_TOKEN] * 7 + list(END_CODES))
+
+    def test_several_stop_tokens(self):
+        self.assert_matches_loop(torch.stack([_row(10, at={3: STOP, 6: STOP}), _row(10, at={8: STOP})]))
+
+    def test_batch_of_one(self):
+        self.assert_matches_loop(_row(10, at={4: STOP}).unsqueeze(0))
+        self.assert_matches_loop(_row(10).unsqueeze(0))
+
+    def test_modifies_in_place(self):
+        codes = _row(10, at={4: STOP}).unsqueeze(0)
+        self.assertIs(fix_autoregressive_codes(codes, STOP, complain=False), codes)
+
+    def test_random_batch(self):
+        torch.manual_seed(0)
+        codes = torch.randint(0, 8192, (64, 40))
+        stops = torch.randint(0, 48, (64,))
+        for row, stop in enumerate(stops.tolist()):
+            if stop < 40:
+                codes[row, stop] = STOP
+        self.assert_matches_loop(codes)
+
+
+class CalmTrimPointsTest(unittest.TestCase):
+    def assert_matches_loop(self, codes, max_calm=8):
+        expected = [_calm_trim_point_loop(row, CALM_TOKEN, max_calm) for row in codes]
+        actual = calm_trim_points(codes, CALM_TOKEN, max_calm)
+        self.assertEqual(actual, expected)
+        return actual
+
+    def test_run_of_exactly_max_calm_is_not_cut(self):
+        self.assertEqual(self.assert_matches_loop(_calm_row(20, 4, 8).unsqueeze(0)), [None])
+
+    def test_run_of_max_calm_plus_one_is_cut(self):
+        self.assertEqual(self.assert_matches_loop(_calm_row(20, 4, 9).unsqueeze(0)), [12])
+
+    def test_run_ending_at_last_column(self):
+        codes = torch.stack([_calm_row(20, 11, 9), _calm_row(20, 12, 8), _calm_row(20, 0, 20)])
+        self.assertEqual(self.assert_matches_loop(codes), [19, None, 8])
+
+    def test_run_from_first_column(self):
+        self.assertEqual(self.assert_matches_loop(_calm_row(20, 0, 9).unsqueeze(0)), [8])
+
+    def test_interrupted_runs(self):
+        row = _calm_row(30, 0, 8)
+        row[9:17] = CALM_TOKEN
+        row[18:27] = CALM_TOKEN
+        self.assertEqual(self.assert_matches_loop(row.unsqueeze(0)), [26])
+
+    def test_other_max_calm(self):
+        codes = torch.stack([_calm_row(20, 2, 3), _calm_row(20, 2, 4)])
+        self.assertEqual(self.assert_matches_loop(codes, max_calm=3), [None, 5])
+
+    def test_after_fix(self):
+        # The real pipeline: trim points of codes that went through fix_autoregressive_codes.
+        torch.manual_seed(1)
+        codes = torch.randint(0, 8192, (32, 60))
+        for row in range(0, 32, 2):
+            codes[row, row + 10] = STOP
+        codes[5, 20:29] = CALM_TOKEN
+        fixed = fix_autoregressive_codes(codes, STOP, complain=False)
+        self.assert_matches_loop(fixed)
+
+
+if __name__ == '__main__':
+    unittest.main()
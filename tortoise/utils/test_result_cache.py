@@ -0,0 +1,155 @@
+"""
+Tests of the on-disk and remote tiers of tortoise.utils.result_cache.SynthesisCache.
+
+Run with: python -m unittest tortoise.utils.test_result_cache
+"""
+import os
+import shutil
+import tempfile
+import unittest
+
+import torch
+
+from tortoise.utils.result_cache import SynthesisCache, _serialize, make_cache_key
+
+
+def _key(name):
+    return make_cache_key([1, 2, 3], 'random', {'name': name}, 0)
+
+
+def _result(value):
+    return torch.full((64,), float(value))
+
+
+ENTRY_BYTES = len(_serialize(_result(0)))
+
+
+class DictRemote:
+    def __init__(self):
+        self.objects = {}
+        self.gets = 0
+
+    def get(self, key):
+        self.gets += 1
+        return self.objects.get(key)
+
+    def put(self, key, data):
+        self.objects[key] = data
+
+
+class SynthesisCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def cache(self, entries=2, **kwargs):
+        # Room for `entries` results of _result().
+        return SynthesisCache(self.dir, max_bytes=entries * ENTRY_BYTES, **kwargs)
+
+    def on_disk(self, cache, name):
+        return os.path.exists(cache._path(_key(name)))
+
+    def test_round_trip_and_counts(self):
+        cache = self.cache()
+        self.assertIsNone(cache.get(_key('a')))
+        cache.put(_key('a'), _result(1))
+        self.assertTrue(torch.equal(cache.get(_key('a')), _result(1)))
+        cache.put(_key('list'), [_result(2), _result(3)])
+        got = cache.get(_key('list'))
+        self.assertEqual(len(got), 2)
+        self.assertTrue(torch.equal(got[1], _result(3)))
+        self.assertEqual(cache.stats()['hits'], 2)
+        self.assertEqual(cache.stats()['misses'], 1)
+
+    def test_evicts_least_recently_used(self):
+        cache = self.cache()
+        cache.put(_key('a'), _result(1))
+        cache.put(_key('b'), _result(2))
+        cache.get(_key('a'))  # b is now the oldest.
+        cache.put(_key('c'), _result(3))
+        self.assertFalse(self.on_disk(cache, 'b'))
+        self.assertIsNone(cache.get(_key('b')))
+        self.assertIsNotNone(cache.get(_key('a')))
+        self.assertIsNotNone(cache.get(_key('c')))
+        stats = cache.stats()
+        self.assertEqual(stats['entries'], 2)
+        self.assertLessEqual(stats['bytes'], stats['max_bytes'])
+
+    def test_restart_orders_entries_by_mtime(self):
+        cache = self.cache()
+        cache.put(_key('a'), _result(1))
+        cache.put(_key('b'), _result(2))
+        # Make a the most recently used entry on disk.
+        os.utime(cache._path(_key('a')), (2e9, 2e9))
+        os.utime(cache._path(_key('b')), (1e9, 1e9))
+
+        restarted = self.cache()
+        self.assertEqual(restarted.stats()['entries'], 2)
+        self.assertEqual(restarted.stats()['bytes'], 2 * ENTRY_BYTES)
+        restarted.put(_key('c'), _result(3))
+        self.assertFalse(self.on_disk(restarted, 'b'))
+        self.assertTrue(self.on_disk(restarted, 'a'))
+
+    def test_read_refreshes_mtime(self):
+        cache = self.cache()
+        cache.put(_key('a'), _result(1))
+        os.utime(cache._path(_key('a')), (1e9, 1e9))
+        cache.get(_key('a'))
+        self.assertGreater(os.stat(cache._path(_key('a'))).st_mtime, 1e9)
+
+    def test_sees_entries_of_other_process(self):
+        first, second = self.cache(), self.cache()
+        first.put(_key('a'), _result(1))
+        self.assertTrue(torch.equal(second.get(_key('a')), _result(1)))
+        stats = second.stats()
+        self.assertEqual((stats['entries'], stats['bytes'], stats['hits']), (1, ENTRY_BYTES, 1))
+        # Adopted entries count towards the budget of the process that found them.
+        second.put(_key('b'), _result(2))
+        second.put(_key('c'), _result(3))
+        self.assertFalse(self.on_disk(second, 'a'))
+
+    def test_entry_removed_by_other_process(self):
+        first = self.cache()
+        first.put(_key('a'), _result(1))
+        second = self.cache()
+        first.put(_key('b'), _result(2))
+        first.put(_key('c'), _result(3))  # Evicts a from the shared directory.
+        self.assertIsNone(second.get(_key('a')))
+        self.assertEqual(second.stats()['entries'], 0)
+        self.assertEqual(second.stats()['bytes'], 0)
+
+    def test_remote_tier(self):
+        remote = DictRemote()
+        cache = self.cache(remote=remote)
+        cache.put(_key('a'), _result(1))
+        self.assertIn(_key('a'), remote.objects)
+        self.assertEqual(remote.gets, 0)
+
+        # A host with an empty disk tier reads the remote one and keeps a local copy.
+        other = SynthesisCache(os.path.join(self.dir, 'other'), max_bytes=2 * ENTRY_BYTES, remote=remote)
+        self.assertTrue(torch.equal(other.get(_key('a')), _result(1)))
+        self.assertEqual(remote.gets, 1)
+        self.assertTrue(os.path.exists(other._path(_key('a'))))
+        other.get(_key('a'))
+        self.assertEqual(remote.gets, 1)
+
+        self.assertIsNone(other.get(_key('missing')))
+        self.assertEqual(remote.gets, 2)
+        self.assertEqual((other.stats()['hits'], other.stats()['misses']), (2, 1))
+
+
+class CacheKeyTest(unittest.TestCase):
+    def test_key_depends_on_every_part(self):
+        base = make_cache_key([1, 2], 'voice', {'temperature': .8}, 1)
+        self.assertEqual(base, make_cache_key([1, 2], 'voice', {'temperature': .8}, 1))
+        for other in [make_cache_key([1, 3], 'voice', {'temperature': .8}, 1),
+                      make_cache_key([1, 2], 'other', {'temperature': .8}, 1),
+                      make_cache_key([1, 2], 'voice', {'temperature': .9}, 1),
+                      make_cache_key([1, 2], 'voice', {'temperature': .8}, 2)]:
+            self.assertNotEqual(base, other)
+
+
+if __name__ == '__main__':
+    unittest.main()
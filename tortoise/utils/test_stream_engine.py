@@ -0,0 +1,158 @@
+"""
+Continuous-batching tests for tortoise.utils.stream_engine on a tiny, randomly initialised model (CPU, no checkpoints).
+
+A seeded session must sample exactly the same codes whether it is decoded alone or while other sessions, with other
+prompt lengths and sampling settings, join and leave the batch: any mistake in the left padding, the attention mask,
+the mel positions or the per-row sampling changes them.
+
+Run with: python -m unittest tortoise.utils.test_stream_engine
+"""
+import threading
+import time
+import unittest
+
+import torch
+
+from tortoise.api_fast import TextToSpeech
+from tortoise.models.autoregressive import UnifiedVoice
+from tortoise.models.hifigan_decoder import HifiganGenerator
+from tortoise.utils.prefix_cache import PrefixCache
+from tortoise.utils.stream_engine import StreamingEngine
+from tortoise.utils.tokenizer import VoiceBpeTokenizer
+
+DIM = 32
+
+LONG_TEXT = 'And a third sentence that is somewhat longer than the first one is.'
+TEXT = 'Hello there, this is the first test sentence.'
+SHORT_TEXT = 'Short one.'
+
+
+def make_tts(prefix_cache=None):
+    """An api_fast.TextToSpeech around tiny random models, built without loading any checkpoint."""
+    torch.manual_seed(0)
+    tts = object.__new__(TextToSpeech)
+    tts.device = torch.device('cpu')
+    tts.half = False
+    tts.tokenizer = VoiceBpeTokenizer()
+    tts.autoregressive = UnifiedVoice(max_mel_tokens=604, max_text_tokens=402, max_conditioning_inputs=2, layers=2,
+                                      model_dim=DIM, heads=4, number_text_tokens=255, start_text_token=255,
+                                      checkpointing=False, train_solo_embeddings=False).eval()
+    tts.autoregressive.post_init_gpt2_config(kv_cache=True)
+    tts.autoregressive.inference_model.prefix_cache = prefix_cache
+    tts.hifi_decoder = HifiganGenerator(in_channels=DIM, out_channels=1, resblock_type='1',
+                                        resblock_dilation_sizes=[[1, 3, 5]] * 3, resblock_kernel_sizes=[3, 7, 11],
+                                        upsample_kernel_sizes=[16, 16, 4, 4], upsample_initial_channel=32,
+                                        upsample_factors=[8, 8, 2, 2], cond_channels=DIM).eval()
+    conditioning = torch.randn(1, DIM)
+    tts.get_random_conditioning_latents = lambda: conditioning
+    return tts
+
+
+def drain(session, timeout=60):
+    """Consumes `session` on another thread; returns its chunks, failing the test if it does not end in time."""
+    chunks = []
+    errors = []
+
+    def consume():
+        try:
+            chunks.extend(session)
+        except Exception as e:
+            errors.append(e)
+
+    thread = threading.Thread(target=consume, daemon=True)
+    thread.start()
+    thread.join(timeout)
+    assert not thread.is_alive(), 'session did not end'
+    if errors:
+        raise errors[0]
+    return chunks
+
+
+def wait_for_codes(session, count, timeout=60):
+    deadline = time.time() + timeout
+    while len(session.codes) < count:
+        assert time.time() < deadline, 'session made no progress'
+        time.sleep(0.001)
+
+
+class StreamingEngineTest(unittest.TestCase):
+    def setUp(self):
+        self.engine = StreamingEngine(make_tts(), max_batch_size=4)
+
+    def tearDown(self):
+        self.engine.close()
+
+    def alone(self, text, seed, **kwargs):
+        session = self.engine.submit(text, seed=seed, **kwargs)
+        drain(session)
+        return session
+
+    def test_codes_do_not_depend_on_other_sessions(self):
+        main = dict(max_mel_tokens=120, stream_chunk_size=20)
+        # Joiners with a longer and a shorter prompt (left padding on either side) and other sampling settings.
+        longer = dict(max_mel_tokens=25, temperature=1.2, top_k=10, top_p=.95, repetition_penalty=1.0)
+        shorter = dict(max_mel_tokens=40, temperature=.5, top_k=0, top_p=.5, repetition_penalty=3.0)
+        expected = {name: self.alone(text, seed, **kwargs).codes for name, text, seed, kwargs in
+                    [('main', TEXT, 1, main), ('longer', LONG_TEXT, 2, longer), ('shorter', SHORT_TEXT, 3, shorter)]}
+        self.assertEqual(self.engine.active_sessions, 0)
+
+        session = self.engine.submit(TEXT, seed=1, **main)
+        wait_for_codes(session, 5)
+        joined_longer = self.engine.submit(LONG_TEXT, seed=2, **longer)
+        wait_for_codes(joined_longer, 5)
+        joined_shorter = self.engine.submit(SHORT_TEXT, seed=3, **shorter)
+        drain(joined_longer)
+        drain(joined_shorter)
+        # Both joiners left while the first session was still decoding.
+        self.assertLess(len(session.codes), len(expected['main']))
+        drain(session)
+
+        self.assertEqual(joined_longer.codes, expected['longer'])
+        self.assertEqual(joined_shorter.codes, expected['shorter'])
+        self.assertEqual(session.codes, expected['main'])
+        self.assertEqual(self.engine.active_sessions, 0)
+
+    def test_seeded_session_yields_same_audio(self):
+        first = torch.cat(drain(self.engine.submit(TEXT, seed=5, max_mel_tokens=80, stream_chunk_size=20)))
+        second = torch.cat(drain(self.engine.submit(TEXT, seed=5, max_mel_tokens=80, stream_chunk_size=20)))
+        self.assertGreater(len(first), 0)
+        self.assertTrue(torch.equal(first, second))
+
+    def test_cancel_ends_iterator(self):
+        session = self.engine.submit(TEXT, seed=1, max_mel_tokens=500, stream_chunk_size=10)
+        chunks = iter(session)
+        next(chunks)
+        session.cancel()
+        drain(chunks)
+        self.assertLess(len(session.codes), 500)
+        deadline = time.time() + 10
+        while self.engine.active_sessions:
+            self.assertLess(time.time(), deadline)
+            time.sleep(0.01)
+
+    def test_closing_stream_generator_cancels(self):
+        stream = self.engine.tts_stream(TEXT, max_mel_tokens=500, stream_chunk_size=10)
+        next(stream)
+        stream.close()
+        # The engine drops the session and carries on with new ones.
+        self.assertEqual(len(self.alone(SHORT_TEXT, seed=1, max_mel_tokens=10).codes), 10)
+        self.assertEqual(self.engine.active_sessions, 0)
+
+
+class PrefixCacheTest(unittest.TestCase):
+    def test_cached_prompt_gives_same_codes(self):
+        cache = PrefixCache(64 * 1024 ** 2)
+        engine = StreamingEngine(make_tts(cache))
+        try:
+            first = engine.submit(TEXT, seed=4, max_mel_tokens=40)
+            drain(first)
+            second = engine.submit(TEXT, seed=4, max_mel_tokens=40)
+            drain(second)
+        finally:
+            engine.close()
+        self.assertEqual(cache.stats()['hits'], 1)
+        self.assertEqual(first.codes, second.codes)
+
+
+if __name__ == '__main__':
+    unittest.main()